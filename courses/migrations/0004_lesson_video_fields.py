@@ -0,0 +1,45 @@
+# Generated by Django 2.2 on 2026-10-18 04:46
+
+import courses.models
+import coursify.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0003_auto_20190917_1711'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='video_duration',
+            field=models.DurationField(blank=True, editable=False, null=True, verbose_name='длительность видео'),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='video_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='высота видео'),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='video_size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='размер видео'),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='video_thumbnail',
+            field=models.FileField(blank=True, editable=False, upload_to='', verbose_name='превью видео'),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='video_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='ширина видео'),
+        ),
+        migrations.AlterField(
+            model_name='lesson',
+            name='video',
+            field=coursify.fields.VideoField(blank=True, duration_field='video_duration', height_field='video_height', size_field='video_size', thumbnail_field='video_thumbnail', upload_to=courses.models.lesson_video_upload_to, verbose_name='видео', width_field='video_width'),
+        ),
+    ]
@@ -33,7 +33,15 @@ class Lesson(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='lessons', verbose_name='курс')
     name = models.CharField('название', max_length=100)
     slug = models.SlugField('ссылка')
-    video = VideoField('видео', upload_to=lesson_video_upload_to, blank=True)
+    video = VideoField('видео', upload_to=lesson_video_upload_to, blank=True,
+                       width_field='video_width', height_field='video_height',
+                       duration_field='video_duration', size_field='video_size',
+                       thumbnail_field='video_thumbnail')
+    video_width = models.PositiveIntegerField('ширина видео', null=True, blank=True, editable=False)
+    video_height = models.PositiveIntegerField('высота видео', null=True, blank=True, editable=False)
+    video_duration = models.DurationField('длительность видео', null=True, blank=True, editable=False)
+    video_size = models.BigIntegerField('размер видео', null=True, blank=True, editable=False)
+    video_thumbnail = models.FileField('превью видео', blank=True, editable=False)
     content = models.TextField('контент', blank=True)
 
     created_at = models.DateTimeField('дата создания', auto_now_add=True)
@@ -0,0 +1,30 @@
+from django.contrib import admin
+
+from .models import DashAsset, VideoConversion
+
+
+@admin.register(VideoConversion)
+class VideoConversionAdmin(admin.ModelAdmin):
+    list_display = ('file_name', 'state', 'tier', 'task_priority', 'stage', 'percent', 'speed', 'eta',
+                    'queued_at', 'queue_wait', 'updated_at')
+    list_filter = ('state', 'tier')
+    search_fields = ('file_name',)
+    readonly_fields = [field.name for field in VideoConversion._meta.fields]
+
+    def queue_wait(self, conversion):
+        return conversion.queue_wait
+    queue_wait.short_description = 'ожидание в очереди, с'
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(DashAsset)
+class DashAssetAdmin(admin.ModelAdmin):
+    list_display = ('file_name', 'state', 'representations', 'file_count', 'size', 'ladder', 'updated_at')
+    list_filter = ('state',)
+    search_fields = ('file_name',)
+    readonly_fields = [field.name for field in DashAsset._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,6 @@
+from django.apps import AppConfig
+
+
+class CoursifyConfig(AppConfig):
+    name = 'coursify'
+    verbose_name = 'Видео'
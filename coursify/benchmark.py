@@ -0,0 +1,201 @@
+import io
+import os
+import posixpath
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+
+from .dash import DashVideoManager
+
+# этапы конвертации в порядке выполнения, их длительность измеряет TimedDashVideoManager
+STAGES = ('copy_in', 'probe', 'analyze', 'encode', 'save', 'destroy')
+
+
+def create_clip(path: str, width: int, height: int, duration: int):
+    """создаёт тестовое видео из источников lavfi: таблица testsrc2 и синусоида 440 Гц
+
+    Видео кодируется с bitexact флагами, поэтому одинаковые параметры
+    на одной версии ffmpeg дают один и тот же файл и результаты разных
+    веток сравниваются на одинаковых исходниках.
+    """
+
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=24:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-map_metadata', '-1', '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact',
+        '-shortest', '-y', path,
+    ], check=True)
+
+
+class MemoryStorage(Storage):
+    """ Storage, который хранит файлы в памяти процесса.
+
+    Не хранит файлы в локальной файловой системе (path не реализован),
+    поэтому DashVideoManager работает с ним так же, как с удалённым storage:
+    копирует оригинал во временный файл и сохраняет результаты копированием.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode:
+            return File(_MemoryFile(self.files, name), name)
+        return File(io.BytesIO(self.files[name]), name)
+
+    def _save(self, name, content):
+        self.files[name] = b''.join(content.chunks())
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def url(self, name):
+        return '/' + name
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/' if path else ''
+        names = [name[len(prefix):] for name in self.files if name.startswith(prefix)]
+        return (sorted({name.split('/')[0] for name in names if '/' in name}),
+                sorted(name for name in names if '/' not in name))
+
+
+class _MemoryFile(io.BytesIO):
+    """файл MemoryStorage, открытый на запись, сохраняется при закрытии"""
+
+    def __init__(self, files: dict, name: str):
+        super().__init__()
+        self._files = files
+        self._name = name
+
+    def close(self):
+        if not self.closed:
+            self._files[self._name] = self.getvalue()
+        super().close()
+
+
+class TimedDashVideoManager(DashVideoManager):
+    """ DashVideoManager, который измеряет длительность каждого этапа конвертации.
+
+    Превью и миниатюры создаются тем же процессом ffmpeg, что и dash,
+    поэтому их время входит в encode.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = {}
+
+    def _create_temp_video_file(self):
+        with self._timer('copy_in'):
+            super()._create_temp_video_file()
+        with self._timer('probe'):
+            self._get_probe()
+
+    def _measure_complexity(self):
+        with self._timer('analyze'):
+            return super()._measure_complexity()
+
+    def _generate_dash(self):
+        with self._timer('encode'):
+            return super()._generate_dash()
+
+    def _generate_dash_progressively(self):
+        # при постепенной публикации файлы сохраняются после каждого разрешения
+        with self._timer('encode'):
+            return super()._generate_dash_progressively()
+
+    def _save_generated_files(self):
+        with self._timer('save'):
+            super()._save_generated_files()
+
+    def destroy(self):
+        with self._timer('destroy'):
+            super().destroy()
+
+    def _timer(self, stage: str):
+        return _Timer(self.timings, stage)
+
+
+class _Timer:
+    def __init__(self, timings: dict, stage: str):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + time.monotonic() - self.started_at
+
+
+def benchmark_clip(clip_path: str, storage: Storage) -> dict:
+    """конвертирует видео в storage и удаляет результаты, измеряя длительность этапов
+
+    :return: длительность этапов в секундах и статистика сохранения файлов
+    """
+
+    with open(clip_path, "rb") as clip_file:
+        name = storage.save(posixpath.join('benchmark', os.path.basename(clip_path)), File(clip_file))
+
+    try:
+        manager = TimedDashVideoManager(name, storage)
+        started_at = time.monotonic()
+        manager.generate()
+        generated_at = time.monotonic()
+
+        destroy_manager = TimedDashVideoManager(name, storage)
+        destroy_manager.destroy()
+    finally:
+        storage.delete(name)
+
+    timings = dict(manager.timings, destroy=destroy_manager.timings['destroy'])
+    return {
+        'stages': {stage: round(timings.get(stage, 0.0), 3) for stage in STAGES},
+        'generate_total': round(generated_at - started_at, 3),
+        'upload': manager.uploader.stats.as_dict(),
+    }
+
+
+def get_storages(names: list, work_dir: str) -> dict:
+    """storage для тестов по названиям: filesystem - FileSystemStorage
+    во временной директории, memory - MemoryStorage"""
+
+    storages = {}
+    for name in names:
+        if name == 'filesystem':
+            storages[name] = FileSystemStorage(location=os.path.join(work_dir, 'storage'))
+        elif name == 'memory':
+            storages[name] = MemoryStorage()
+        else:
+            raise ValueError(f"Unknown storage: {name}")
+    return storages
+
+
+def get_environment() -> dict:
+    """версии ffmpeg и кода и настройки конвертации, чтобы результаты можно было сравнивать"""
+
+    ffmpeg = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  universal_newlines=True)
+    except OSError:
+        revision = None
+    return {
+        'ffmpeg': ffmpeg.stdout.split('\n')[0],
+        'revision': revision.stdout.strip() if revision and revision.returncode == 0 else None,
+        'cpu_count': os.cpu_count(),
+        'settings': {name: getattr(settings, name) for name in dir(settings) if name.startswith('DASH_')},
+    }
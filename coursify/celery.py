@@ -1,10 +1,11 @@
 import os
 from celery import Celery
+from celery.signals import celeryd_init
 
 # set the default Django settings module for the 'celery' program.
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'domznaniy.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'coursify.settings')
 
-app = Celery('domznaniy')
+app = Celery('coursify')
 
 # Using a string here means the worker doesn't have to serialize
 # the configuration object to child processes.
@@ -14,3 +15,26 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
+
+
+@celeryd_init.connect
+def configure_transcoding_worker(sender=None, conf=None, options=None, **kwargs):
+    """ Настраивает воркер, который обрабатывает только очереди конвертации видео.
+
+    Количество процессов такого воркера по умолчанию - DASH_WORKER_CONCURRENCY,
+    а не количество ядер: каждая конвертация сама занимает DASH_CPU_BUDGET ядер.
+    Каждый процесс берёт из очереди по одной задаче, чтобы длинная конвертация
+    не держала за собой видео, которые мог бы взять свободный воркер.
+    """
+
+    from django.conf import settings
+
+    queues = (options or {}).get('queues') or []
+    if isinstance(queues, str):
+        queues = queues.split(',')
+    if not queues or not set(queues) <= {settings.DASH_QUEUE, settings.DASH_HEAVY_QUEUE}:
+        return
+
+    if not options.get('concurrency'):
+        conf.worker_concurrency = settings.DASH_WORKER_CONCURRENCY
+    conf.worker_prefetch_multiplier = 1
@@ -1,12 +1,139 @@
+import fcntl
+import functools
+import hashlib
+import json
 import os
 import tempfile
 import subprocess
 import shutil
 import glob
-
-from django.core import checks
+import math
+import posixpath
+import re
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
 from django.core.files.storage import Storage
 
+from .models import DashAsset
+from .mpd import MpdManifest, find_index_range
+from .probe import VideoProbe
+from .progress import FfmpegProgress
+from .remover import StorageRemover
+from .source import PIPE_SOURCE, ProcessCancelled, needs_seeking, run_with_source
+from .uploader import SegmentWatcher, StorageUploader
+
+Rendition = namedtuple('Rendition', ['height', 'bitrate', 'profile'])
+
+# высота пробного кодирования, по которому оценивается сложность видео (DASH_ADAPTIVE_LADDER)
+COMPLEXITY_HEIGHT = 240
+
+# во сколько раз растёт битрейт того же качества при росте количества пикселей в n раз: n ** 0.75
+COMPLEXITY_PIXELS_EXPONENT = 0.75
+
+# во сколько раз битрейты соседних разрешений лестницы видео должны отличаться хотя бы
+MIN_BITRATE_STEP = 1.5
+
+# схема SupplementalProperty mpd манифеста, в которой хранится сложность видео
+COMPLEXITY_SCHEME = 'urn:coursify:dash:complexity'
+
+# профили h264 по первому байту параметров кодека avc1 в mpd манифесте
+AVC_PROFILES = {'42': 'baseline', '4d': 'main', '64': 'high'}
+
+
+def parse_ladder(ladder: str) -> tuple:
+    """разбирает лестницу разрешений вида 360:450k:baseline,480:700k:main
+    (высота:битрейт:профиль h264) и упорядочивает её от меньшего разрешения к большему
+
+    :raises ValueError: если лестница записана неверно
+    """
+
+    renditions = []
+    for rung in ladder.split(','):
+        try:
+            height, bitrate, profile = rung.strip().split(':')
+            renditions.append(Rendition(height=int(height), bitrate=bitrate, profile=profile))
+        except ValueError:
+            raise ValueError(f"Invalid rendition {rung!r}, expected height:bitrate:profile")
+    if not renditions:
+        raise ValueError("Empty renditions ladder")
+    return tuple(sorted(renditions))
+
+
+def format_ladder(renditions) -> str:
+    """записывает лестницу разрешений в том же виде, что и DASH_LADDER"""
+    return ','.join(f'{rendition.height}:{rendition.bitrate}:{rendition.profile}' for rendition in renditions)
+
+
+def manifest_ladder(manifest: MpdManifest) -> tuple:
+    """лестница разрешений, с которой опубликовано видео, по его mpd манифесту"""
+
+    renditions = []
+    for _, representation in manifest.video_representations():
+        codecs = representation.get('codecs', '')
+        profile = AVC_PROFILES.get(codecs[5:7].lower(), codecs) if codecs.startswith('avc1.') else codecs
+        renditions.append(Rendition(
+            height=int(representation.get('height', 0)),
+            bitrate=f"{int(representation.get('bandwidth', 0)) // 1000}k",
+            profile=profile))
+    return tuple(sorted(renditions))
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """битрейт ffmpeg вида 450k или 5M в битах в секунду"""
+
+    multipliers = {'k': 1000, 'M': 1000000}
+    if bitrate[-1:] in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[bitrate[-1]])
+    return int(bitrate)
+
+
+def adapt_ladder(renditions, complexity: int, min_factor: float, max_factor: float) -> tuple:
+    """ Подбирает битрейты и количество разрешений лестницы для конкретного видео (per-title).
+
+    complexity - битрейт пробного кодирования видео в COMPLEXITY_HEIGHT
+    с постоянным качеством (см. DashVideoManager._measure_complexity).
+    Битрейт, при котором разрешение достигает того же качества, растёт
+    медленнее количества пикселей (COMPLEXITY_PIXELS_EXPONENT), и он ограничен
+    битрейтом разрешения из лестницы, умноженным на min_factor и max_factor.
+    Поэтому статичные слайды получают битрейты в разы меньше, а динамичные
+    демонстрации - больше, чем в лестнице.
+
+    Самое большое разрешение остаётся всегда, а меньшее убирается, если
+    его битрейт меньше чем в MIN_BITRATE_STEP раз ниже битрейта следующего
+    оставленного разрешения (переключаться между ними плееру незачем) или
+    если следующее разрешение уже укладывается в битрейт самого маленького
+    разрешения лестницы, т.е. его и так можно смотреть на самом медленном
+    подключении. Так у лекции со слайдами остаются два-три разрешения.
+    """
+
+    adapted = []
+    for rendition in renditions:
+        pixels_ratio = (rendition.height / COMPLEXITY_HEIGHT) ** 2
+        bitrate = complexity * pixels_ratio ** COMPLEXITY_PIXELS_EXPONENT
+        ladder_bitrate = parse_bitrate(rendition.bitrate)
+        bitrate = min(max(bitrate, ladder_bitrate * min_factor), ladder_bitrate * max_factor)
+        adapted.append(rendition._replace(bitrate=f'{max(1, round(bitrate / 1000))}k'))
+
+    lowest_bitrate = parse_bitrate(renditions[0].bitrate)
+    kept = [adapted[-1]]
+    for rendition in reversed(adapted[:-1]):
+        next_bitrate = parse_bitrate(kept[-1].bitrate)
+        if next_bitrate > lowest_bitrate and parse_bitrate(rendition.bitrate) * MIN_BITRATE_STEP <= next_bitrate:
+            kept.append(rendition)
+    return tuple(reversed(kept))
+
+
+class DashGenerationError(Exception):
+    """ ffmpeg завершился с ошибкой при генерации dash.
+    stderr - последние строки вывода ffmpeg с описанием ошибки."""
+
+    def __init__(self, message: str, stderr: str = ''):
+        super().__init__(message)
+        self.stderr = stderr
+
 
 class DashFilesNames:
     """
@@ -55,6 +182,31 @@ class DashFilesNames:
         filename = cls.get_video_name(video_name)
         return f"{filename}-init-stream\$RepresentationID\$.m4s"
 
+    @classmethod
+    def dash_single_file_mask(cls, video_name: str) -> str:
+        """ Генерирует маску названий файлов потоков для раскладки
+        одним файлом на поток (DASH_SINGLE_FILE). При генерации
+        на место подстроки \$RepresentationID\$ будет подставляться
+        номер потока.
+
+        :param video_name: название оригинального видео файла
+        :return: маска для названий файлов потоков
+        """
+        filename = cls.get_video_name(video_name)
+        return f"{filename}-stream\$RepresentationID\$.mp4"
+
+    @classmethod
+    def hls_playlist_name(cls, video_name: str) -> str:
+        """Возвращает название основного плейлиста HLS"""
+        filename = cls.get_video_name(video_name)
+        return filename + ".m3u8"
+
+    @classmethod
+    def hls_media_playlist_name(cls, video_name: str, stream_id: int) -> str:
+        """Возвращает название плейлиста HLS одного потока, номер потока тот же, что в mpd"""
+        filename = cls.get_video_name(video_name)
+        return f"{filename}-media-{stream_id}.m3u8"
+
     @classmethod
     def preview_image_name(cls, video_name: str) -> str:
         """Возвращает название файла preview из названия видео"
@@ -64,6 +216,31 @@ class DashFilesNames:
         filename = cls.get_video_name(video_name)
         return filename + ".jpg"
 
+    @classmethod
+    def poster_candidate_name(cls, video_name: str, index: int) -> str:
+        """Возвращает название одного из вариантов превью, index начинается с 1"""
+        filename = cls.get_video_name(video_name)
+        return f"{filename}-poster-{index}.jpg"
+
+    @classmethod
+    def thumbnails_track_name(cls, video_name: str) -> str:
+        """Возвращает название WebVTT дорожки миниатюр для перемотки"""
+        filename = cls.get_video_name(video_name)
+        return filename + "-thumbnails.vtt"
+
+    @classmethod
+    def thumbnails_sprite_name(cls, video_name: str, number: int) -> str:
+        """Возвращает название спрайта с миниатюрами для перемотки, number начинается с 1"""
+        filename = cls.get_video_name(video_name)
+        return f"{filename}-sprite-{str(number).zfill(3)}.jpg"
+
+    @classmethod
+    def thumbnails_sprite_mask(cls, video_name: str) -> str:
+        """Возвращает маску названий спрайтов для ffmpeg,
+        на место %03d подставляется номер спрайта"""
+        filename = cls.get_video_name(video_name)
+        return f"{filename}-sprite-%03d.jpg"
+
     @classmethod
     def get_video_name(cls, video_name: str) -> str:
         filename, ext = os.path.splitext(video_name)
@@ -90,15 +267,114 @@ class DashVideoManager:
     3) файлы чанков (в коде отмечены как chunk файлы) - файлы, в которых непосредственно
     кодируется определённый промежуток потока. На момент написания этого комментария,
     это было около 2-3 секнуд в каждом чанке.
+
+    Если включён DASH_SINGLE_FILE, init часть и все чанки потока хранятся
+    в одном файле, а плеер запрашивает чанки по диапазонам байт.
+
+    Если включён DASH_HLS_PLAYLIST, рядом с mpd создаются плейлисты HLS,
+    которые ссылаются на те же самые init файлы и чанки (CMAF).
     """
 
     TEMP_DIR_PREFIX = "dash_video_"
 
-    def __init__(self: object, file_name: str, storage: Storage):
+    # файл с параметрами кодирования в директории контрольной точки
+    CHECKPOINT_PARAMS_NAME = "checkpoint.json"
+
+    # файл в директории контрольной точки, который блокирует конвертация (flock)
+    CHECKPOINT_LOCK_NAME = "checkpoint.lock"
+
+    # разрешение лестницы кодируется, если оно выше оригинала меньше, чем на столько пикселей
+    LADDER_HEIGHT_TOLERANCE = 10
+
+    # сколько самых маленьких разрешений лестницы кодируется даже для видео меньшей высоты
+    MIN_RENDITIONS = 2
+
+    VIDEO_CODEC_ARGS = [
+        '-c:v', 'libx264', '-x264opts', 'keyint=24:min-keyint=24:no-scenecut', '-r', '24',
+        '-bf', '1', '-b_strategy', '0', '-sc_threshold', '0', '-pix_fmt', 'yuv420p',
+    ]
+
+    AUDIO_BITRATE = '128k'
+
+    AUDIO_CODEC_ARGS = ['-c:a', 'aac', '-b:a', AUDIO_BITRATE]
+
+    # длина сегмента в секундах, кратна интервалу ключевых кадров (24 кадра при 24 fps)
+    SEGMENT_DURATION = 5
+
+    # сколько миниатюр для перемотки помещается в один спрайт: колонки и строки
+    THUMBNAILS_TILE = (5, 5)
+
+    # как часто проверять ход параллельных процессов ffmpeg, в секундах
+    PROGRESS_POLL_INTERVAL = 0.5
+
+    # длина отрезков видео, по которым оценивается его сложность, в секундах
+    COMPLEXITY_SAMPLE_DURATION = 2
+
+    # сколько секунд добавляется к ограничению времени работы ffmpeg (DASH_FFMPEG_TIMEOUT)
+    FFMPEG_TIMEOUT_MARGIN = 60
+
+    # сколько последних строк stderr ffmpeg сохранять в описании ошибки
+    STDERR_TAIL_LINES = 20
+
+    # так ffmpeg называет плейлисты HLS потоков, номер - номер потока
+    HLS_MEDIA_PLAYLIST = re.compile(r'\bmedia_(\d+)\.m3u8\b')
+
+    def __init__(self: object, file_name: str, storage: Storage, probe: VideoProbe = None,
+                 progress: FfmpegProgress = None):
+        """
+        :param progress: куда сообщать о ходе конвертации или None, если ход не нужен
+        """
         self.file_name = file_name
         self.storage = storage
+        self.probe = probe
+        self.progress = progress
         self.temp_video_file = None
         self.temp_dir = None
+        self.source_path = None
+        self.checkpoint_path = None
+        # открытый файл блокировки контрольной точки, пока её держит эта конвертация
+        self.checkpoint_lock = None
+        self.publish_by_rename = False
+        self.published_names = set()
+        # размеры файлов, сохранённых в storage, но ещё не записанных в индекс (DashAsset)
+        self.saved_files = {}
+        self.parallel_renditions = settings.DASH_PARALLEL_RENDITIONS
+        self.cpu_budget = settings.DASH_CPU_BUDGET
+        self.threads_per_job = settings.DASH_THREADS_PER_JOB
+        self.niceness = settings.DASH_NICENESS
+        self.ffmpeg_timeout = settings.DASH_FFMPEG_TIMEOUT
+        # после установки все процессы ffmpeg конвертации прерываются (см. cancel)
+        self.cancelled = threading.Event()
+        # лестница разрешений от меньшего к большему (DASH_LADDER), при первой конвертации
+        # номер разрешения в лестнице совпадает с номером потока в названиях его файлов
+        self.ladder = parse_ladder(settings.DASH_LADDER)
+        self.adaptive_ladder = settings.DASH_ADAPTIVE_LADDER
+        self.adaptive_crf = settings.DASH_ADAPTIVE_CRF
+        self.adaptive_samples = settings.DASH_ADAPTIVE_SAMPLES
+        self.adaptive_factors = (settings.DASH_ADAPTIVE_MIN_FACTOR, settings.DASH_ADAPTIVE_MAX_FACTOR)
+        # сложность видео (см. _measure_complexity) или None, если лестница не подбирается
+        self.complexity = None
+        self.checkpoint_dir = settings.DASH_CHECKPOINT_DIR
+        self.progressive_publish = settings.DASH_PROGRESSIVE_PUBLISH
+        # при постепенной публикации каждое разрешение кодируется целиком
+        self.time_slices = 0 if self.progressive_publish else settings.DASH_TIME_SLICES
+        self.single_file = settings.DASH_SINGLE_FILE
+        self.hls_playlist = settings.DASH_HLS_PLAYLIST
+        # файл потока целиком готов только после завершения ffmpeg
+        self.stream_upload = settings.DASH_STREAM_UPLOAD and not self.single_file
+        self.pipe_source = settings.DASH_PIPE_SOURCE
+        self.preview_time = settings.DASH_PREVIEW_TIME
+        self.poster_candidates = settings.DASH_POSTER_CANDIDATES
+        self.thumbnails_interval = settings.DASH_THUMBNAILS_INTERVAL
+        self.thumbnails_width = settings.DASH_THUMBNAILS_WIDTH
+        self.uploader = StorageUploader(
+            storage,
+            concurrency=settings.DASH_UPLOAD_CONCURRENCY,
+            retries=settings.DASH_UPLOAD_RETRIES)
+        self.remover = StorageRemover(
+            storage,
+            concurrency=settings.DASH_DELETE_CONCURRENCY,
+            batch_size=settings.DASH_DELETE_BATCH_SIZE)
 
     def __del__(self):
         if self.temp_video_file is not None \
@@ -106,29 +382,302 @@ class DashVideoManager:
             os.remove(self.temp_video_file.name)
 
     def generate(self):
-        """Генерирует все компоненты для dash и удалет оригинальное видео"""
-        self._create_temp_video_file()
-        self._generate_dash()
-        self._generate_preview()
-        self._save_generated_files()
+        """Генерирует все компоненты для dash и удалет оригинальное видео
+
+        :raises DashGenerationError: если ffmpeg завершился с ошибкой
+        """
+        DashAsset.begin(self.file_name)
+        try:
+            self._create_temp_video_file()
+            if self.adaptive_ladder:
+                self.complexity = self._measure_complexity()
+            if self.progressive_publish:
+                self._generate_dash_progressively()
+            else:
+                self._generate_dash()
+                self._start_stage('upload')
+                self._save_generated_files()
+            self._remove_checkpoint()
+        finally:
+            self.uploader.close()
+            self._unlock_checkpoint()
+
+    def cancel(self):
+        """прерывает конвертацию из другого потока: запущенные процессы ffmpeg
+        убиваются, новые не запускаются, а generate выбрасывает ProcessCancelled"""
+
+        self.cancelled.set()
+
+    def update_renditions(self):
+        """ Добавляет к уже сконвертированному видео разрешения лестницы DASH_LADDER,
+        которых у него ещё нет, например, после добавления в лестницу 1440p.
+
+        Лестница, с которой видео было сконвертировано, записана в его mpd
+        манифесте: разрешение считается уже закодированным, если в манифесте
+        есть видео поток той же высоты и того же битрейта. Кодируются только
+        недостающие разрешения, файлы уже опубликованных потоков не меняются,
+        а новые потоки получают следующие свободные номера и добавляются
+        в манифест, который сохраняется последним. Потоки, которых больше
+        нет в лестнице, остаются.
+
+        Если лестница видео подбиралась по его сложности (DASH_ADAPTIVE_LADDER),
+        сложность берётся из манифеста, и новые разрешения получают битрейты
+        по той же оценке.
+
+        Если манифеста нет или включён DASH_HLS_PLAYLIST (основной плейлист
+        HLS описывает потоки иначе), видео конвертируется заново целиком.
+
+        На время добавления блокируется контрольная точка видео (DASH_CHECKPOINT_DIR):
+        при постепенной публикации манифест есть уже посреди конвертации,
+        и недостающие разрешения получили бы номера потоков, которые вот-вот запишет она.
+
+        :return: добавленные разрешения
+        :raises DashGenerationError: если ffmpeg завершился с ошибкой
+            или видео конвертирует другой процесс
+        """
+
+        if self.checkpoint_dir:
+            self._lock_conversion()
+        manifest = self._get_manifest()
+        if manifest is None or self.hls_playlist:
+            self.generate()
+            return list(self._get_renditions())
+
+        complexity = manifest.get_property(COMPLEXITY_SCHEME)
+        self.complexity = int(complexity) if complexity else None
+        try:
+            self._create_temp_video_file()
+            renditions = self._get_missing_renditions(manifest)
+            if not renditions:
+                return []
+            # индекс видео, сконвертированного до его появления, неполон и после добавления
+            indexed = DashAsset.begin(self.file_name).state == DashAsset.STATE_PUBLISHED
+
+            self._start_stage('encode')
+            outputs = [(rendition, self._rendition_file_path(index, 0))
+                       for index, rendition in enumerate(renditions)]
+            result = self._run_ffmpeg(self._encode_renditions_command(outputs, self._get_threads_per_job(1)))
+            self._check_results([result], 'Cannot encode renditions for ffmpeg dash')
+
+            self._start_stage('package')
+            inputs = [['-i', output_path] for _, output_path in outputs]
+            result = self._run_ffmpeg(self._package_renditions_command(renditions, inputs, with_audio=False))
+            self._check_results([result], 'Cannot generate ffmpeg dash mpd manifest')
+            self._finish_manifest()
+            self._merge_representations(manifest)
+
+            self._start_stage('upload')
+            if self.single_file:
+                self._save_single_files()
+            else:
+                self._save_init_files()
+                self._save_seg_files()
+            self.uploader.wait()
+            self._publish_manifests(published=indexed)
+        finally:
+            self.uploader.close()
+            self._remove_checkpoint()
+        return renditions
+
+    def _get_missing_renditions(self, manifest: MpdManifest) -> list:
+        """разрешения для этого видео из лестницы DASH_LADDER, которых нет в манифесте"""
+
+        encoded = {(int(representation.get('height', 0)), int(representation.get('bandwidth', 0)))
+                   for _, representation in manifest.video_representations()}
+        return [rendition for rendition in self._get_renditions()
+                if (rendition.height, parse_bitrate(rendition.bitrate)) not in encoded]
+
+    def _merge_representations(self, manifest: MpdManifest):
+        """добавляет потоки из только что созданного mpd во временной директории
+        в опубликованный манифест и записывает результат на место созданного mpd
+
+        ffmpeg нумерует потоки с нуля, поэтому новые потоки и их файлы
+        перенумеровываются начиная со следующего свободного номера."""
+
+        with open(self._mpd_file_path(), "rb") as mpd_file:
+            new_manifest = MpdManifest.from_string(mpd_file.read())
+
+        first_id = manifest.max_representation_id() + 1
+        representations = [(adaptation_set, representation)
+                           for adaptation_set, representation in new_manifest.video_representations()]
+        # с большего номера, чтобы новые названия не совпали с ещё не переименованными файлами
+        for adaptation_set, representation in reversed(representations):
+            stream_id = first_id + int(representation.get('id'))
+            old_names = new_manifest.representation_file_names(adaptation_set, representation)
+            representation.set('id', str(stream_id))
+            base_url = representation.find(MpdManifest._tag('BaseURL'))
+            if base_url is not None:
+                base_url.text = os.path.basename(self._unescape_mask(self._single_file_name_mask())
+                                                 .replace('$RepresentationID$', str(stream_id)))
+            new_names = new_manifest.representation_file_names(adaptation_set, representation)
+            for old_name, new_name in zip(old_names, new_names):
+                os.replace(os.path.join(self.temp_dir.name, old_name),
+                           os.path.join(self.temp_dir.name, new_name))
+
+        for _, representation in representations:
+            manifest.add_video_representation(representation)
+        with open(self._mpd_file_path(), "wb") as mpd_file:
+            mpd_file.write(manifest.to_string())
 
     def destroy(self):
-        """Удаляет все компоненты dash этого видео"""
+        """Удаляет все компоненты dash этого видео
+
+        Если индекс файлов видео (DashAsset) полон, список файлов берётся
+        из него одним запросом, без обращений к storage. Иначе init файлы
+        и сегменты перечисляются по mpd манифесту, а остальные файлы ищутся
+        в storage. Файлы удаляются параллельно. Манифест удаляется последним,
+        а индекс - после него, чтобы прерванное удаление можно было повторить."""
+
+        asset = DashAsset.objects.filter(file_name=self.file_name).first()
+        if asset is not None and asset.state in (DashAsset.STATE_PUBLISHED, DashAsset.STATE_DELETING):
+            asset.set_deleting()
+            manifest_names = {DashFilesNames.mpd_manifest_name(self.file_name),
+                              DashFilesNames.hls_playlist_name(self.file_name)}
+            file_names = [name for name in asset.file_names() if name not in manifest_names]
+        else:
+            file_names = self._find_file_names(self._get_manifest())
+            if asset is not None:
+                file_names = sorted(set(file_names) | set(asset.file_names()))
+        self.remover.delete(file_names)
         self._remove_mpd_manifest()
-        self._remove_preview_image()
-        init_files_count = self._remove_init_files()
-        self._remove_seg_files(init_files_count)
+        self._remove_checkpoint()
+        DashAsset.objects.filter(file_name=self.file_name).delete()
+
+    def index(self) -> bool:
+        """ Записывает в индекс (DashAsset) файлы видео, сконвертированного
+        до появления индекса. Файлы перечисляются так же, как при удалении
+        без индекса, а их размер запрашивается у storage.
+
+        :return: False, если у видео нет mpd манифеста
+        """
+
+        manifest = self._get_manifest()
+        if manifest is None:
+            return False
+
+        file_names = self._find_file_names(manifest)
+        file_names += [DashFilesNames.mpd_manifest_name(self.file_name),
+                       DashFilesNames.hls_playlist_name(self.file_name)]
+        files = {name: self.storage.size(name) for name in file_names if self.storage.exists(name)}
+        DashAsset.add_files(self.file_name, files, format_ladder(manifest_ladder(manifest)), published=True)
+        return True
+
+    def _find_file_names(self, manifest: MpdManifest = None) -> list:
+        """названия файлов видео, кроме манифестов, по mpd манифесту и поиском в storage.
+        Если манифеста нет, init файлы и сегменты удаляются сразу при поиске"""
+
+        if manifest is None:
+            init_files_count = self._remove_init_files()
+            self._remove_seg_files(init_files_count)
+            file_names = self._get_single_file_names(0)
+        else:
+            mpd_manifest_name = DashFilesNames.mpd_manifest_name(self.file_name)
+            file_names = manifest.file_names(posixpath.dirname(mpd_manifest_name))
+            file_names += self._get_unlisted_streams_file_names(
+                len(list(manifest.representations())))
+
+        file_names.append(DashFilesNames.preview_image_name(self.file_name))
+        file_names += self._get_poster_candidate_names()
+        file_names += self._get_thumbnails_file_names()
+        file_names += self._get_hls_media_playlist_names()
+        return file_names
+
+    def _get_manifest(self):
+        """возвращает mpd манифест из storage или None,
+        если манифеста нет или его не удалось разобрать"""
+
+        mpd_manifest_name = DashFilesNames.mpd_manifest_name(self.file_name)
+        if not self.storage.exists(mpd_manifest_name):
+            return None
+
+        with self.storage.open(mpd_manifest_name, "rb") as mpd_file:
+            content = mpd_file.read()
+
+        try:
+            return MpdManifest.from_string(content)
+        except ValueError:
+            return None
+
+    def _get_unlisted_streams_file_names(self, first_stream_id: int) -> list:
+        """названия init файлов и сегментов потоков с номерами от first_stream_id,
+        которых ещё нет в mpd манифесте.
+
+        Такие файлы остаются, если при постепенной публикации
+        (DASH_PROGRESSIVE_PUBLISH) файлы следующего разрешения уже сохранены,
+        а манифест с ним ещё нет."""
+
+        init_name_mask = DashFilesNames.dash_init_files_mask(self.file_name). \
+            replace(r"\$RepresentationID\$", "{0}")
+        seg_name_mask = DashFilesNames.dash_segments_mask(self.file_name). \
+            replace(r"\$RepresentationID\$", "{0}"). \
+            replace(r"\$Number%05d\$", "{1}")
+
+        names = []
+        stream_id = first_stream_id
+        while self.storage.exists(init_name_mask.format(stream_id)):
+            names.append(init_name_mask.format(stream_id))
+            chunk_id = 1
+            while self.storage.exists(seg_name_mask.format(stream_id, str(chunk_id).zfill(5))):
+                names.append(seg_name_mask.format(stream_id, str(chunk_id).zfill(5)))
+                chunk_id += 1
+            stream_id += 1
+        return names + self._get_single_file_names(first_stream_id)
+
+    def _get_single_file_names(self, first_stream_id: int) -> list:
+        """названия файлов потоков с номерами от first_stream_id
+        в раскладке одним файлом на поток (DASH_SINGLE_FILE), которые есть в storage"""
+
+        name_mask = DashFilesNames.dash_single_file_mask(self.file_name). \
+            replace(r"\$RepresentationID\$", "{0}")
+
+        names = []
+        while self.storage.exists(name_mask.format(first_stream_id + len(names))):
+            names.append(name_mask.format(first_stream_id + len(names)))
+        return names
+
+    def _get_hls_media_playlist_names(self) -> list:
+        """названия плейлистов HLS потоков, которые есть в storage"""
+
+        names = []
+        while self.storage.exists(DashFilesNames.hls_media_playlist_name(self.file_name, len(names))):
+            names.append(DashFilesNames.hls_media_playlist_name(self.file_name, len(names)))
+        return names
+
+    def _get_poster_candidate_names(self) -> list:
+        """названия вариантов превью, которые есть в storage"""
+        return self._get_numbered_file_names(DashFilesNames.poster_candidate_name)
+
+    def _get_thumbnails_file_names(self) -> list:
+        """названия дорожки миниатюр и спрайтов, которые есть в storage"""
+
+        names = self._get_numbered_file_names(DashFilesNames.thumbnails_sprite_name)
+        track_name = DashFilesNames.thumbnails_track_name(self.file_name)
+        if self.storage.exists(track_name):
+            names.append(track_name)
+        return names
+
+    def _get_numbered_file_names(self, get_name) -> list:
+        """названия файлов с номерами от 1, которые есть в storage, до первого пропущенного номера
+
+        :param get_name: метод DashFilesNames, возвращающий название файла по номеру
+        """
+
+        names = []
+        while True:
+            name = get_name(self.file_name, len(names) + 1)
+            if not self.storage.exists(name):
+                return names
+            names.append(name)
 
     def _remove_mpd_manifest(self):
+        """удаляет mpd манифест и основной плейлист HLS"""
         mpd_file_name = DashFilesNames.mpd_manifest_name(self.file_name)
         self.storage.delete(mpd_file_name)
-
-    def _remove_preview_image(self):
-        preview_image = DashFilesNames.preview_image_name(self.file_name)
-        self.storage.delete(preview_image)
+        self.storage.delete(DashFilesNames.hls_playlist_name(self.file_name))
 
     def _remove_init_files(self):
-        """удаляет все файлы описания потоков"""
+        """удаляет все файлы описания потоков, перебирая номера потоков.
+        Используется, только если нет mpd манифеста"""
         stream_init_name = DashFilesNames.dash_init_files_mask(self.file_name)
         stream_init_name_mask = stream_init_name.replace(r"\$RepresentationID\$", "{0}")
 
@@ -143,14 +692,14 @@ class DashVideoManager:
         return stream_id
 
     def _remove_seg_files(self, init_files_count):
-        """удаляет все чанки для потоков с номерами от 0 до init_files_count"""
+        """удаляет все чанки для потоков с номерами от 0 до init_files_count,
+        перебирая номера чанков. Используется, только если нет mpd манифеста"""
 
         dash_seg_name = DashFilesNames.dash_segments_mask(self.file_name)
         dash_seg_name_mask = dash_seg_name. \
             replace(r"\$RepresentationID\$", "{0}"). \
             replace(r"\$Number%05d\$", "{1}")
 
-        # TODO: сделать на threads
         for stream_id in range(init_files_count):
             chunk_id = 1
             while True:
@@ -164,250 +713,1153 @@ class DashVideoManager:
 
     def _create_temp_video_file(self):
         """создаёт временную директорию и переносит туда оригинал видео из storage,
-        т.к. storage может хранить файлы не в файловой системе текущего хоста"""
+        т.к. storage может хранить файлы не в файловой системе текущего хоста
+
+        Если storage хранит файлы локально (FileSystemStorage), оригинал
+        не копируется: ffmpeg читает его напрямую, а временная директория
+        создаётся рядом с видео, чтобы готовые файлы можно было
+        опубликовать переименованием, а не копированием."""
+
+        local_path = self._get_local_path(self.file_name)
+        if local_path is not None:
+            self.temp_dir = tempfile.TemporaryDirectory(
+                prefix=self.TEMP_DIR_PREFIX,
+                dir=os.path.dirname(local_path))
+            self.source_path = local_path
+            self.publish_by_rename = True
+            return
 
         self.temp_dir = tempfile.TemporaryDirectory(
             prefix=self.TEMP_DIR_PREFIX)
+        if self._can_pipe_source():
+            self.source_path = PIPE_SOURCE
+            return
+
         self.temp_video_file = tempfile.NamedTemporaryFile(
             dir=self.temp_dir.name,
             delete=False)
         video_file = self.storage.open(self.file_name, "rb")
         shutil.copyfileobj(video_file, self.temp_video_file.file)
         self.temp_video_file.file.close()
+        self.source_path = self.temp_video_file.name
+
+    def _can_pipe_source(self) -> bool:
+        """можно ли не копировать оригинал во временный файл, а передавать
+        его в ffmpeg через stdin прямо из storage (DASH_PIPE_SOURCE)
+
+        Так скачивание и кодирование идут одновременно, а на диске не нужно
+        место под оригинал. Это возможно только при кодировании одним
+        процессом ffmpeg и только для видео, которое читается без перемотки."""
+
+        if not self.pipe_source or self.parallel_renditions or self.time_slices > 1 \
+                or self.progressive_publish:
+            return False
+
+        with self.storage.open(self.file_name, "rb") as video_file:
+            return not needs_seeking(video_file)
+
+    def _get_local_path(self, name: str):
+        """путь к файлу storage в локальной файловой системе или None,
+        если storage хранит файлы не в ней"""
+
+        try:
+            return self.storage.path(name)
+        except NotImplementedError:
+            return None
 
     def _generate_dash(self):
         """запускает генерацию всех компонентов dash формата и
         сохраняет все файлы во временную директорию"""
 
-        result = subprocess.run(self._get_command_for_generate_dash(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                universal_newlines=True,
-                                shell=True)
-
-        if not result.returncode == 0:
-            return [checks.Error('Cannot generate ffmpeg dash mpd manifest')]
-
-    def _generate_preview(self):
-        """генерирует preview изображение из видео
-        на момент написания комментарии, берётся кадр из 1 секнуды видео"""
-
-        video_file_name = self.temp_video_file.name
-        preview = self._preview_file_path()
-        result = subprocess.run(f"ffmpeg -i '{video_file_name}' -ss 00:00:01.000 -vframes 1 '{preview}'",
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                universal_newlines=True,
-                                shell=True)
-        if not result.returncode == 0:
-            return [checks.Error('Cannot generate ffmpeg preview for video')]
+        if self.parallel_renditions or self.time_slices > 1:
+            return self._generate_dash_by_jobs()
 
-    def _save_generated_files(self):
-        """сохраняет mpd манифест, изображение-превью,
-        а так же файлы инициализации потоков и сегменты потоков
-        из временной директории в storage"""
+        self._start_stage('encode')
+        result = self._run_dash_ffmpeg(self._get_command_for_generate_dash())
+        self._check_results([result], 'Cannot generate ffmpeg dash mpd manifest')
+        self._finish_manifest()
 
-        with open(self._mpd_file_path(), "rb") as mpd_tmp_file:
-            mpd_manifest_name = DashFilesNames.mpd_manifest_name(self.file_name)
-            mpd_storage_file = self.storage.open(
-                mpd_manifest_name,
-                "wb+")
-            shutil.copyfileobj(mpd_tmp_file, mpd_storage_file)
-            mpd_storage_file.close()
+    def _generate_dash_by_jobs(self):
+        """генерирует dash, кодируя видео несколькими процессами ffmpeg параллельно
 
-        with open(self._preview_file_path(), "rb") as preview_tmp_file:
-            preview_image_name = DashFilesNames.preview_image_name(self.file_name)
-            preview_storage_file = self.storage.open(
-                preview_image_name,
-                "wb+")
-            shutil.copyfileobj(preview_tmp_file, preview_storage_file)
-            preview_storage_file.close()
+        Видео делится на задания по разрешениям (DASH_PARALLEL_RENDITIONS)
+        и/или по отрезкам времени (DASH_TIME_SLICES). Каждое задание кодирует
+        промежуточные mp4 файлы, после чего отрезки одного разрешения склеиваются
+        и без перекодирования упаковываются в dash вместе с аудио
+        с теми же названиями файлов и тем же mpd, что и при кодировании одним процессом.
 
-        self._save_init_files()
+        Процессы ffmpeg запускаются из пула потоков, а не через multiprocessing:
+        celery воркеры являются демонами и не могут создавать
+        дочерние процессы через multiprocessing.
+        """
 
-        self._save_seg_files()
+        renditions = self._get_renditions()
+        time_slices = self._get_time_slices()
+        self._open_checkpoint()
+
+        jobs = []
+        for slice_index, time_slice in enumerate(time_slices):
+            outputs = [(rendition, self._rendition_file_path(index, slice_index))
+                       for index, rendition in enumerate(renditions)]
+            if self.parallel_renditions:
+                slice_jobs = [[output] for output in outputs]
+            else:
+                slice_jobs = [outputs]
+            # превью создаются первым заданием отрезка из уже декодированных кадров
+            jobs += [(time_slice, job_outputs, job_index == 0)
+                     for job_index, job_outputs in enumerate(slice_jobs)]
+
+        threads = self._get_threads_per_job(len(jobs))
+        commands = []
+        for time_slice, outputs, with_posters in jobs:
+            output_paths = [output_path for _, output_path in outputs]
+            if self._is_checkpointed(output_paths):
+                # отрезок уже закодирован до прерывания конвертации, нужны только превью
+                command = self._previews_command(time_slice) if with_posters else None
+                output_paths = []
+            else:
+                command = self._encode_renditions_command(outputs, threads, time_slice, with_posters)
+            if command is not None:
+                commands.append((command, output_paths, self._get_slice_duration(time_slice)))
+
+        self._start_stage('encode')
+        workers = max(1, min(len(commands), self.cpu_budget // threads))
+        results = self._run_jobs(commands, workers)
+        self._check_results(results, 'Cannot encode renditions for ffmpeg dash')
+
+        inputs = [self._rendition_input_args(index, len(time_slices))
+                  for index, _ in enumerate(renditions)]
+        self._start_stage('package')
+        result = self._run_dash_ffmpeg(self._package_renditions_command(renditions, inputs))
+        self._check_results([result], 'Cannot generate ffmpeg dash mpd manifest')
+        self._finish_manifest()
+
+    def _generate_dash_progressively(self):
+        """генерирует и публикует dash по одному разрешению, начиная с меньшего
+        (DASH_PROGRESSIVE_PUBLISH)
+
+        Сначала кодируются и публикуются самое маленькое разрешение, аудио,
+        превью и миниатюры с готовым mpd манифестом, т.е. видео можно смотреть
+        сразу после этого. Затем каждое следующее разрешение кодируется
+        отдельно и публикуется вместе с перезаписанным манифестом. Файлы
+        в storage сохраняются раньше манифеста, который на них ссылается,
+        а сохранение манифеста атомарно, поэтому плеер всегда видит целый манифест.
+
+        Если оригинал видео удалили во время конвертации, уже опубликованные
+        файлы удаляются, а конвертация прекращается.
+        """
 
-    def _get_command_for_generate_dash(self):
-        video_height = self._get_height_of_video()
+        renditions = self._get_renditions()
+        threads = self._get_threads_per_job(1)
+        self._open_checkpoint()
+        audio_path = self._audio_file_path() if self._get_probe().has_audio else None
+
+        for index, rendition in enumerate(renditions):
+            first_stage = index == 0
+            self._start_stage(f'{rendition.height}p')
+            output_paths = [self._rendition_file_path(index, 0)]
+            if first_stage and audio_path is not None:
+                output_paths.append(audio_path)
+
+            results = []
+            if not self._is_checkpointed(output_paths):
+                results.append(self._run_encode_job(self._encode_renditions_command(
+                    [(rendition, output_paths[0])],
+                    threads,
+                    with_posters=first_stage,
+                    audio_path=audio_path if first_stage else None), output_paths))
+            elif first_stage and self._previews_command() is not None:
+                results.append(self._run_ffmpeg(self._previews_command()))
+            results.append(self._run_ffmpeg(self._package_progressive_command(renditions[:index + 1])))
+
+            if not self.storage.exists(self.file_name):
+                self.destroy()
+                return
+            self._check_results(results, f'Cannot generate ffmpeg dash for {rendition.height}p')
+
+            self._finish_manifest()
+            self._publish_progressive_stage(first_stage)
+
+        DashAsset.set_published(self.file_name)
+
+    def _publish_progressive_stage(self, first_stage: bool):
+        """сохраняет в storage новые файлы очередной ступени постепенной публикации
+        и затем перезаписывает mpd манифест
+
+        Упаковка без перекодирования повторяет файлы уже опубликованных потоков
+        байт в байт, поэтому сохраняются только файлы, которых ещё нет в storage.
+        Индекс файлов видео полон только после последней ступени."""
+
+        if first_stage:
+            for _, temp_path, storage_name in self._get_posters():
+                self._save_temp_file(temp_path, storage_name)
+            for temp_path, storage_name in self._write_thumbnails_track():
+                self._save_temp_file(temp_path, storage_name)
+
+        dash_file_paths = []
+        for files_glob in self._dash_files_globs():
+            dash_file_paths += glob.glob(os.path.join(self.temp_dir.name, files_glob))
+        for dash_file_path in sorted(dash_file_paths):
+            storage_name = os.path.join(
+                os.path.dirname(self.file_name),
+                os.path.basename(dash_file_path))
+            if storage_name not in self.published_names:
+                self.published_names.add(storage_name)
+                self._save_temp_file(dash_file_path, storage_name)
+
+        self.uploader.wait()
+
+        self._publish_manifests(published=False)
+
+    def _get_time_slices(self) -> list:
+        """делит видео на DASH_TIME_SLICES отрезков вида (начало, длительность) в секундах
+
+        Границы отрезков кратны длине сегмента SEGMENT_DURATION, а она кратна
+        интервалу ключевых кадров. Поэтому каждый отрезок начинается с ключевого
+        кадра там же, где он был бы при кодировании целиком, а сегменты
+        и их нумерация после склейки не отличаются от кодирования одним процессом.
+        Если деление не нужно, возвращается один отрезок None - всё видео.
+        """
+
+        if self.time_slices <= 1:
+            return [None]
+
+        duration = self._get_probe().duration
+        segments_count = math.ceil(duration / self.SEGMENT_DURATION)
+        segments_per_slice = max(1, math.ceil(segments_count / self.time_slices))
+        slice_duration = segments_per_slice * self.SEGMENT_DURATION
+
+        return [(start, slice_duration)
+                for start in range(0, segments_count * self.SEGMENT_DURATION, slice_duration)]
+
+    def _rendition_input_args(self, index: int, slices_count: int) -> list:
+        """аргументы ffmpeg для чтения закодированного разрешения целиком.
+        Отрезки склеиваются concat демуксером без перекодирования"""
+
+        if slices_count == 1:
+            return ['-i', self._rendition_file_path(index, 0)]
+
+        concat_list_path = os.path.join(self.temp_dir.name, f"rendition-{index}.txt")
+        with open(concat_list_path, "w") as concat_list:
+            for slice_index in range(slices_count):
+                concat_list.write(f"file '{self._rendition_file_path(index, slice_index)}'\n")
+        return ['-f', 'concat', '-safe', '0', '-i', concat_list_path]
+
+    def _open_checkpoint(self):
+        """ Открывает контрольную точку конвертации в DASH_CHECKPOINT_DIR.
+
+        Промежуточные файлы (закодированные отрезки разрешений и аудио)
+        пишутся не во временную директорию, а в постоянную директорию
+        контрольной точки, и каждый файл появляется в ней только целиком
+        (см. _run_encode_job). Если воркер убили посреди конвертации, повторная
+        задача кодирует только недостающие файлы, а упаковка из тех же файлов
+        даёт тот же mpd манифест. Если оригинал или параметры кодирования
+        изменились, контрольная точка начинается заново.
+
+        Контрольная точка блокируется до конца конвертации, поэтому вторая задача
+        с тем же видео (повторная конвертация, задача, которую брокер отдал
+        повторно) не удалит промежуточные файлы из-под идущего кодирования.
+
+        :raises DashGenerationError: если видео уже конвертирует другой процесс
+        """
+
+        if not self.checkpoint_dir:
+            return
+
+        path = self._lock_conversion()
+        params_path = os.path.join(path, self.CHECKPOINT_PARAMS_NAME)
+        params = json.loads(json.dumps(self._get_checkpoint_params()))
+        try:
+            with open(params_path) as params_file:
+                saved_params = json.load(params_file)
+        except (OSError, ValueError):
+            saved_params = None
+
+        if saved_params != params:
+            # файл блокировки остаётся, иначе другой процесс заблокировал бы новый файл
+            for name in os.listdir(path):
+                if name == self.CHECKPOINT_LOCK_NAME:
+                    continue
+                entry_path = os.path.join(path, name)
+                if os.path.isdir(entry_path):
+                    shutil.rmtree(entry_path, ignore_errors=True)
+                else:
+                    os.remove(entry_path)
+            with open(params_path + '.tmp', 'w') as params_file:
+                json.dump(params, params_file)
+            os.replace(params_path + '.tmp', params_path)
+        self.checkpoint_path = path
+
+    def _lock_conversion(self) -> str:
+        """ Блокирует контрольную точку видео до конца конвертации (см. _lock_checkpoint).
+
+        :return: директория контрольной точки
+        :raises DashGenerationError: если видео уже конвертирует другой процесс
+        """
 
-        if video_height > 1070:
-            return self._dash_command_gen_1080_and_less()
-        elif video_height > 710:
-            return self._dash_command_gen_720_and_less()
+        path = self._get_checkpoint_path()
+        if not self._lock_checkpoint(path):
+            raise DashGenerationError(f'Video {self.file_name} is already being converted by another process')
+        return path
+
+    def _get_checkpoint_path(self) -> str:
+        """директория контрольной точки этого видео"""
+
+        digest = hashlib.sha1(self.file_name.encode()).hexdigest()
+        return os.path.join(self.checkpoint_dir, digest)
+
+    def _get_checkpoint_params(self) -> dict:
+        """параметры, от которых зависят промежуточные файлы"""
+
+        return {
+            'file_name': self.file_name,
+            'size': self.storage.size(self.file_name),
+            'renditions': self._get_renditions(),
+            'time_slices': self._get_time_slices(),
+            'parallel_renditions': bool(self.parallel_renditions),
+            'progressive_publish': bool(self.progressive_publish),
+            'video_codec': self.VIDEO_CODEC_ARGS,
+            'audio_codec': self.AUDIO_CODEC_ARGS,
+        }
+
+    def _is_checkpointed(self, paths: list) -> bool:
+        """все ли промежуточные файлы уже есть в контрольной точке"""
+
+        return self.checkpoint_path is not None and all(os.path.exists(path) for path in paths)
+
+    def _remove_checkpoint(self):
+        """удаляет контрольную точку, если её не держит конвертация в другом процессе.
+        Та конвертация удалит контрольную точку сама, когда закончится"""
+
+        if not self.checkpoint_dir:
+            return
+        path = self._get_checkpoint_path()
+        if not self._lock_checkpoint(path):
+            return
+        shutil.rmtree(path, ignore_errors=True)
+        self._unlock_checkpoint()
+
+    def _lock_checkpoint(self, path: str) -> bool:
+        """ Блокирует контрольную точку path для этой конвертации (flock без ожидания).
+        Блокировка снимается в _unlock_checkpoint или сама, если процесс завершился.
+
+        :return: False, если контрольную точку держит другой процесс
+        """
+
+        if self.checkpoint_lock is not None:
+            return True
+
+        lock_path = os.path.join(path, self.CHECKPOINT_LOCK_NAME)
+        while True:
+            os.makedirs(path, exist_ok=True)
+            lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            # держатель блокировки мог удалить контрольную точку, пока файл открывался
+            try:
+                locked = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path))
+            except FileNotFoundError:
+                locked = False
+            if locked:
+                self.checkpoint_lock = lock_file
+                return True
+            lock_file.close()
+
+    def _unlock_checkpoint(self):
+        if self.checkpoint_lock is not None:
+            self.checkpoint_lock.close()
+            self.checkpoint_lock = None
+
+    def _run_encode_job(self, command: list, output_paths: list,
+                        duration: float = None) -> subprocess.CompletedProcess:
+        """запускает ffmpeg, кодирующий промежуточные файлы output_paths
+
+        С контрольной точкой ffmpeg пишет в файлы *.partial.*, которые
+        переименовываются после его успешного завершения, поэтому
+        прерванное кодирование не оставляет недописанных файлов."""
+
+        if self.checkpoint_path is None:
+            return self._run_ffmpeg(command, duration)
+
+        partial_paths = {}
+        for path in output_paths:
+            root, extension = os.path.splitext(path)
+            partial_paths[path] = f'{root}.partial{extension}'
+        result = self._run_ffmpeg([partial_paths.get(arg, arg) for arg in command], duration)
+        if result.returncode == 0:
+            for path, partial_path in partial_paths.items():
+                os.replace(partial_path, path)
+        return result
+
+    def _run_jobs(self, jobs: list, workers: int) -> list:
+        """ Выполняет задания кодирования (команда, выходные файлы, длительность)
+        в workers потоках.
+
+        Если ffmpeg одного из заданий завершился с ошибкой или не уложился
+        во время, остальные процессы прерываются, а ещё не начатые задания
+        не запускаются: конвертация всё равно не удастся. Так же прерываются
+        все процессы, если ожидание заданий прервано исключением (например,
+        мягким ограничением времени задачи celery).
+
+        :return: результаты выполненных заданий, прерванные задания пропускаются
+        """
+
+        def run(command, output_paths, duration):
+            if self.cancelled.is_set():
+                return None
+            try:
+                result = self._run_encode_job(command, output_paths, duration)
+            except ProcessCancelled:
+                return None
+            except DashGenerationError:
+                self.cancel()
+                raise
+            if result.returncode != 0:
+                self.cancel()
+            return result
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, command, output_paths, duration)
+                       for command, output_paths, duration in jobs]
+            try:
+                self._wait_jobs(futures)
+            except BaseException:
+                self.cancel()
+                raise
+            results = [future.result() for future in futures]
+        return [result for result in results if result is not None]
+
+    def _previews_command(self, time_slice=None):
+        """команда, которая создаёт только превью и миниатюры отрезка, если
+        сам отрезок взят из контрольной точки, или None, если они не нужны"""
+
+        output_args = self._poster_output_args(time_slice) + self._thumbnails_output_args(time_slice)
+        if not output_args:
+            return None
+
+        command = ['ffmpeg']
+        if time_slice is not None:
+            start, duration = time_slice
+            command += ['-ss', str(start), '-t', str(duration)]
+        return command + ['-i', self.source_path] + output_args
+
+    def _measure_complexity(self) -> int:
+        """ Быстро оценивает сложность видео, чтобы подобрать лестницу этого видео
+        (DASH_ADAPTIVE_LADDER) до основного кодирования.
+
+        DASH_ADAPTIVE_SAMPLES отрезков по COMPLEXITY_SAMPLE_DURATION секунд,
+        равномерно взятых из видео, кодируются в COMPLEXITY_HEIGHT с постоянным
+        качеством DASH_ADAPTIVE_CRF. Битрейт результата и есть сложность:
+        у лекции со слайдами он в разы ниже, чем у демонстрации с движением.
+
+        :return: битрейт пробного кодирования в битах в секунду
+        :raises DashGenerationError: если ffmpeg завершился с ошибкой
+        """
+
+        self._start_stage('analyze')
+        output_path = os.path.join(self.temp_dir.name, 'complexity.mp4')
+        command, duration = self._complexity_command(output_path)
+        try:
+            result = self._run_ffmpeg(command, duration)
+            self._check_results([result], 'Cannot analyze video complexity')
+            return int(os.path.getsize(output_path) * 8 / duration)
+        finally:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+    def _complexity_command(self, output_path: str) -> tuple:
+        """команда пробного кодирования для _measure_complexity и сколько секунд видео она кодирует
+
+        Отрезки читаются с перемоткой, поэтому декодируются только они. Оригинал,
+        который передаётся через stdin (DASH_PIPE_SOURCE), перематывать нельзя,
+        и отрезки выбираются фильтром select при чтении видео целиком."""
+
+        duration = self._get_probe().duration
+        sample_duration = self.COMPLEXITY_SAMPLE_DURATION
+        samples = max(1, self.adaptive_samples)
+        scale = f'scale=-2:{COMPLEXITY_HEIGHT}'
+
+        command = ['ffmpeg']
+        if samples * sample_duration >= duration:
+            command += ['-i', self.source_path, '-map', '0:v:0', '-filter:v', scale]
+            sampled_duration = duration
+        elif self.source_path == PIPE_SOURCE:
+            period = duration / samples
+            command += ['-i', self.source_path, '-map', '0:v:0', '-filter:v',
+                        f"select='lt(mod(t,{period:.3f}),{sample_duration})',setpts=N/FRAME_RATE/TB,{scale}"]
+            sampled_duration = samples * sample_duration
+        else:
+            period = duration / samples
+            filters = ''
+            for index in range(samples):
+                start = period * index + (period - sample_duration) / 2
+                command += ['-ss', f'{start:.3f}', '-t', str(sample_duration), '-i', self.source_path]
+                filters += f'[{index}:v:0]{scale}[s{index}];'
+            filters += ''.join(f'[s{index}]' for index in range(samples))
+            command += ['-filter_complex', f'{filters}concat=n={samples}:v=1:a=0[v]', '-map', '[v]']
+            sampled_duration = samples * sample_duration
+
+        command += ['-an'] + self.VIDEO_CODEC_ARGS
+        command += ['-preset', 'veryfast', '-crf', str(self.adaptive_crf)]
+        command += ['-threads', str(self._get_threads_per_job(1)), '-y', output_path]
+        return command, sampled_duration
+
+    def _run_ffmpeg(self, command: list, duration: float = None) -> subprocess.CompletedProcess:
+        """запускает ffmpeg с пониженным приоритетом (DASH_NICENESS).
+        Если нужен ход конвертации, ffmpeg пишет его в stdout
+
+        :param duration: сколько секунд видео обрабатывает команда, по умолчанию всё видео
+        :raises DashGenerationError: если ffmpeg не уложился во время (см. _get_ffmpeg_timeout)
+        :raises ProcessCancelled: если конвертацию прервали (см. cancel)
+        """
+
+        if not duration and (self.progress is not None or self.ffmpeg_timeout):
+            duration = self._get_probe().duration
+        if self.progress is not None:
+            command = command[:1] + ['-progress', 'pipe:1', '-nostats'] + command[1:]
+            read_output = functools.partial(self.progress.read, duration=duration)
         else:
-            return self._dash_command_gen_480_and_less()
-
-    def _get_height_of_video(self):
-        video_file_name = self.temp_video_file.name
-        cmd_video_height = 'ffmpeg -i ' + video_file_name + \
-                           r' 2>&1 | grep Video: | grep -Po "\d{3,5}x\d{3,5}" | cut -d"x" -f1'
-              
-        height = subprocess.check_output([cmd_video_height], shell=True)
-        height_str = height.decode("utf-8", "strict")
-
-        if len(height_str) == 0:
-            raise ValueError("Value of the height video is empty")
+            read_output = None
+        if self.niceness:
+            command = ['nice', '-n', str(self.niceness)] + command
+
+        timeout = self._get_ffmpeg_timeout(duration)
         try:
-            return int(height_str)
-        except ValueError:
-            raise ValueError(f"Unexpected type of video height value. Expected digits, got {height_str}")
+            if self.source_path == PIPE_SOURCE:
+                with self.storage.open(self.file_name, "rb") as video_file:
+                    return run_with_source(command, video_file, read_output, timeout, self.cancelled)
+            return run_with_source(command, None, read_output, timeout, self.cancelled)
+        except subprocess.TimeoutExpired as error:
+            stderr_tail = '\n'.join(error.stderr.splitlines()[-self.STDERR_TAIL_LINES:])
+            raise DashGenerationError(f'ffmpeg timed out after {round(timeout)} seconds', stderr_tail)
+
+    def _get_ffmpeg_timeout(self, duration: float):
+        """сколько секунд может работать ffmpeg, обрабатывающий duration секунд видео:
+        в DASH_FFMPEG_TIMEOUT раз больше длительности видео плюс FFMPEG_TIMEOUT_MARGIN.
+        Зависший на испорченном видео ffmpeg иначе занимал бы воркер бесконечно"""
+
+        if not self.ffmpeg_timeout:
+            return None
+        return self.FFMPEG_TIMEOUT_MARGIN + duration * self.ffmpeg_timeout
+
+    def _run_dash_ffmpeg(self, command: list) -> subprocess.CompletedProcess:
+        """запускает ffmpeg, создающий dash файлы. Если включен DASH_STREAM_UPLOAD,
+        готовые сегменты сохраняются в storage, не дожидаясь завершения ffmpeg"""
+
+        if not self.stream_upload:
+            return self._run_ffmpeg(command)
+
+        watcher = SegmentWatcher(
+            self.temp_dir.name,
+            self._seg_files_glob(),
+            lambda seg_path: self._save_seg_file(seg_path, remove=True))
+        watcher.start()
+        try:
+            return self._run_ffmpeg(command)
+        finally:
+            watcher.stop()
+            self.uploader.wait()
+
+    def _start_stage(self, stage: str):
+        if self.progress is not None:
+            self.progress.start_stage(stage)
+
+    def _wait_jobs(self, futures: list):
+        """дожидается параллельных процессов ffmpeg, сообщая о ходе конвертации
+        из текущего потока (см. FfmpegProgress)"""
+
+        if self.progress is None:
+            wait(futures)
+            return
+        while wait(futures, timeout=self.PROGRESS_POLL_INTERVAL).not_done:
+            self.progress.report_if_due()
+        self.progress.report_if_due(force=True)
+
+    def _check_results(self, results: list, message: str):
+        """:raises DashGenerationError: с концом stderr первого процесса, завершившегося с ошибкой"""
+
+        for result in results:
+            if result.returncode != 0:
+                stderr_tail = '\n'.join(result.stderr.splitlines()[-self.STDERR_TAIL_LINES:])
+                raise DashGenerationError(message, stderr_tail)
+
+    def _get_slice_duration(self, time_slice) -> float:
+        """сколько секунд видео в отрезке, None - всё видео"""
+
+        duration = self._get_probe().duration
+        if time_slice is None:
+            return duration
+        start, slice_duration = time_slice
+        return max(0.0, min(slice_duration, duration - start))
+
+    def _get_threads_per_job(self, jobs_count: int) -> int:
+        """количество потоков ffmpeg для одного процесса кодирования
+
+        Если DASH_THREADS_PER_JOB не задан, бюджет процессора
+        делится поровну между всеми процессами."""
+
+        if self.threads_per_job:
+            return self.threads_per_job
+        return max(1, self.cpu_budget // jobs_count)
+
+    def _get_posters(self) -> list:
+        """превью и варианты превью в виде (момент видео в секундах, путь временного файла,
+        название в storage)
+
+        Превью берётся из кадра на DASH_PREVIEW_TIME секунде, а для более коротких видео -
+        из его середины. DASH_POSTER_CANDIDATES вариантов превью берутся
+        через равные промежутки видео."""
+
+        duration = self._get_probe().duration
+        names = [(min(self.preview_time, duration / 2),
+                  DashFilesNames.preview_image_name(self.file_name))]
+        for index in range(1, self.poster_candidates + 1):
+            names.append((duration * index / (self.poster_candidates + 1),
+                          DashFilesNames.poster_candidate_name(self.file_name, index)))
+
+        return [(time, os.path.join(self.temp_dir.name, os.path.basename(name)), name)
+                for time, name in names]
+
+    def _poster_output_args(self, time_slice=None) -> list:
+        """выходные файлы превью для команды ffmpeg, кодирующей видео или его отрезок.
+
+        Кадр для превью выбирается фильтром select из тех же декодированных
+        кадров, что кодируются в dash, поэтому оригинал не открывается
+        и не декодируется для превью ещё раз.
+
+        :param time_slice: (начало, длительность) кодируемого отрезка или None для всего видео,
+            в команду попадают только превью из этого отрезка
+        """
 
-    def _dash_command_gen_1080_and_less(self):
-        """Создаёт команду для генерации dash контента на основе оригинального видео.
-        Данная функция создаёт потоки в 1080, 720, 480, 360px.
+        start, duration = time_slice or (0, None)
+        args = []
+        for time, temp_path, _ in self._get_posters():
+            if time < start or (duration is not None and time >= start + duration):
+                continue
+            args += [
+                '-map', '0:v:0',
+                '-filter:v', f'select=gte(t\\,{time - start})',
+                '-frames:v', '1',
+                '-y', temp_path,
+            ]
+        return args
+
+    def _get_thumbnail_slices(self) -> list:
+        """миниатюры для перемотки по отрезкам кодирования в виде
+        (отрезок, номер первого спрайта отрезка, моменты миниатюр в секундах)
+
+        Миниатюры берутся каждые DASH_THUMBNAILS_INTERVAL секунд от начала отрезка.
+        Каждый отрезок кодируется своим процессом ffmpeg, поэтому
+        его миниатюры начинаются с нового спрайта."""
+
+        if not self.thumbnails_interval:
+            return []
+
+        duration = self._get_probe().duration
+        columns, rows = self.THUMBNAILS_TILE
+        number = 1
+        thumbnail_slices = []
+        for time_slice in self._get_time_slices():
+            start, slice_duration = time_slice or (0, duration)
+            end = min(start + slice_duration, duration)
+            times = [start + index * self.thumbnails_interval
+                     for index in range(math.ceil((end - start) / self.thumbnails_interval))]
+            thumbnail_slices.append((time_slice, number, times))
+            number += math.ceil(len(times) / (columns * rows))
+        return thumbnail_slices
+
+    def _get_thumbnail_size(self) -> tuple:
+        """ширина и высота одной миниатюры с сохранением пропорций видео"""
+
+        probe = self._get_probe()
+        height = round(self.thumbnails_width * probe.height / probe.width / 2) * 2
+        return self.thumbnails_width, max(2, height)
+
+    def _thumbnails_output_args(self, time_slice=None) -> list:
+        """выходные файлы спрайтов с миниатюрами для перемотки.
+
+        Как и превью, миниатюры выбираются из тех же декодированных кадров,
+        что кодируются в dash. Фильтр tile собирает их в спрайты,
+        а setpts нумерует спрайты подряд, чтобы ffmpeg не дублировал их
+        для постоянной частоты кадров.
+
+        :param time_slice: (начало, длительность) кодируемого отрезка или None для всего видео
+        """
 
-        Описание генерируемой команды:
-        -i {адрес входного файла}
+        for thumbnail_slice, number, times in self._get_thumbnail_slices():
+            if thumbnail_slice != time_slice or not times:
+                continue
+
+            width, height = self._get_thumbnail_size()
+            columns, rows = self.THUMBNAILS_TILE
+            sprite_mask = os.path.basename(DashFilesNames.thumbnails_sprite_mask(self.file_name))
+            return [
+                '-map', '0:v:0',
+                '-filter:v',
+                f'select=isnan(prev_selected_t)+gte(t-prev_selected_t\\,{self.thumbnails_interval}),'
+                f'scale={width}:{height},tile={columns}x{rows},settb=1,setpts=N',
+                '-r', '1',
+                '-start_number', str(number),
+                '-y', os.path.join(self.temp_dir.name, sprite_mask),
+            ]
+        return []
+
+    def _write_thumbnails_track(self) -> list:
+        """записывает WebVTT дорожку миниатюр для перемотки во временную директорию
+
+        Каждая миниатюра описывается интервалом времени и ссылкой на спрайт
+        с координатами миниатюры в нём (#xywh=x,y,ширина,высота). Ссылки указаны
+        относительно дорожки, т.к. спрайты хранятся рядом с ней.
+
+        :return: пути сгенерированных файлов и их названия в storage
+        """
 
-        -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:a:0 - дублируем
-            входной поток на 4 видео потока (v) и 1 аудио (a)
+        thumbnail_slices = self._get_thumbnail_slices()
+        if not thumbnail_slices:
+            return []
+
+        duration = self._get_probe().duration
+        width, height = self._get_thumbnail_size()
+        columns, rows = self.THUMBNAILS_TILE
+
+        cues = []
+        sprite_numbers = set()
+        for _, first_number, times in thumbnail_slices:
+            for index, time in enumerate(times):
+                number = first_number + index // (columns * rows)
+                position = index % (columns * rows)
+                sprite_numbers.add(number)
+                sprite_name = os.path.basename(
+                    DashFilesNames.thumbnails_sprite_name(self.file_name, number))
+                end = min(time + self.thumbnails_interval, duration)
+                cues.append(
+                    f"{self._format_vtt_time(time)} --> {self._format_vtt_time(end)}\n"
+                    f"{sprite_name}#xywh={position % columns * width},{position // columns * height},"
+                    f"{width},{height}\n")
+
+        track_name = DashFilesNames.thumbnails_track_name(self.file_name)
+        track_path = os.path.join(self.temp_dir.name, os.path.basename(track_name))
+        with open(track_path, "w") as track_file:
+            track_file.write("WEBVTT\n\n" + "\n".join(cues))
+
+        files = [(track_path, track_name)]
+        for number in sorted(sprite_numbers):
+            sprite_name = DashFilesNames.thumbnails_sprite_name(self.file_name, number)
+            files.append((os.path.join(self.temp_dir.name, os.path.basename(sprite_name)), sprite_name))
+        return files
+
+    @staticmethod
+    def _format_vtt_time(seconds: float) -> str:
+        milliseconds = int(round(seconds * 1000))
+        hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+        minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
 
-        -b:v:3 5000k -filter:v:3 "scale=-2:1080" -profile:v:3 high -
-            берем 3 видео поток, устанавливаем битрейт в 5000 кб/c
-            сжимаем до высоты в 1080 пикселей и уставливаем профиль кодирования
-            в hight. Все остальные потоки на подобии этому
+    def _save_generated_files(self):
+        """сохраняет изображение-превью, миниатюры для перемотки, файлы инициализации
+        потоков, сегменты потоков и mpd манифест из временной директории в storage.
 
-        -chunk_duration_ms 2000 средняя длина чанка в мс
-        -time_shift_buffer_depth 4000 время забуфферизированного видео
-            до начала воспроизведения плеером видео
+        Манифест сохраняется последним, чтобы видео стало доступно
+        плееру только когда все его файлы уже в storage."""
+
+        for _, temp_path, storage_name in self._get_posters():
+            self._save_temp_file(temp_path, storage_name)
+
+        for temp_path, storage_name in self._write_thumbnails_track():
+            self._save_temp_file(temp_path, storage_name)
+
+        if self.single_file:
+            self._save_single_files()
+        else:
+            self._save_init_files()
+            self._save_seg_files()
+
+        self.uploader.wait()
+
+        self._publish_manifests()
+
+    def _publish_manifests(self, published: bool = True):
+        """ Сохраняет манифесты и записывает сохранённые файлы в индекс (DashAsset)
+        вместе с лестницей разрешений из mpd манифеста.
+
+        Индекс записывается после сохранения манифеста: файлы, которые есть
+        в индексе, уже есть в storage.
+
+        :param published: все файлы видео сохранены, индекс полон
         """
-        return f'ffmpeg -i {self.temp_video_file.name} \
--map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:a:0 \
--c:a aac -b:a 128k \
--c:v libx264 -x264opts "keyint=24:min-keyint=24:no-scenecut" -r 24 \
--bf 1 -b_strategy 0 -sc_threshold 0 -pix_fmt yuv420p \
--b:v:3 5000k -filter:v:3 "scale=-2:1080" -profile:v:3 high \
--b:v:2 1800k -filter:v:2 "scale=-2:720" -profile:v:2 main \
--b:v:1 700k -filter:v:1 "scale=-2:480" -profile:v:1 main \
--b:v:0 450k -filter:v:0 "scale=-2:360" -profile:v:0 baseline \
--chunk_start_index 1 \
--chunk_duration_ms 2000 \
--time_shift_buffer_depth 4000 \
--minimum_update_period 4000 \
--use_timeline 1 \
--use_template 1 \
--f dash \
--init_seg_name {self._init_file_name_mask()} \
--media_seg_name {self._seg_file_name_mask()} \
-{self._mpd_file_path()}'
-
-    def _dash_command_gen_720_and_less(self):
-        """Создаёт команду для генерации dash контента на основе оригинального видео.
-        Данная функция создаёт потоки в 720, 480, 360px.
-
-        Описание генерируемой команды:
+
+        with open(self._mpd_file_path(), "rb") as mpd_file:
+            ladder = format_ladder(manifest_ladder(MpdManifest.from_string(mpd_file.read())))
+        self._save_manifests()
+
+        files, self.saved_files = self.saved_files, {}
+        DashAsset.add_files(self.file_name, files, ladder, published)
+
+    def _save_manifests(self):
+        """сохраняет плейлисты HLS и mpd манифест после файлов, на которые они ссылаются.
+        Основной плейлист HLS сохраняется после плейлистов потоков"""
+
+        if self.hls_playlist:
+            media_playlists_glob = os.path.basename(
+                DashFilesNames.hls_media_playlist_name(self.file_name, "*"))
+            for playlist_path in glob.glob(os.path.join(self.temp_dir.name, media_playlists_glob)):
+                self._save_temp_file(
+                    playlist_path,
+                    os.path.join(os.path.dirname(self.file_name), os.path.basename(playlist_path)))
+            self.uploader.wait()
+
+            self._save_temp_file(
+                self._hls_playlist_path(),
+                DashFilesNames.hls_playlist_name(self.file_name))
+
+        self._save_temp_file(
+            self._mpd_file_path(),
+            DashFilesNames.mpd_manifest_name(self.file_name))
+
+        self.uploader.wait()
+
+    def _save_temp_file(self, temp_file_path: str, storage_name: str, remove: bool = False):
+        """ставит файл из временной директории в очередь на сохранение в storage.
+        Файлы сохраняются параллельно, см. StorageUploader.
+
+        Для локального storage временный файл больше не нужен, поэтому
+        он всегда удаляется, т.е. публикуется переименованием без копирования."""
+
+        if self.publish_by_rename:
+            remove = True
+        # размер запоминается до сохранения: временный файл может быть перенесён
+        self.saved_files[storage_name] = os.path.getsize(temp_file_path)
+        self.uploader.upload(temp_file_path, storage_name, remove)
+
+    def _get_command_for_generate_dash(self):
+        """Создаёт команду для генерации dash контента на основе оригинального видео
+        одним процессом ffmpeg. Потоки создаются для всех разрешений из _get_renditions.
+
+        Описание генерируемой команды (на примере лестницы из 4 разрешений):
         -i {адрес входного файла}
 
         -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:a:0 - дублируем
-            входной поток на 4 видео потока (v) и 1 аудио
+            входной поток на 4 видео потока (v) и 1 аудио (a)
 
         -b:v:3 5000k -filter:v:3 "scale=-2:1080" -profile:v:3 high -
             берем 3 видео поток, устанавливаем битрейт в 5000 кб/c
             сжимаем до высоты в 1080 пикселей и уставливаем профиль кодирования
             в hight. Все остальные потоки на подобии этому
 
+        -threads 4 - сколько потоков кодирования занимает ffmpeg (DASH_CPU_BUDGET),
+            без этого ffmpeg занимает все ядра машины
+
         -chunk_duration_ms 2000 средняя длина чанка в мс
         -time_shift_buffer_depth 4000 время забуфферизированного видео
             до начала воспроизведения плеером видео
         """
-        return f'ffmpeg -i {self.temp_video_file.name} \
--map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:a:0 \
--c:a aac -b:a 128k \
--c:v libx264 -x264opts "keyint=24:min-keyint=24:no-scenecut" -r 24 \
--bf 1 -b_strategy 0 -sc_threshold 0 -pix_fmt yuv420p \
--b:v:2 1800k -filter:v:2 "scale=-2:720" -profile:v:2 main \
--b:v:1 700k -filter:v:1 "scale=-2:480" -profile:v:1 main \
--b:v:0 450k -filter:v:0 "scale=-2:360" -profile:v:0 baseline \
--chunk_start_index 1 \
--chunk_duration_ms 2000 \
--time_shift_buffer_depth 4000 \
--minimum_update_period 4000 \
--use_timeline 1 \
--use_template 1 \
--f dash \
--adaptation_sets "id=0,streams=0,1,2 id=1,streams=3" \
--init_seg_name {self._init_file_name_mask()} \
--media_seg_name {self._seg_file_name_mask()} \
-{self._mpd_file_path()} '
-
-    def _dash_command_gen_480_and_less(self):
-        """Создаёт команду для генерации dash контента на основе оригинального видео.
-        Данная функция создаёт потоки в 480, 360px.
-
-        Описание генерируемой команды:
-        -i {адрес входного файла}
+        renditions = self._get_renditions()
+
+        command = ['ffmpeg', '-i', self.source_path]
+        for _ in renditions:
+            command += ['-map', '0:v:0']
+        if self._get_probe().has_audio:
+            command += ['-map', '0:a:0']
+            command += self.AUDIO_CODEC_ARGS
+        command += self.VIDEO_CODEC_ARGS
+        for index, rendition in reversed(list(enumerate(renditions))):
+            command += self._rendition_args(index, rendition)
+        command += ['-threads', str(self._get_threads_per_job(1))]
+        command += self._dash_muxer_args()
+        command += self._poster_output_args()
+        command += self._thumbnails_output_args()
+        return command
+
+    def _encode_renditions_command(self, outputs: list, threads: int, time_slice=None,
+                                   with_posters: bool = False, audio_path: str = None) -> list:
+        """команда кодирования разрешений в промежуточные mp4 файлы
+        с теми же параметрами, что и при кодировании одним процессом.
+
+        :param outputs: список пар (разрешение, путь выходного файла),
+            видео декодируется один раз для всех выходных файлов
+        :param threads: количество потоков кодирования на каждый выходной файл
+        :param time_slice: (начало, длительность) кодируемого отрезка или None для всего видео
+        :param with_posters: создать также превью и миниатюры для перемотки из этого отрезка
+        :param audio_path: путь, куда закодировать аудио, или None, если аудио не нужно
+        """
 
-        -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:v:0 -map 0:a:0 - дублируем
-            входной поток на 4 видео потока (v) и 1 аудио
+        command = ['ffmpeg']
+        if time_slice is not None:
+            start, duration = time_slice
+            command += ['-ss', str(start), '-t', str(duration)]
+        command += ['-i', self.source_path]
+        for rendition, output_path in outputs:
+            command += ['-map', '0:v:0', '-an']
+            command += self.VIDEO_CODEC_ARGS
+            command += self._rendition_args(0, rendition)
+            command += ['-threads', str(threads), '-y', output_path]
+        if audio_path is not None:
+            command += ['-map', '0:a:0'] + self.AUDIO_CODEC_ARGS + ['-y', audio_path]
+        if with_posters:
+            command += self._poster_output_args(time_slice)
+            command += self._thumbnails_output_args(time_slice)
+        return command
+
+    def _package_renditions_command(self, renditions, inputs: list, with_audio: bool = True) -> list:
+        """команда упаковки закодированных разрешений в dash без перекодирования.
+
+        Аудио кодируется здесь же из оригинала целиком, т.к. это намного дешевле видео
+        и не даёт разрывов на границах отрезков.
+        Порядок потоков совпадает с _get_command_for_generate_dash, поэтому
+        номера потоков в названиях init и chunk файлов тоже совпадают.
+        Битрейт указывается явно, чтобы в mpd попал тот же bandwidth.
+
+        :param inputs: аргументы ffmpeg для чтения каждого разрешения
+        :param with_audio: упаковать также аудио, кодируя его из оригинала
+        """
 
-        -b:v:3 5000k -filter:v:3 "scale=-2:1080" -profile:v:3 high -
-            берем 3 видео поток, устанавливаем битрейт в 5000 кб/c
-            сжимаем до высоты в 1080 пикселей и уставливаем профиль кодирования
-            в hight. Все остальные потоки на подобии этому
+        with_audio = with_audio and self._get_probe().has_audio
+        command = ['ffmpeg']
+        for input_args in inputs:
+            command += input_args
+        if with_audio:
+            command += ['-i', self.source_path]
+        for index, _ in enumerate(renditions):
+            command += ['-map', f'{index}:v:0']
+        if with_audio:
+            command += ['-map', f'{len(renditions)}:a:0']
+            command += self.AUDIO_CODEC_ARGS
+        command += ['-c:v', 'copy']
+        for index, rendition in enumerate(renditions):
+            command += [f'-b:v:{index}', rendition.bitrate]
+        command += self._dash_muxer_args(with_audio)
+        return command
+
+    def _package_progressive_command(self, renditions) -> list:
+        """команда упаковки закодированных разрешений и аудио в dash без перекодирования
+        для постепенной публикации.
+
+        Аудио идёт первым потоком, а разрешения - за ним по порядку лестницы.
+        Поэтому, когда добавляется следующее разрешение, номера уже
+        опубликованных потоков и названия их файлов не меняются.
+        """
 
-        -chunk_duration_ms 2000 средняя длина чанка в мс
-        -time_shift_buffer_depth 4000 время забуфферизированного видео
-            до начала воспроизведения плеером видео
+        has_audio = self._get_probe().has_audio
+        command = ['ffmpeg']
+        if has_audio:
+            command += ['-i', self._audio_file_path()]
+        for index, _ in enumerate(renditions):
+            command += ['-i', self._rendition_file_path(index, 0)]
+
+        if has_audio:
+            command += ['-map', '0:a:0']
+        for index, _ in enumerate(renditions):
+            command += ['-map', f'{index + int(has_audio)}:v:0']
+        command += ['-c', 'copy']
+        if has_audio:
+            command += ['-b:a', self.AUDIO_BITRATE]
+        for index, rendition in enumerate(renditions):
+            command += [f'-b:v:{index}', rendition.bitrate]
+        command += self._dash_muxer_args()
+        return command
+
+    def _rendition_args(self, index: int, rendition) -> list:
+        return [
+            f'-b:v:{index}', rendition.bitrate,
+            f'-filter:v:{index}', f'scale=-2:{rendition.height}',
+            f'-profile:v:{index}', rendition.profile,
+        ]
+
+    def _dash_muxer_args(self, with_audio: bool = True) -> list:
+        """параметры dash муксера: видео потоки в одном adaptation set, аудио в другом
+
+        :param with_audio: упаковывается ли аудио
         """
-        return f'ffmpeg -i {self.temp_video_file.name} \
--map 0:v:0 -map 0:v:0 -map 0:a:0 \
--c:a aac -b:a 128k \
--c:v libx264 -x264opts "keyint=24:min-keyint=24:no-scenecut" -r 24 \
--bf 1 -b_strategy 0 -sc_threshold 0 -pix_fmt yuv420p \
--b:v:1 700k -filter:v:1 "scale=-2:480" -profile:v:1 main \
--b:v:0 450k -filter:v:0 "scale=-2:360" -profile:v:0 baseline \
--chunk_start_index 1 \
--chunk_duration_ms 2000 \
--time_shift_buffer_depth 4000 \
--minimum_update_period 4000 \
--use_timeline 1 \
--use_template 1 \
--f dash \
--adaptation_sets "id=0,streams=0,1 id=1,streams=3" \
--init_seg_name {self._init_file_name_mask()} \
--media_seg_name {self._seg_file_name_mask()} \
-{self._mpd_file_path()} '
+
+        adaptation_sets = 'id=0,streams=v'
+        if with_audio and self._get_probe().has_audio:
+            adaptation_sets += ' id=1,streams=a'
+
+        args = [
+            '-chunk_start_index', '1',
+            '-chunk_duration_ms', '2000',
+            '-seg_duration', str(self.SEGMENT_DURATION),
+            '-time_shift_buffer_depth', '4000',
+            '-minimum_update_period', '4000',
+        ]
+        if self.single_file:
+            # global_sidx записывает в начало файла индекс всех сегментов,
+            # по нему манифест переписывается на SegmentBase (см. _finish_manifest)
+            args += [
+                '-single_file', '1',
+                '-global_sidx', '1',
+                '-single_file_name', self._unescape_mask(self._single_file_name_mask()),
+            ]
+        else:
+            args += [
+                '-use_timeline', '1',
+                '-use_template', '1',
+                '-init_seg_name', self._unescape_mask(self._init_file_name_mask()),
+                '-media_seg_name', self._unescape_mask(self._seg_file_name_mask()),
+            ]
+        if self.hls_playlist:
+            args += [
+                '-hls_playlist', '1',
+                '-hls_master_name', os.path.basename(self._hls_playlist_path()),
+            ]
+        return args + [
+            '-dash_segment_type', 'mp4',
+            '-f', 'dash',
+            '-adaptation_sets', adaptation_sets,
+            self._mpd_file_path(),
+        ]
+
+    def _finish_manifest(self):
+        """доводит созданные ffmpeg манифесты до публикуемого вида"""
+
+        if self.single_file:
+            self._use_segment_base()
+        if self.complexity is not None:
+            self._save_complexity()
+        if self.hls_playlist:
+            self._rename_hls_media_playlists()
+
+    def _use_segment_base(self):
+        """переписывает mpd манифест для раскладки одним файлом на поток (DASH_SINGLE_FILE)
+
+        ffmpeg описывает сегменты такого файла списком диапазонов байт (SegmentList),
+        и манифест растёт вместе с длиной видео. Манифест переписывается
+        на SegmentBase со ссылкой на индекс сегментов в самом файле,
+        и его размер не зависит от длины видео."""
+
+        with open(self._mpd_file_path(), "rb") as mpd_file:
+            manifest = MpdManifest.from_string(mpd_file.read())
+
+        for adaptation_set, representation in manifest.representations():
+            for name in manifest.representation_file_names(adaptation_set, representation):
+                with open(os.path.join(self.temp_dir.name, name), "rb") as stream_file:
+                    manifest.set_segment_base(representation, find_index_range(stream_file))
+
+        with open(self._mpd_file_path(), "wb") as mpd_file:
+            mpd_file.write(manifest.to_string())
+
+    def _save_complexity(self):
+        """записывает сложность видео в mpd манифест: манифест хранится вместе
+        с видео, и по нему update_renditions подбирает битрейты новых разрешений"""
+
+        with open(self._mpd_file_path(), "rb") as mpd_file:
+            manifest = MpdManifest.from_string(mpd_file.read())
+
+        manifest.set_property(COMPLEXITY_SCHEME, str(self.complexity))
+
+        with open(self._mpd_file_path(), "wb") as mpd_file:
+            mpd_file.write(manifest.to_string())
+
+    def _rename_hls_media_playlists(self):
+        """переименовывает плейлисты HLS потоков по названию видео
+
+        ffmpeg называет их media_{номер потока}.m3u8 для любого видео,
+        а видео хранятся в одной директории storage. Ссылки на них
+        в основном плейлисте исправляются. Плейлисты потоков ссылаются
+        на те же init файлы и чанки, что и mpd манифест."""
+
+        def playlist_name(match) -> str:
+            return os.path.basename(
+                DashFilesNames.hls_media_playlist_name(self.file_name, int(match.group(1))))
+
+        for playlist_path in glob.glob(os.path.join(self.temp_dir.name, "media_*.m3u8")):
+            match = self.HLS_MEDIA_PLAYLIST.search(os.path.basename(playlist_path))
+            os.replace(playlist_path, os.path.join(self.temp_dir.name, playlist_name(match)))
+
+        with open(self._hls_playlist_path()) as playlist_file:
+            content = playlist_file.read()
+        with open(self._hls_playlist_path(), "w") as playlist_file:
+            playlist_file.write(self.HLS_MEDIA_PLAYLIST.sub(playlist_name, content))
+
+    def _get_renditions(self):
+        """выбирает разрешения из лестницы DASH_LADDER по высоте оригинального видео:
+        разрешения не выше оригинала, но не меньше MIN_RENDITIONS самых маленьких.
+        Если известна сложность видео, битрейты и количество разрешений
+        подбираются по ней (см. adapt_ladder)"""
+
+        video_height = self._get_probe().height
+        renditions = tuple(rendition for rendition in self.ladder
+                           if rendition.height < video_height + self.LADDER_HEIGHT_TOLERANCE)
+        if len(renditions) < self.MIN_RENDITIONS:
+            renditions = self.ladder[:self.MIN_RENDITIONS]
+        if self.complexity is not None:
+            min_factor, max_factor = self.adaptive_factors
+            renditions = adapt_ladder(renditions, self.complexity, min_factor, max_factor)
+        return renditions
+
+    def _get_probe(self) -> VideoProbe:
+        """параметры оригинального видео. Если они не были переданы
+        при создании менеджера, видео анализируется один раз здесь"""
+
+        if self.probe is None and self.source_path == PIPE_SOURCE:
+            with self.storage.open(self.file_name, "rb") as video_file:
+                self.probe = VideoProbe.from_stream(video_file)
+        elif self.probe is None:
+            self.probe = VideoProbe.from_file(self.source_path)
+        return self.probe
 
     def _save_init_files(self):
         """сохраняет сгенерированные init файлы из временной директории в storage"""
-        dash_init_name = self._init_file_name_mask()
-        dash_init_name_mask = dash_init_name. \
-            replace(r"\$RepresentationID\$", "*"). \
-            replace("\$Number%05d\$", "*")
-
         inits_filepath_list = glob.glob(
-            os.path.join(self.temp_dir.name, dash_init_name_mask))
+            os.path.join(self.temp_dir.name, self._init_files_glob()))
 
         for init_path in inits_filepath_list:
             init_name = os.path.basename(init_path)
-            with open(init_path, "rb") as init_tmp_file:
-                init_storage_file = self.storage.open(
-                    os.path.join(os.path.dirname(self.file_name), init_name),
-                    "wb+"
-                )
-                shutil.copyfileobj(init_tmp_file, init_storage_file)
-                init_storage_file.close()
+            self._save_temp_file(
+                init_path,
+                os.path.join(os.path.dirname(self.file_name), init_name))
 
     def _save_seg_files(self):
         """
         сохраняет сгенерированные seg файлы из временной директории в storage
         """
-        dash_seg_name = self._seg_file_name_mask()
-        dash_seg_name_mask = dash_seg_name. \
-            replace(r"\$RepresentationID\$", "*"). \
-            replace("\$Number%05d\$", "*")
-
         segs_filepath_list = glob.glob(
-            os.path.join(self.temp_dir.name, dash_seg_name_mask))
+            os.path.join(self.temp_dir.name, self._seg_files_glob()))
 
         for seg_path in segs_filepath_list:
-            seg_name = os.path.basename(seg_path)
-            with open(seg_path, "rb") as seg_tmp_file:
-                seg_storage_file = self.storage.open(
-                    os.path.join(os.path.dirname(self.file_name), seg_name),
-                    "wb+")
-                shutil.copyfileobj(seg_tmp_file, seg_storage_file)
-                seg_storage_file.close()
+            self._save_seg_file(seg_path)
+
+    def _save_seg_file(self, seg_path: str, remove: bool = False):
+        seg_name = os.path.basename(seg_path)
+        self._save_temp_file(
+            seg_path,
+            os.path.join(os.path.dirname(self.file_name), seg_name),
+            remove)
+
+    def _save_single_files(self):
+        """сохраняет сгенерированные файлы потоков (DASH_SINGLE_FILE) из временной директории в storage"""
+        for file_path in glob.glob(os.path.join(self.temp_dir.name, self._single_files_glob())):
+            self._save_temp_file(
+                file_path,
+                os.path.join(os.path.dirname(self.file_name), os.path.basename(file_path)))
+
+    def _dash_files_globs(self) -> list:
+        """glob маски для поиска всех файлов потоков во временной директории"""
+        if self.single_file:
+            return [self._single_files_glob()]
+        return [self._init_files_glob(), self._seg_files_glob()]
+
+    def _single_files_glob(self) -> str:
+        """glob маска для поиска файлов потоков (DASH_SINGLE_FILE) во временной директории"""
+        return self._single_file_name_mask().replace(r"\$RepresentationID\$", "*")
+
+    def _init_files_glob(self) -> str:
+        """glob маска для поиска init файлов во временной директории"""
+        dash_init_name = self._init_file_name_mask()
+        return dash_init_name. \
+            replace(r"\$RepresentationID\$", "*"). \
+            replace("\$Number%05d\$", "*")
+
+    def _seg_files_glob(self) -> str:
+        """glob маска для поиска seg файлов во временной директории"""
+        dash_seg_name = self._seg_file_name_mask()
+        return dash_seg_name. \
+            replace(r"\$RepresentationID\$", "*"). \
+            replace("\$Number%05d\$", "*")
 
     def _mpd_file_path(self):
         """возвращает путь временного mpd файла в файловой системе"""
@@ -415,10 +1867,10 @@ class DashVideoManager:
 
         return os.path.join(self.temp_dir.name, os.path.basename(mpd_file_name))
 
-    def _preview_file_path(self):
-        """возвращает путь временного preview файла в файловой системе"""
-        preview_file_name = DashFilesNames.preview_image_name(self.file_name)
-        return os.path.join(self.temp_dir.name, os.path.basename(preview_file_name))
+    def _hls_playlist_path(self):
+        """возвращает путь временного файла основного плейлиста HLS"""
+        playlist_name = DashFilesNames.hls_playlist_name(self.file_name)
+        return os.path.join(self.temp_dir.name, os.path.basename(playlist_name))
 
     def _seg_file_name_mask(self):
         path = DashFilesNames.dash_segments_mask(self.file_name)
@@ -427,3 +1879,24 @@ class DashVideoManager:
     def _init_file_name_mask(self):
         path = DashFilesNames.dash_init_files_mask(self.file_name)
         return os.path.basename(path)
+
+    def _single_file_name_mask(self):
+        path = DashFilesNames.dash_single_file_mask(self.file_name)
+        return os.path.basename(path)
+
+    def _rendition_file_path(self, index: int, slice_index: int) -> str:
+        """возвращает путь промежуточного файла закодированного отрезка разрешения"""
+        return os.path.join(self._intermediate_dir(), f"rendition-{index}-{slice_index}.mp4")
+
+    def _audio_file_path(self) -> str:
+        """возвращает путь промежуточного файла закодированного аудио"""
+        return os.path.join(self._intermediate_dir(), "audio.mp4")
+
+    def _intermediate_dir(self) -> str:
+        """директория промежуточных файлов: контрольная точка или временная директория"""
+        return self.checkpoint_path or self.temp_dir.name
+
+    def _unescape_mask(self, mask: str) -> str:
+        """убирает экранирование $ для shell из масок DashFilesNames,
+        т.к. команды ffmpeg запускаются без shell"""
+        return mask.replace(r"\$", "$")
@@ -7,7 +7,6 @@ import posixpath
 from django.conf import settings
 from django.db.models.fields.files import FieldFile
 from django.core.files.storage import Storage
-from django.core.files.storage import default_storage
 
 try:
     from subprocess import DEVNULL
@@ -15,12 +14,17 @@ except ImportError:
     DEVNULL = open('/dev/null', 'w')
 
 from django import forms
+from django.apps import apps
 from django.core import checks
 from django.db import models
+from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 
 from .dash import DashFilesNames, DashVideoManager
-from .tasks import generate_dash_manifest
+from .models import DashAsset, VideoAsset, VideoConversion
+from .probe import VideoProbe
+from .tasks import enqueue_dash_generation, generate_dash
+from .uploadhandlers import get_content_digest
 
 
 class VideoFormField(forms.FileField):
@@ -38,7 +42,7 @@ class VideoFormField(forms.FileField):
             return None
 
         if hasattr(data, 'temporary_file_path'):
-            input_file = data.temporary_file_path()
+            probe = self._probe_video(data.temporary_file_path())
         else:
             if hasattr(data, 'read'):
                 content = data.read()
@@ -46,32 +50,36 @@ class VideoFormField(forms.FileField):
                 content = data['content']
 
             fd, input_file = tempfile.mkstemp()
+            try:
+                with io.open(fd, 'wb') as temp_file:
+                    temp_file.write(content)
+                probe = self._probe_video(input_file)
+            finally:
+                os.remove(input_file)
 
-            with io.open(fd, 'w') as f:  # this works on Python 2?
-                f.write(str(content))
+        # анализ видео переиспользуется при сохранении модели и генерации DASH
+        f.video_probe = probe
 
-        # tries to open the video file with ffmpeg to check his integrity
-        exit_code = subprocess.call([
-            'ffmpeg',
-            '-v', 'quiet',  # don't print messages
-            '-i', input_file,  # input file
-            '-f', 'null',  # format is null because we don't really want to convert anything
-            '-'  # output to nowhere
-        ], stdout=DEVNULL, stderr=DEVNULL)
+        if hasattr(f, 'seek') and callable(f.seek):
+            f.seek(0)
 
-        # TODO: if file is an image ffmpeg dont exit with error code
-        # we should use ffprobe and analyze the output too
+        return f
 
-        if not exit_code == 0:
+    def _probe_video(self, input_file: str) -> VideoProbe:
+        """анализирует видео через ffprobe и проверяет, что это действительно видео,
+        а не изображение или файл другого формата"""
+
+        try:
+            probe = VideoProbe.from_file(input_file)
+        except ValueError:
+            probe = None
+
+        if probe is None or not probe.is_video:
             raise forms.ValidationError(
                 self.error_messages['invalid_video'],
                 code='invalid_video'
             )
-
-        if hasattr(f, 'seek') and callable(f.seek):
-            f.seek(0)
-
-        return f
+        return probe
 
 
 class FieldVideo(FieldFile):
@@ -90,6 +98,14 @@ class FieldVideo(FieldFile):
         обо всех остальных частях dash файлов"""
         return self.storage.url(DashFilesNames.mpd_manifest_name(self.name))
 
+    @property
+    def hls_url(self) -> str:
+        """url путь к основному плейлисту HLS (DASH_HLS_PLAYLIST) или пустая строка,
+        если плейлисты не создаются. Плейлисты ссылаются на те же сегменты, что и mpd файл"""
+        if not settings.DASH_HLS_PLAYLIST:
+            return ''
+        return self.storage.url(DashFilesNames.hls_playlist_name(self.name))
+
     @property
     def preview_url(self) -> str:
         """url путь к превью-изображению видео"""
@@ -100,15 +116,94 @@ class FieldVideo(FieldFile):
         """название превью-изображения"""
         return DashFilesNames.preview_image_name(self.name)
 
+    @property
+    def thumbnails_url(self) -> str:
+        """url путь к WebVTT дорожке миниатюр для перемотки.
+        Миниатюры в ней ссылаются на спрайты, которые хранятся рядом"""
+        return self.storage.url(DashFilesNames.thumbnails_track_name(self.name))
+
+    @property
+    def poster_candidate_urls(self) -> list:
+        """ url пути к вариантам превью-изображения (DASH_POSTER_CANDIDATES).
+
+        Названия вариантов берутся одним запросом из индекса файлов видео
+        (DashAsset). Если индекс видео неполон, в storage проверяется
+        не больше DASH_POSTER_CANDIDATES вариантов."""
+
+        names = [DashFilesNames.poster_candidate_name(self.name, index)
+                 for index in range(1, settings.DASH_POSTER_CANDIDATES + 1)]
+        asset = DashAsset.objects.filter(file_name=self.name, state=DashAsset.STATE_PUBLISHED).first()
+        if asset is not None:
+            prefix = DashFilesNames.get_video_name(self.name) + '-poster-'
+            indexed = set(asset.files.filter(name__startswith=prefix).values_list('name', flat=True))
+            names = [DashFilesNames.poster_candidate_name(self.name, index)
+                     for index in range(1, len(indexed) + 1)]
+            return [self.storage.url(name) for name in names if name in indexed]
+
+        urls = []
+        for name in names:
+            if not self.storage.exists(name):
+                break
+            urls.append(self.storage.url(name))
+        return urls
+
+    @property
+    def conversion(self):
+        """ход и результат конвертации видео (VideoConversion) или None,
+        если видео ещё не начинало конвертироваться"""
+        return VideoConversion.objects.filter(file_name=self.name).first()
+
     @property
     def mpd_file_name(self) -> str:
         """название mpd манифеста."""
         return DashFilesNames.mpd_manifest_name(self.name)
 
+    def save(self, name, content, save=True):
+        """сохраняет загруженное видео
+
+        Если включён DASH_DEDUPLICATE_UPLOADS и видео с таким же содержимым
+        уже было загружено, файл не сохраняется и не конвертируется повторно:
+        поле ссылается на уже сохранённое видео и его DASH файлы (см. VideoAsset)."""
+
+        digest = None
+        if settings.DASH_DEDUPLICATE_UPLOADS:
+            digest = get_content_digest(content)
+            asset = VideoAsset.acquire(digest, self.storage)
+            if asset is not None:
+                self.name = asset.file_name
+                setattr(self.instance, self.field.name, self.name)
+                self._committed = True
+                self.field.set_reused_asset(self.instance, self.name)
+                if save:
+                    self.instance.save()
+                return
+
+        super().save(name, content, save)
+        if digest is not None:
+            VideoAsset.register(digest, self.name)
+    save.alters_data = True
+
     def delete(self, save=True):
+        """удаляет видео и его DASH файлы. Если это же видео используется
+        в других моделях (DASH_DEDUPLICATE_UPLOADS), удаляется только ссылка на него"""
+
+        if not self:
+            return
+
         file_name = self.name
         storage = self.storage
+        if not VideoAsset.release(file_name):
+            self.name = None
+            setattr(self.instance, self.field.name, self.name)
+            self._committed = False
+            if save:
+                self.instance.save()
+            return
+
         super().delete(save)
+        # строка конвертации удаляется до DASH файлов: запущенная конвертация
+        # этого видео, не найдя её, сама удалит то, что успеет опубликовать (см. generate_dash)
+        VideoConversion.objects.filter(file_name=file_name).delete()
         dash = DashVideoManager(file_name, storage)
         dash.destroy()
     delete.alters_data = True
@@ -128,9 +223,17 @@ class VideoField(models.FileField):
 
         super(VideoField, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(VideoField, self).contribute_to_class(cls, name, **kwargs)
+        # Как и ImageField, подписываемся на post_init, чтобы запомнить,
+        # какой файл уже был сконвертирован в DASH до изменения модели
+        if not cls._meta.abstract:
+            signals.post_init.connect(self.remember_dash_source, sender=cls)
+
     def check(self, **kwargs):
         errors = super(VideoField, self).check(**kwargs)
         errors.extend(self._check_ffmpeg_installed())
+        errors.extend(self._check_ffprobe_installed())
         return errors
 
     def _check_ffmpeg_installed(self):
@@ -147,6 +250,20 @@ class VideoField(models.FileField):
             ]
         return []
 
+    def _check_ffprobe_installed(self):
+        exit_code = subprocess.call(['which', 'ffprobe'], stdout=DEVNULL)
+
+        if not exit_code == 0:
+            return [
+                checks.Error(
+                    'Cannot use VideoField because ffprobe is not installed.',
+                    hint='ffprobe is shipped with ffmpeg, get it at https://ffmpeg.org/download.html',
+                    obj=self,
+                    id='videofield.E002',
+                )
+            ]
+        return []
+
     def deconstruct(self):
         name, path, args, kwargs = super(VideoField, self).deconstruct()
 
@@ -169,17 +286,149 @@ class VideoField(models.FileField):
         return super(VideoField, self).formfield(**defaults)
 
     def pre_save(self, model_instance, add):
+        file = getattr(model_instance, self.attname)
+        is_new_upload = bool(file) and not file._committed
+        probe = getattr(file.file, 'video_probe', None) if is_new_upload else None
         file = super().pre_save(model_instance, add)
-        if file:
-            self.gen_dash(file.name)
+        if not file:
+            self.set_dash_source(model_instance, None)
+            self.update_video_fields(model_instance, None)
+        elif is_new_upload or self.is_dash_source_changed(model_instance, file):
+            if probe is None and self.has_video_fields():
+                probe = self._probe_stored_video(file)
+            self.update_video_fields(model_instance, file, probe)
+            if not self.is_reused_asset(model_instance, file.name):
+                # у модели уже было сконвертированное видео, и её можно смотреть без нового
+                retranscode = self.get_dash_source(model_instance) is not None
+                self.gen_dash(file.name, probe, retranscode)
+            self.set_dash_source(model_instance, (file.name, file.size))
         return file
 
-    def gen_dash(self, file_name: str):
+    def _probe_stored_video(self, file: FieldVideo):
+        """анализирует видео, сохранённое без VideoFormField, например из кода.
+        Если файл не удалось проанализировать, поля модели останутся пустыми"""
+
+        try:
+            return VideoProbe.from_storage(file.storage, file.name)
+        except ValueError:
+            return None
+
+    def has_video_fields(self) -> bool:
+        return bool(self.width_field or self.height_field or self.duration_field
+                    or self.size_field or self.thumbnail_field)
+
+    def update_video_fields(self, instance, file: FieldVideo, probe: VideoProbe = None):
+        """заполняет поля модели, указанные в width_field, height_field,
+        duration_field, size_field и thumbnail_field, по аналогии с ImageField.
+
+        Значения берутся из анализа видео, сделанного при загрузке, поэтому
+        они доступны в шаблонах без чтения mpd манифеста из storage.
+        Поля модели заполняются в pre_save, поэтому они должны быть
+        объявлены в модели после VideoField.
+        """
+
+        if not self.has_video_fields():
+            return
+
+        if file and probe is not None:
+            values = {
+                self.width_field: probe.width,
+                self.height_field: probe.height,
+                self.duration_field: probe.duration,
+                self.size_field: file.size,
+                self.thumbnail_field: DashFilesNames.preview_image_name(file.name),
+            }
+        else:
+            values = {
+                self.width_field: None,
+                self.height_field: None,
+                self.duration_field: None,
+                self.size_field: None,
+                self.thumbnail_field: None,
+            }
+
+        for field_name, value in values.items():
+            if not field_name:
+                continue
+            field = instance._meta.get_field(field_name)
+            if isinstance(field, models.DurationField) and value is not None:
+                value = datetime.timedelta(seconds=value)
+            elif value is None and not field.null:
+                value = field.get_default()
+            setattr(instance, field.attname, value)
+
+    def remember_dash_source(self, instance, **kwargs):
+        """запоминает состояние файла, с которым модель была создана или загружена из БД.
+
+        Незакоммиченный файл (только что загруженный) не запоминается:
+        для него DASH ещё не сгенерирован. Размер файла здесь не запрашивается,
+        чтобы не обращаться к storage при каждой загрузке модели.
+
+        Django отмечает модель загруженной из БД (_state.adding) уже после
+        post_init, поэтому запомненный файл новой модели отбрасывается
+        позже, в get_dash_source.
+        """
+
+        # поле отложено через defer()/only()
+        if self.attname not in instance.__dict__:
+            return
+
+        file = getattr(instance, self.attname)
+        if file and file._committed:
+            self.set_dash_source(instance, (file.name, None))
+        else:
+            self.set_dash_source(instance, None)
+
+    def is_dash_source_changed(self, instance, file: FieldVideo) -> bool:
+        """проверяет, отличается ли сохраняемый файл от уже сконвертированного
+
+        Сравнивается название файла и, если он известен, размер.
+        Новое видео всегда получает уникальное название (см. gen_uniq_filename),
+        поэтому при обычном сохранении модели, например при изменении текста урока,
+        DASH повторно не генерируется.
+        """
+
+        source = self.get_dash_source(instance)
+        if source is None:
+            return True
+
+        name, size = source
+        if name != file.name:
+            return True
+        return size is not None and size != file.size
+
+    def get_dash_source(self, instance):
+        """файл, для которого уже сгенерирован DASH, в виде (название, размер) или None
+
+        Модель, которая ещё не сохранялась, например Lesson(video='videos/lecture.mp4'),
+        своего видео не конвертировала, даже если файл уже есть в storage.
+        """
+
+        if instance._state.adding:
+            return None
+        return getattr(instance, self._dash_source_attname(), None)
+
+    def set_dash_source(self, instance, source):
+        setattr(instance, self._dash_source_attname(), source)
+
+    def _dash_source_attname(self) -> str:
+        return f'_{self.attname}_dash_source'
+
+    def set_reused_asset(self, instance, name: str):
+        """отмечает, что поле ссылается на уже загруженное и сконвертированное видео"""
+        setattr(instance, self._reused_asset_attname(), name)
+
+    def is_reused_asset(self, instance, name: str) -> bool:
+        return getattr(instance, self._reused_asset_attname(), None) == name
+
+    def _reused_asset_attname(self) -> str:
+        return f'_{self.attname}_reused_asset'
+
+    def gen_dash(self, file_name: str, probe: VideoProbe = None, retranscode: bool = False):
         if settings.DASH_RUN_CONVERTATION_AT_ASYNC:
-            generate_dash_manifest.apply_async(args=[file_name])
+            enqueue_dash_generation(file_name, probe, retranscode)
         else:
-            dash = DashVideoManager(file_name, default_storage)
-            dash.generate()
+            generate_dash(file_name, probe)
 
     def get_storage_object(self) -> Storage:
         return self.storage
@@ -203,3 +452,27 @@ class VideoField(models.FileField):
         gen_mpd_name = self.storage.generate_filename(mpd_file_name)
         gen_name, _ = os.path.splitext(gen_mpd_name)
         return gen_name + ext
+
+
+def get_video_fields():
+    """все поля VideoField всех моделей парами (модель, поле)"""
+
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, VideoField):
+                yield model, field
+
+
+def get_stored_videos():
+    """storage и названия всех видео из полей VideoField всех моделей.
+    Одно и то же видео может использоваться в нескольких моделях
+    (DASH_DEDUPLICATE_UPLOADS), но возвращается один раз"""
+
+    seen = set()
+    for model, field in get_video_fields():
+        file_names = model._default_manager.exclude(**{field.name: ''}) \
+            .values_list(field.name, flat=True)
+        for file_name in file_names.iterator():
+            if file_name and file_name not in seen:
+                seen.add(file_name)
+                yield field.storage, file_name
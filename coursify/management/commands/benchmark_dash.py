@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coursify.benchmark import benchmark_clip, create_clip, get_environment, get_storages
+
+
+class Command(BaseCommand):
+    help = ('Измеряет длительность этапов конвертации видео в DASH на тестовых видео '
+            'разных разрешений и длительностей и выводит результаты в JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default='640x360,1280x720,1920x1080',
+                            help='разрешения тестовых видео через запятую')
+        parser.add_argument('--durations', default='10,60',
+                            help='длительности тестовых видео в секундах через запятую')
+        parser.add_argument('--storages', default='filesystem,memory',
+                            help='storage через запятую: filesystem, memory')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='сколько раз конвертировать каждое видео')
+        parser.add_argument('--output', help='файл для результатов, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        try:
+            resolutions = [tuple(int(size) for size in resolution.split('x'))
+                           for resolution in options['resolutions'].split(',')]
+            durations = [int(duration) for duration in options['durations'].split(',')]
+        except ValueError as error:
+            raise CommandError(f"Invalid resolutions or durations: {error}")
+
+        results = []
+        with tempfile.TemporaryDirectory(prefix='dash_benchmark_') as work_dir:
+            try:
+                storages = get_storages(options['storages'].split(','), work_dir)
+            except ValueError as error:
+                raise CommandError(str(error))
+
+            for width, height in resolutions:
+                for duration in durations:
+                    clip_path = os.path.join(work_dir, f'clip-{width}x{height}-{duration}s.mp4')
+                    create_clip(clip_path, width, height, duration)
+
+                    for storage_name, storage in storages.items():
+                        for repeat in range(options['repeat']):
+                            result = benchmark_clip(clip_path, storage)
+                            results.append(dict(
+                                result,
+                                resolution=f'{width}x{height}',
+                                duration=duration,
+                                storage=storage_name,
+                                repeat=repeat))
+                            self.stderr.write(
+                                f'{width}x{height} {duration}s {storage_name} #{repeat}: '
+                                + ', '.join(f'{stage} {seconds:.2f}s'
+                                            for stage, seconds in result['stages'].items()))
+
+        report = json.dumps({'environment': get_environment(), 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(report)
+        else:
+            self.stdout.write(report)
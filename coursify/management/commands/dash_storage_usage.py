@@ -0,0 +1,41 @@
+import json
+from collections import defaultdict
+
+from django.core.exceptions import FieldError
+from django.core.management.base import BaseCommand, CommandError
+
+from coursify.fields import get_video_fields
+from coursify.models import DashAsset
+
+
+class Command(BaseCommand):
+    help = ('Выводит в JSON, сколько DASH файлов и места в storage занимают видео '
+            'по индексу DashAsset, не обращаясь к storage')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.Model',
+                            help='модели с полями VideoField, по умолчанию все')
+        parser.add_argument('--group-by', default='pk',
+                            help='поле или lookup модели, по которому группируются видео, например course__slug')
+
+    def handle(self, *args, **options):
+        report = {}
+        for model, field in get_video_fields():
+            label = model._meta.label
+            if options['models'] and label not in options['models']:
+                continue
+
+            groups = defaultdict(set)
+            try:
+                file_names = model._default_manager.exclude(**{field.name: ''}) \
+                    .values_list(options['group_by'], field.name)
+                for group, file_name in file_names.iterator():
+                    groups[str(group)].add(file_name)
+            except FieldError as error:
+                raise CommandError(f'{label}: {error}')
+
+            report[f'{label}.{field.name}'] = {
+                'total': DashAsset.usage(set().union(*groups.values())),
+                'groups': {group: DashAsset.usage(names) for group, names in sorted(groups.items())},
+            }
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from coursify.dash import DashVideoManager
+from coursify.fields import get_stored_videos
+from coursify.models import DashAsset
+
+
+class Command(BaseCommand):
+    help = ('Записывает в индекс DASH файлов (DashAsset) видео, сконвертированные '
+            'до его появления: файлы перечисляются по mpd манифесту и поиском в storage')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='reindex',
+                            help='переписать индекс и тех видео, у которых он уже полон')
+
+    def handle(self, *args, **options):
+        published = set()
+        if not options['reindex']:
+            published = set(DashAsset.objects.filter(state=DashAsset.STATE_PUBLISHED)
+                            .values_list('file_name', flat=True))
+
+        for storage, file_name in get_stored_videos():
+            if file_name in published:
+                continue
+            indexed = DashVideoManager(file_name, storage).index()
+            self.stdout.write(f'{file_name}: {"indexed" if indexed else "no manifest"}')
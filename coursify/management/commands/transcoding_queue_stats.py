@@ -0,0 +1,21 @@
+import datetime
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from coursify.models import VideoConversion
+
+
+class Command(BaseCommand):
+    help = ('Выводит в JSON время ожидания конвертаций видео в очереди celery '
+            'для первых публикаций и повторных конвертаций')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24,
+                            help='за сколько последних часов учитывать начатые конвертации')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - datetime.timedelta(hours=options['hours'])
+        stats = VideoConversion.queue_wait_stats(since)
+        self.stdout.write(json.dumps({'since': since.isoformat(), 'tiers': stats}, indent=2))
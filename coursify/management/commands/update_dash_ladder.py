@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from coursify.dash import DashVideoManager
+from coursify.fields import get_stored_videos
+from coursify.models import VideoConversion
+from coursify.tasks import LOWEST_PRIORITY, update_dash_renditions
+
+
+class Command(BaseCommand):
+    help = ('Добавляет всем сконвертированным видео разрешения лестницы DASH_LADDER, '
+            'которых у них нет, не перекодируя уже опубликованные потоки. '
+            'Видео, которые ждут конвертации или конвертируются, пропускаются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--async', action='store_true', dest='run_async',
+                            help='поставить видео в очередь конвертации с самым низким приоритетом')
+
+    def handle(self, *args, **options):
+        for storage, file_name in get_stored_videos():
+            if VideoConversion.is_active(file_name):
+                self.stdout.write(f'{file_name}: converting, skipped')
+                continue
+            if options['run_async']:
+                update_dash_renditions.apply_async(args=[file_name], priority=LOWEST_PRIORITY)
+                self.stdout.write(f'{file_name}: queued')
+                continue
+
+            renditions = DashVideoManager(file_name, storage).update_renditions()
+            added = ', '.join(f'{rendition.height}p' for rendition in renditions) or 'up to date'
+            self.stdout.write(f'{file_name}: {added}')
@@ -0,0 +1,28 @@
+# Generated by Django 2.2 on 2026-10-18 05:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoAsset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='sha256 содержимого')),
+                ('file_name', models.CharField(max_length=255, unique=True, verbose_name='название файла')),
+                ('references', models.PositiveIntegerField(default=1, verbose_name='количество ссылок')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='дата создания')),
+            ],
+            options={
+                'verbose_name': 'Видео файл',
+                'verbose_name_plural': 'Видео файлы',
+            },
+        ),
+    ]
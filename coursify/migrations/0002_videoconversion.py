@@ -0,0 +1,35 @@
+# Generated by Django 2.2 on 2026-10-18 06:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coursify', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoConversion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255, unique=True, verbose_name='название файла')),
+                ('state', models.CharField(choices=[('progress', 'конвертируется'), ('done', 'готово'), ('failed', 'ошибка')], default='progress', max_length=20, verbose_name='состояние')),
+                ('stage', models.CharField(blank=True, max_length=20, verbose_name='этап')),
+                ('percent', models.FloatField(default=0, verbose_name='процент этапа')),
+                ('frame', models.PositiveIntegerField(default=0, verbose_name='закодировано кадров')),
+                ('out_time', models.FloatField(default=0, verbose_name='закодировано секунд')),
+                ('speed', models.FloatField(default=0, verbose_name='скорость')),
+                ('eta', models.FloatField(blank=True, null=True, verbose_name='осталось секунд')),
+                ('error', models.TextField(blank=True, verbose_name='ошибка')),
+                ('started_at', models.DateTimeField(verbose_name='дата начала')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Конвертация видео',
+                'verbose_name_plural': 'Конвертации видео',
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 2.2 on 2026-10-18 06:41
+
+from django.db import migrations, models
+
+
+def set_queued_at(apps, schema_editor):
+    # конвертации до появления очереди начинались сразу
+    VideoConversion = apps.get_model('coursify', 'VideoConversion')
+    VideoConversion.objects.update(queued_at=models.F('started_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coursify', '0002_videoconversion'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='videoconversion',
+            options={'ordering': ['-queued_at'], 'verbose_name': 'Конвертация видео', 'verbose_name_plural': 'Конвертации видео'},
+        ),
+        migrations.AddField(
+            model_name='videoconversion',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='приоритет'),
+        ),
+        migrations.AddField(
+            model_name='videoconversion',
+            name='queue',
+            field=models.CharField(blank=True, max_length=255, verbose_name='очередь celery'),
+        ),
+        migrations.AddField(
+            model_name='videoconversion',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='дата постановки в очередь'),
+        ),
+        migrations.AddField(
+            model_name='videoconversion',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255, verbose_name='задача celery'),
+        ),
+        migrations.AddField(
+            model_name='videoconversion',
+            name='task_priority',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='приоритет с учётом ожидания'),
+        ),
+        migrations.AddField(
+            model_name='videoconversion',
+            name='tier',
+            field=models.CharField(choices=[('publish', 'первая публикация'), ('retranscode', 'повторная конвертация')], default='publish', max_length=20, verbose_name='вид конвертации'),
+        ),
+        migrations.AlterField(
+            model_name='videoconversion',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='дата начала'),
+        ),
+        migrations.AlterField(
+            model_name='videoconversion',
+            name='state',
+            field=models.CharField(choices=[('queued', 'в очереди'), ('progress', 'конвертируется'), ('done', 'готово'), ('failed', 'ошибка')], default='progress', max_length=20, verbose_name='состояние'),
+        ),
+        migrations.RunPython(set_queued_at, migrations.RunPython.noop),
+    ]
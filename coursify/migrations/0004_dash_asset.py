@@ -0,0 +1,47 @@
+# Generated by Django 2.2 on 2026-10-18 07:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coursify', '0003_conversion_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashAsset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255, unique=True, verbose_name='название файла')),
+                ('state', models.CharField(choices=[('publishing', 'сохраняется'), ('published', 'опубликовано'), ('deleting', 'удаляется')], default='publishing', max_length=20, verbose_name='состояние')),
+                ('ladder', models.CharField(blank=True, max_length=255, verbose_name='лестница разрешений')),
+                ('representations', models.PositiveSmallIntegerField(default=0, verbose_name='количество потоков')),
+                ('file_count', models.PositiveIntegerField(default=0, verbose_name='количество файлов')),
+                ('size', models.BigIntegerField(default=0, verbose_name='размер, байт')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='дата обновления')),
+            ],
+            options={
+                'verbose_name': 'DASH файлы видео',
+                'verbose_name_plural': 'DASH файлы видео',
+            },
+        ),
+        migrations.CreateModel(
+            name='DashFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='название в storage')),
+                ('representation', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='номер потока')),
+                ('size', models.BigIntegerField(verbose_name='размер, байт')),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='coursify.DashAsset', verbose_name='видео')),
+            ],
+            options={
+                'verbose_name': 'DASH файл',
+                'verbose_name_plural': 'DASH файлы',
+                'unique_together': {('asset', 'name')},
+            },
+        ),
+    ]
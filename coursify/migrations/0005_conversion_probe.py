@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 08:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coursify', '0004_dash_asset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videoconversion',
+            name='probe',
+            field=models.TextField(blank=True, verbose_name='анализ видео'),
+        ),
+    ]
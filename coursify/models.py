@@ -0,0 +1,456 @@
+import datetime
+import json
+import posixpath
+import re
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from django.core.files.storage import Storage
+
+
+class VideoAsset(models.Model):
+    """ Загруженное видео и его DASH файлы, общие для всех моделей с таким же видео.
+
+    Видео с одинаковым содержимым (например, одно и то же вступление
+    в разных уроках) сохраняется и конвертируется один раз, а поля моделей
+    ссылаются на один и тот же файл. references - количество таких ссылок,
+    файлы удаляются только вместе с последней из них.
+    """
+
+    digest = models.CharField('sha256 содержимого', max_length=64, unique=True)
+    file_name = models.CharField('название файла', max_length=255, unique=True)
+    references = models.PositiveIntegerField('количество ссылок', default=1)
+
+    created_at = models.DateTimeField('дата создания', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Видео файл'
+        verbose_name_plural = 'Видео файлы'
+
+    def __str__(self):
+        return self.file_name
+
+    @classmethod
+    def acquire(cls, digest: str, storage: Storage):
+        """находит уже загруженное видео с таким содержимым и добавляет ссылку на него
+
+        :return: VideoAsset или None, если такого видео нет в storage
+        """
+
+        with transaction.atomic():
+            asset = cls.objects.select_for_update().filter(digest=digest).first()
+            if asset is None:
+                return None
+            if not storage.exists(asset.file_name):
+                asset.delete()
+                return None
+
+            asset.references = models.F('references') + 1
+            asset.save(update_fields=['references'])
+            return asset
+
+    @classmethod
+    def register(cls, digest: str, file_name: str):
+        """запоминает новое загруженное видео с одной ссылкой на него.
+        Если такое же видео одновременно загрузили в другую модель,
+        это видео остаётся отдельным файлом"""
+
+        cls.objects.get_or_create(digest=digest, defaults={'file_name': file_name})
+
+    @classmethod
+    def release(cls, file_name: str) -> bool:
+        """убирает ссылку на видео
+
+        :return: True, если ссылок больше нет и файлы видео можно удалять
+        """
+
+        with transaction.atomic():
+            asset = cls.objects.select_for_update().filter(file_name=file_name).first()
+            if asset is None:
+                return True
+            if asset.references > 1:
+                asset.references = models.F('references') - 1
+                asset.save(update_fields=['references'])
+                return False
+
+            asset.delete()
+            return True
+
+
+class DashAsset(models.Model):
+    """ Индекс DASH файлов сконвертированного видео в storage.
+
+    Файлы (DashFile) записываются при сохранении в storage, поэтому список
+    файлов видео и их размер известны без перебора storage: удаление видео
+    берёт список отсюда, а место в storage по урокам и курсам считается
+    запросом к базе (см. usage).
+
+    Пока файлы сохраняются, запись в состоянии publishing, и в индексе может
+    не хватать файлов. Полным индекс считается только в состоянии published.
+    ladder - лестница разрешений, с которой видео опубликовано
+    (высота:битрейт:профиль через запятую, см. DASH_LADDER).
+    """
+
+    STATE_PUBLISHING = 'publishing'
+    STATE_PUBLISHED = 'published'
+    STATE_DELETING = 'deleting'
+    STATES = (
+        (STATE_PUBLISHING, 'сохраняется'),
+        (STATE_PUBLISHED, 'опубликовано'),
+        (STATE_DELETING, 'удаляется'),
+    )
+
+    file_name = models.CharField('название файла', max_length=255, unique=True)
+    state = models.CharField('состояние', max_length=20, choices=STATES, default=STATE_PUBLISHING)
+    ladder = models.CharField('лестница разрешений', max_length=255, blank=True)
+    representations = models.PositiveSmallIntegerField('количество потоков', default=0)
+    file_count = models.PositiveIntegerField('количество файлов', default=0)
+    size = models.BigIntegerField('размер, байт', default=0)
+
+    created_at = models.DateTimeField('дата создания', auto_now_add=True)
+    updated_at = models.DateTimeField('дата обновления', auto_now=True)
+
+    class Meta:
+        verbose_name = 'DASH файлы видео'
+        verbose_name_plural = 'DASH файлы видео'
+
+    def __str__(self):
+        return self.file_name
+
+    @classmethod
+    def begin(cls, file_name: str) -> 'DashAsset':
+        """отмечает, что файлы видео начинают сохраняться
+
+        :return: запись в состоянии до вызова, т.е. state - прежнее состояние
+        """
+
+        asset, _ = cls.objects.get_or_create(file_name=file_name)
+        cls.objects.filter(pk=asset.pk).update(state=cls.STATE_PUBLISHING, updated_at=timezone.now())
+        return asset
+
+    @classmethod
+    def add_files(cls, file_name: str, files: dict, ladder: str, published: bool):
+        """записывает сохранённые в storage файлы и пересчитывает итоги видео
+
+        :param files: размер каждого файла по его названию в storage. Размер
+            уже записанных файлов (например, перезаписанного манифеста) обновляется
+        :param published: все файлы видео уже записаны, индекс полон
+        """
+
+        with transaction.atomic():
+            asset, _ = cls.objects.select_for_update().get_or_create(file_name=file_name)
+            if len(files) <= DashFile.LOOKUP_BATCH_SIZE:
+                existing = asset.files.filter(name__in=list(files))
+            else:
+                existing = asset.files.all()
+            existing = {dash_file.name: dash_file for dash_file in existing}
+            updated = []
+            created = []
+            for name, size in files.items():
+                dash_file = existing.get(name)
+                if dash_file is None:
+                    created.append(DashFile(asset=asset, name=name, size=size,
+                                            representation=stream_id_of(file_name, name)))
+                elif dash_file.size != size:
+                    dash_file.size = size
+                    updated.append(dash_file)
+            DashFile.objects.bulk_create(created, batch_size=DashFile.LOOKUP_BATCH_SIZE)
+            DashFile.objects.bulk_update(updated, ['size'], batch_size=DashFile.LOOKUP_BATCH_SIZE)
+
+            totals = asset.files.aggregate(file_count=models.Count('id'), size=models.Sum('size'))
+            asset.file_count = totals['file_count']
+            asset.size = totals['size'] or 0
+            asset.representations = asset.files.exclude(representation=None) \
+                .values('representation').distinct().count()
+            asset.ladder = ladder
+            if published:
+                asset.state = cls.STATE_PUBLISHED
+            asset.save()
+
+    @classmethod
+    def set_published(cls, file_name: str):
+        """отмечает, что все файлы видео сохранены и записаны в индекс"""
+        cls.objects.filter(file_name=file_name).update(state=cls.STATE_PUBLISHED, updated_at=timezone.now())
+
+    def set_deleting(self):
+        self.state = self.STATE_DELETING
+        self.save(update_fields=['state', 'updated_at'])
+
+    def file_names(self) -> list:
+        """названия всех файлов видео одним запросом"""
+        return list(self.files.values_list('name', flat=True))
+
+    @classmethod
+    def usage(cls, file_names) -> dict:
+        """сколько DASH файлов и места в storage занимают видео file_names"""
+
+        file_names = list(file_names)
+        usage = {'videos': 0, 'files': 0, 'bytes': 0}
+        for start in range(0, len(file_names), DashFile.LOOKUP_BATCH_SIZE):
+            totals = cls.objects.filter(file_name__in=file_names[start:start + DashFile.LOOKUP_BATCH_SIZE]) \
+                .aggregate(videos=models.Count('id'), files=models.Sum('file_count'), bytes=models.Sum('size'))
+            for key in usage:
+                usage[key] += totals[key] or 0
+        return usage
+
+
+class DashFile(models.Model):
+    """ Файл DASH видео в storage: сегмент, init файл или файл потока, манифест,
+    плейлист, превью или миниатюры. representation - номер потока, как в mpd
+    манифесте, или None для файлов, которые не относятся к потоку."""
+
+    # сколько файлов записывается и ищется одним запросом (в sqlite не больше 999 параметров)
+    LOOKUP_BATCH_SIZE = 500
+
+    asset = models.ForeignKey(DashAsset, on_delete=models.CASCADE, related_name='files', verbose_name='видео')
+    name = models.CharField('название в storage', max_length=255)
+    representation = models.PositiveSmallIntegerField('номер потока', null=True, blank=True)
+    size = models.BigIntegerField('размер, байт')
+
+    class Meta:
+        verbose_name = 'DASH файл'
+        verbose_name_plural = 'DASH файлы'
+        unique_together = ('asset', 'name')
+
+    def __str__(self):
+        return self.name
+
+
+# номер потока в названиях init файлов, сегментов, файлов потоков и плейлистов HLS потоков
+# после названия видео (см. DashFilesNames)
+STREAM_FILE_NAME = re.compile(r'^-(?:chunk-stream|init-stream|stream|media-)(\d+)[-.]')
+
+
+def stream_id_of(video_name: str, name: str):
+    """номер потока, к которому относится DASH файл name видео video_name, или None"""
+
+    prefix = posixpath.basename(posixpath.splitext(video_name)[0])
+    base_name = posixpath.basename(name)
+    if not base_name.startswith(prefix):
+        return None
+    match = STREAM_FILE_NAME.match(base_name[len(prefix):])
+    return int(match.group(1)) if match else None
+
+
+class VideoConversion(models.Model):
+    """ Ход и результат конвертации видео в DASH.
+
+    Запись обновляется во время конвертации не чаще раза в DASH_PROGRESS_INTERVAL
+    секунд, поэтому по updated_at видно, идёт ли конвертация или зависла.
+    Если ffmpeg завершился с ошибкой, в error сохраняется конец его stderr.
+
+    При конвертации в celery запись создаётся при постановке видео в очередь,
+    task_id - задача, которую ждёт видео. По queued_at и started_at считается
+    время ожидания в очереди для каждого tier (см. queue_wait_stats).
+    """
+
+    STATE_QUEUED = 'queued'
+    STATE_PROGRESS = 'progress'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+    STATES = (
+        (STATE_QUEUED, 'в очереди'),
+        (STATE_PROGRESS, 'конвертируется'),
+        (STATE_DONE, 'готово'),
+        (STATE_FAILED, 'ошибка'),
+    )
+
+    TIER_PUBLISH = 'publish'
+    TIER_RETRANSCODE = 'retranscode'
+    TIERS = (
+        (TIER_PUBLISH, 'первая публикация'),
+        (TIER_RETRANSCODE, 'повторная конвертация'),
+    )
+
+    file_name = models.CharField('название файла', max_length=255, unique=True)
+    state = models.CharField('состояние', max_length=20, choices=STATES, default=STATE_PROGRESS)
+    stage = models.CharField('этап', max_length=20, blank=True)
+    percent = models.FloatField('процент этапа', default=0)
+    frame = models.PositiveIntegerField('закодировано кадров', default=0)
+    out_time = models.FloatField('закодировано секунд', default=0)
+    speed = models.FloatField('скорость', default=0)
+    eta = models.FloatField('осталось секунд', null=True, blank=True)
+    error = models.TextField('ошибка', blank=True)
+
+    tier = models.CharField('вид конвертации', max_length=20, choices=TIERS, default=TIER_PUBLISH)
+    queue = models.CharField('очередь celery', max_length=255, blank=True)
+    priority = models.PositiveSmallIntegerField('приоритет', default=0)
+    task_priority = models.PositiveSmallIntegerField('приоритет с учётом ожидания', default=0)
+    task_id = models.CharField('задача celery', max_length=255, blank=True)
+    # анализ видео (VideoProbe.as_dict) в json, передаётся и в задачу с повышенным приоритетом
+    probe = models.TextField('анализ видео', blank=True)
+
+    queued_at = models.DateTimeField('дата постановки в очередь', null=True, blank=True)
+    started_at = models.DateTimeField('дата начала', null=True, blank=True)
+    updated_at = models.DateTimeField('дата обновления', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Конвертация видео'
+        verbose_name_plural = 'Конвертации видео'
+        ordering = ['-queued_at']
+
+    def __str__(self):
+        return self.file_name
+
+    @classmethod
+    def enqueue(cls, file_name: str, task_id: str, queue: str, tier: str, priority: int,
+                probe: dict = None) -> 'VideoConversion':
+        """ставит видео в очередь конвертации, предыдущий результат сбрасывается
+
+        :param probe: анализ видео (VideoProbe.as_dict), с которым отправлена задача
+        """
+
+        conversion, _ = cls.objects.update_or_create(file_name=file_name, defaults=dict(
+            cls._initial_progress(),
+            state=cls.STATE_QUEUED,
+            tier=tier,
+            queue=queue,
+            priority=priority,
+            task_priority=priority,
+            task_id=task_id,
+            probe=json.dumps(probe) if probe else '',
+            queued_at=timezone.now(),
+            started_at=None,
+        ))
+        return conversion
+
+    @classmethod
+    def start(cls, file_name: str, task_id: str = ''):
+        """начинает конвертацию видео, предыдущий результат сбрасывается
+
+        Задача celery начинает конвертацию, только если видео ждёт именно её:
+        после повышения приоритета в очереди остаётся сообщение прежней задачи
+        (см. replace_task). Задача, которую брокер отдал повторно после падения
+        воркера, начинает конвертацию заново, но только если ход конвертации
+        не обновлялся DASH_STALE_CONVERSION_TIMEOUT секунд. Иначе конвертация
+        ещё идёт, а задача отдана повторно по visibility_timeout брокера.
+
+        :return: VideoConversion или None, если задача устарела или уже выполняется
+        """
+
+        now = timezone.now()
+        if task_id:
+            stale_before = now - datetime.timedelta(seconds=settings.DASH_STALE_CONVERSION_TIMEOUT)
+            # условное обновление не даёт одновременно начать конвертацию и заменить задачу
+            started = cls.objects.filter(file_name=file_name, task_id=task_id) \
+                .exclude(state=cls.STATE_PROGRESS, updated_at__gt=stale_before) \
+                .update(state=cls.STATE_PROGRESS, started_at=now, updated_at=now, **cls._initial_progress())
+            if started:
+                return cls.objects.get(file_name=file_name)
+            if cls.objects.filter(file_name=file_name).exclude(task_id='').exists():
+                return None
+
+        conversion, _ = cls.objects.update_or_create(file_name=file_name, defaults=dict(
+            cls._initial_progress(),
+            state=cls.STATE_PROGRESS,
+            task_id=task_id,
+            queued_at=now,
+            started_at=now,
+        ))
+        return conversion
+
+    @classmethod
+    def is_active(cls, file_name: str) -> bool:
+        """ждёт ли видео в очереди конвертации или уже конвертируется"""
+        return cls.objects.filter(file_name=file_name, state__in=[cls.STATE_QUEUED, cls.STATE_PROGRESS]).exists()
+
+    @staticmethod
+    def _initial_progress() -> dict:
+        return {
+            'stage': '',
+            'percent': 0,
+            'frame': 0,
+            'out_time': 0,
+            'speed': 0,
+            'eta': None,
+            'error': '',
+        }
+
+    def get_probe(self):
+        """анализ видео (VideoProbe.as_dict), сохранённый при постановке в очередь, или None"""
+        return json.loads(self.probe) if self.probe else None
+
+    def replace_task(self, task_id: str, task_priority: int) -> bool:
+        """заменяет задачу, которую ждёт видео в очереди, например, задачей с более высоким приоритетом
+
+        :return: False, если видео уже не ждёт прежнюю задачу (конвертация началась)
+        """
+
+        replaced = VideoConversion.objects.filter(
+            pk=self.pk, state=self.STATE_QUEUED, task_id=self.task_id,
+        ).update(task_id=task_id, task_priority=task_priority, updated_at=timezone.now())
+        if replaced:
+            self.task_id = task_id
+            self.task_priority = task_priority
+        return bool(replaced)
+
+    def set_progress(self, progress: dict) -> bool:
+        """сохраняет ход конвертации из FfmpegProgress
+
+        Как и set_done и set_failed, обновляет строку запросом UPDATE, который
+        ничего не делает, если видео удалили во время конвертации (см. FieldVideo.delete).
+
+        :return: False, если строки конвертации уже нет
+        """
+
+        self.stage = progress['stage'] or ''
+        self.percent = progress['percent']
+        self.frame = progress['frame']
+        self.out_time = progress['out_time']
+        self.speed = progress['speed']
+        self.eta = progress['eta']
+        return self._update('stage', 'percent', 'frame', 'out_time', 'speed', 'eta')
+
+    def set_done(self) -> bool:
+        self.state = self.STATE_DONE
+        self.percent = 100
+        self.eta = None
+        return self._update('state', 'percent', 'eta')
+
+    def set_failed(self, error: str) -> bool:
+        self.state = self.STATE_FAILED
+        self.error = error
+        return self._update('state', 'error')
+
+    def _update(self, *fields) -> bool:
+        self.updated_at = timezone.now()
+        values = {field: getattr(self, field) for field in fields + ('updated_at',)}
+        return bool(VideoConversion.objects.filter(pk=self.pk).update(**values))
+
+    @property
+    def queue_wait(self):
+        """сколько секунд видео ждало в очереди или None, если конвертация не начиналась"""
+
+        if self.queued_at is None or self.started_at is None:
+            return None
+        return (self.started_at - self.queued_at).total_seconds()
+
+    @classmethod
+    def queue_wait_stats(cls, since) -> dict:
+        """время ожидания в очереди в секундах для каждого tier по конвертациям,
+        начатым после since, и сколько видео ждут в очереди сейчас"""
+
+        stats = {}
+        for tier, _ in cls.TIERS:
+            conversions = cls.objects.filter(tier=tier, started_at__gte=since, queued_at__isnull=False)
+            waits = sorted((started_at - queued_at).total_seconds()
+                           for queued_at, started_at in conversions.values_list('queued_at', 'started_at'))
+            stats[tier] = {
+                'started': len(waits),
+                'waiting': cls.objects.filter(tier=tier, state=cls.STATE_QUEUED).count(),
+                'wait_mean': round(sum(waits) / len(waits), 3) if waits else None,
+                'wait_median': _percentile(waits, 50),
+                'wait_p95': _percentile(waits, 95),
+                'wait_max': round(waits[-1], 3) if waits else None,
+            }
+        return stats
+
+
+def _percentile(values: list, percent: int):
+    """перцентиль отсортированного списка по ближайшему рангу"""
+
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * percent // 100))
+    return round(values[rank - 1], 3)
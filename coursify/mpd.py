@@ -0,0 +1,251 @@
+import math
+import posixpath
+import re
+import struct
+import xml.etree.ElementTree as ElementTree
+
+MPD_NAMESPACE = 'urn:mpeg:dash:schema:mpd:2011'
+
+# профиль манифеста, в котором каждый поток - один файл с индексом сегментов (SegmentBase)
+ON_DEMAND_PROFILE = 'urn:mpeg:dash:profile:isoff-on-demand:2011'
+
+# чтобы при сохранении манифеста префиксы пространств имён остались прежними
+ElementTree.register_namespace('', MPD_NAMESPACE)
+ElementTree.register_namespace('xsi', 'http://www.w3.org/2001/XMLSchema-instance')
+ElementTree.register_namespace('xlink', 'http://www.w3.org/1999/xlink')
+
+# $RepresentationID$, $Number%05d$ и т.п. из SegmentTemplate
+TEMPLATE_IDENTIFIER = re.compile(r'\$(RepresentationID|Number|Bandwidth|Time)(%0(\d+)d)?\$')
+
+# PT1H2M3.5S
+ISO_DURATION = re.compile(r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$')
+
+
+class MpdManifest:
+    """ Разбор mpd манифеста DASH.
+
+    Манифест - единственный полный список файлов видео: по SegmentTemplate
+    и SegmentTimeline каждого потока можно точно восстановить названия
+    init файлов и всех сегментов, не обращаясь к storage.
+    """
+
+    def __init__(self, root: ElementTree.Element):
+        self.root = root
+
+    @classmethod
+    def from_string(cls, content) -> 'MpdManifest':
+        """:raises ValueError: если это не mpd манифест"""
+        try:
+            root = ElementTree.fromstring(content)
+        except ElementTree.ParseError as error:
+            raise ValueError(f"Cannot parse mpd manifest: {error}")
+
+        if root.tag != cls._tag('MPD'):
+            raise ValueError(f"Unexpected root element of mpd manifest: {root.tag}")
+        return cls(root)
+
+    def to_string(self) -> bytes:
+        return ElementTree.tostring(self.root, encoding='utf-8', xml_declaration=True)
+
+    @property
+    def duration(self) -> float:
+        """длительность видео в секундах"""
+        return parse_iso_duration(self.root.get('mediaPresentationDuration'))
+
+    def representations(self):
+        """возвращает пары (AdaptationSet, Representation) всех потоков"""
+        for period in self.root.iter(self._tag('Period')):
+            for adaptation_set in period.iter(self._tag('AdaptationSet')):
+                for representation in adaptation_set.iter(self._tag('Representation')):
+                    yield adaptation_set, representation
+
+    def file_names(self, directory: str = '') -> list:
+        """названия init файлов и сегментов всех потоков
+
+        :param directory: директория манифеста, названия в манифесте указаны относительно неё
+        """
+        names = []
+        for adaptation_set, representation in self.representations():
+            names += self.representation_file_names(adaptation_set, representation)
+        return [posixpath.join(directory, name) for name in names]
+
+    def representation_file_names(self, adaptation_set, representation) -> list:
+        """названия init файла и сегментов одного потока"""
+
+        template = representation.find(self._tag('SegmentTemplate'))
+        if template is None:
+            template = adaptation_set.find(self._tag('SegmentTemplate'))
+
+        if template is None:
+            base_url = representation.find(self._tag('BaseURL'))
+            return [base_url.text.strip()] if base_url is not None else []
+
+        values = {
+            'RepresentationID': representation.get('id'),
+            'Bandwidth': representation.get('bandwidth'),
+        }
+
+        names = []
+        initialization = template.get('initialization')
+        if initialization:
+            names.append(self._fill_template(initialization, values))
+
+        media = template.get('media')
+        if media:
+            number = int(template.get('startNumber', 1))
+            for time in self._segment_times(template):
+                names.append(self._fill_template(media, dict(values, Number=number, Time=time)))
+                number += 1
+        return names
+
+    def video_representations(self):
+        """возвращает пары (AdaptationSet, Representation) видео потоков"""
+        for adaptation_set, representation in self.representations():
+            if adaptation_set.get('contentType') == 'video':
+                yield adaptation_set, representation
+
+    def max_representation_id(self) -> int:
+        """наибольший номер потока, номера потоков - это номера в названиях их файлов"""
+        return max((int(representation.get('id')) for _, representation in self.representations()),
+                   default=-1)
+
+    def add_video_representation(self, representation):
+        """добавляет видео поток из другого манифеста в adaptation set видео.
+
+        Потоки в adaptation set упорядочены по высоте, а maxWidth и maxHeight
+        расширяются до размеров нового потока. Сегменты нового потока
+        должны начинаться в те же моменты, что и у остальных потоков."""
+
+        adaptation_set = next(adaptation_set for adaptation_set, _ in self.video_representations())
+        representations = adaptation_set.findall(self._tag('Representation'))
+        height = int(representation.get('height', 0))
+        position = list(adaptation_set).index(representations[-1]) + 1
+        for existing in representations:
+            if int(existing.get('height', 0)) > height:
+                position = list(adaptation_set).index(existing)
+                break
+        adaptation_set.insert(position, representation)
+
+        for dimension in ('Width', 'Height'):
+            value = representation.get(dimension.lower())
+            max_value = adaptation_set.get(f'max{dimension}')
+            if value is not None and max_value is not None and int(value) > int(max_value):
+                adaptation_set.set(f'max{dimension}', value)
+
+    def get_property(self, scheme_id: str):
+        """значение SupplementalProperty adaptation set видео со схемой scheme_id или None"""
+
+        for adaptation_set, _ in self.video_representations():
+            for prop in adaptation_set.findall(self._tag('SupplementalProperty')):
+                if prop.get('schemeIdUri') == scheme_id:
+                    return prop.get('value')
+            return None
+        return None
+
+    def set_property(self, scheme_id: str, value: str):
+        """записывает SupplementalProperty в adaptation set видео. Плееры
+        пропускают свойства с неизвестными им схемами"""
+
+        adaptation_set = next(adaptation_set for adaptation_set, _ in self.video_representations())
+        for prop in adaptation_set.findall(self._tag('SupplementalProperty')):
+            if prop.get('schemeIdUri') == scheme_id:
+                prop.set('value', value)
+                return
+        # по схеме mpd свойства идут перед описаниями потоков
+        prop = ElementTree.Element(self._tag('SupplementalProperty'), {'schemeIdUri': scheme_id, 'value': value})
+        adaptation_set.insert(0, prop)
+
+    def set_segment_base(self, representation, index_range: tuple):
+        """заменяет список сегментов потока, хранящегося одним файлом, на SegmentBase
+
+        Плеер сначала запрашивает из файла диапазон байт с индексом сегментов
+        (sidx), а затем сами сегменты по диапазонам байт из индекса.
+        Init часть файла - всё, что идёт до индекса.
+
+        :param index_range: первый и последний байт sidx в файле потока
+        """
+
+        for segment_list in representation.findall(self._tag('SegmentList')):
+            representation.remove(segment_list)
+
+        index_start, index_end = index_range
+        segment_base = ElementTree.SubElement(
+            representation,
+            self._tag('SegmentBase'),
+            {'indexRange': f'{index_start}-{index_end}'})
+        ElementTree.SubElement(
+            segment_base,
+            self._tag('Initialization'),
+            {'range': f'0-{index_start - 1}'})
+        self.root.set('profiles', ON_DEMAND_PROFILE)
+
+    def _segment_times(self, template) -> list:
+        """времена начала всех сегментов потока в единицах timescale"""
+
+        timeline = template.find(self._tag('SegmentTimeline'))
+        if timeline is not None:
+            times = []
+            time = 0
+            for segment in timeline.iter(self._tag('S')):
+                time = int(segment.get('t', time))
+                duration = int(segment.get('d'))
+                for _ in range(int(segment.get('r', 0)) + 1):
+                    times.append(time)
+                    time += duration
+            return times
+
+        duration = int(template.get('duration', 0))
+        if not duration:
+            return []
+        timescale = int(template.get('timescale', 1))
+        count = math.ceil(self.duration * timescale / duration)
+        return [index * duration for index in range(count)]
+
+    @staticmethod
+    def _fill_template(template: str, values: dict) -> str:
+        def replace(match):
+            value = values[match.group(1)]
+            if match.group(3):
+                return str(value).zfill(int(match.group(3)))
+            return str(value)
+
+        return TEMPLATE_IDENTIFIER.sub(replace, template).replace('$$', '$')
+
+    @staticmethod
+    def _tag(name: str) -> str:
+        return f'{{{MPD_NAMESPACE}}}{name}'
+
+
+def parse_iso_duration(duration: str) -> float:
+    """переводит длительность в формате ISO 8601 (PT8.0S) в секунды"""
+
+    match = ISO_DURATION.match(duration or '')
+    if match is None:
+        return 0.0
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 \
+        + int(minutes or 0) * 60 + float(seconds or 0)
+
+
+def find_index_range(source) -> tuple:
+    """ищет в mp4 файле индекс сегментов (блок sidx)
+
+    :param source: файл, открытый на чтение с начала
+    :return: первый и последний байт блока sidx
+    :raises ValueError: если в файле нет sidx
+    """
+
+    position = 0
+    header = source.read(8)
+    while len(header) == 8:
+        size, box_type = struct.unpack('>I4s', header)
+        if size == 1:
+            size = struct.unpack('>Q', source.read(8))[0]
+        if box_type == b'sidx':
+            return position, position + size - 1
+        if size < 8:
+            break
+        position += size
+        source.seek(position)
+        header = source.read(8)
+    raise ValueError("Cannot find sidx box in mp4 file")
@@ -0,0 +1,176 @@
+import json
+import shutil
+import subprocess
+import tempfile
+from fractions import Fraction
+
+from django.core.files.storage import Storage
+
+from .source import PIPE_SOURCE, run_with_source
+
+
+class VideoProbe:
+    """ Параметры видео файла, полученные одним запуском ffprobe.
+
+    Видео анализируется один раз при загрузке (в VideoFormField)
+    и дальше передаётся в DashVideoManager, в том числе в celery задачу
+    через as_dict/from_dict, чтобы не запускать ffprobe повторно.
+
+    Ширина и высота указаны с учётом поворота видео, т.е. так,
+    как видео будет показано плеером.
+    """
+
+    # кодеки изображений, ffmpeg открывает их как видео поток из одного кадра
+    IMAGE_CODECS = ('png', 'bmp', 'gif', 'tiff', 'webp', 'jpeg2000', 'mjpeg')
+
+    # ffprobe читает только начало файла, дольше он работает только на испорченных файлах
+    TIMEOUT = 60
+
+    FIELDS = ('width', 'height', 'duration', 'fps', 'video_codec',
+              'audio_codec', 'bit_rate', 'has_audio')
+
+    def __init__(self, width: int = 0, height: int = 0, duration: float = 0.0,
+                 fps: float = 0.0, video_codec: str = None, audio_codec: str = None,
+                 bit_rate: int = 0, has_audio: bool = False):
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.fps = fps
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.bit_rate = bit_rate
+        self.has_audio = has_audio
+
+    @classmethod
+    def from_file(cls, file_path: str) -> 'VideoProbe':
+        """запускает ffprobe для файла и разбирает его вывод
+
+        :raises ValueError: если ffprobe не смог открыть файл или не успел за TIMEOUT секунд
+        """
+
+        try:
+            result = subprocess.run(cls._ffprobe_command(file_path),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    universal_newlines=True,
+                                    timeout=cls.TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise ValueError(f"Cannot probe video file: ffprobe timed out after {cls.TIMEOUT} seconds")
+        return cls._from_ffprobe_result(result)
+
+    @classmethod
+    def from_stream(cls, stream) -> 'VideoProbe':
+        """анализирует видео, передавая его в ffprobe через stdin
+
+        :raises ValueError: если ffprobe не смог прочитать видео
+        """
+        try:
+            result = run_with_source(cls._ffprobe_command(PIPE_SOURCE), stream, timeout=cls.TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise ValueError(f"Cannot probe video file: ffprobe timed out after {cls.TIMEOUT} seconds")
+        return cls._from_ffprobe_result(result)
+
+    @classmethod
+    def from_storage(cls, storage: Storage, file_name: str) -> 'VideoProbe':
+        """анализирует файл из storage. Если storage хранит файлы
+        не в файловой системе текущего хоста, файл сначала копируется во временный"""
+
+        try:
+            return cls.from_file(storage.path(file_name))
+        except NotImplementedError:
+            pass
+
+        with tempfile.NamedTemporaryFile() as temp_file, storage.open(file_name, "rb") as video_file:
+            shutil.copyfileobj(video_file, temp_file)
+            temp_file.flush()
+            return cls.from_file(temp_file.name)
+
+    @classmethod
+    def from_ffprobe_output(cls, output: dict) -> 'VideoProbe':
+        """создаёт объект из json вывода ffprobe -show_format -show_streams"""
+
+        streams = output.get('streams', [])
+        video = cls._first_stream(streams, 'video')
+        audio = cls._first_stream(streams, 'audio')
+        video_format = output.get('format', {})
+
+        probe = cls(
+            duration=float(video_format.get('duration') or 0),
+            bit_rate=int(video_format.get('bit_rate') or 0),
+            has_audio=audio is not None,
+            audio_codec=audio and audio.get('codec_name'),
+        )
+
+        if video is not None:
+            probe.video_codec = video.get('codec_name')
+            probe.width = int(video.get('width') or 0)
+            probe.height = int(video.get('height') or 0)
+            probe.fps = cls._parse_frame_rate(video.get('avg_frame_rate')) \
+                or cls._parse_frame_rate(video.get('r_frame_rate'))
+            if cls._get_rotation(video) % 180 == 90:
+                probe.width, probe.height = probe.height, probe.width
+
+        return probe
+
+    @classmethod
+    def _from_ffprobe_result(cls, result: subprocess.CompletedProcess) -> 'VideoProbe':
+        if not result.returncode == 0:
+            raise ValueError(f"Cannot probe video file: {result.stderr.strip()}")
+
+        return cls.from_ffprobe_output(json.loads(result.stdout))
+
+    @staticmethod
+    def _ffprobe_command(file_path: str) -> list:
+        return [
+            'ffprobe',
+            '-v', 'error',
+            '-print_format', 'json',
+            '-show_format',
+            '-show_streams',
+            file_path
+        ]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'VideoProbe':
+        return cls(**{field: data[field] for field in cls.FIELDS if field in data})
+
+    def as_dict(self) -> dict:
+        """сериализуемое в json представление для передачи в celery задачу"""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def is_video(self) -> bool:
+        """есть ли в файле видео поток, который не является изображением"""
+        return self.video_codec is not None \
+            and self.video_codec not in self.IMAGE_CODECS \
+            and self.height > 0 \
+            and self.duration > 0
+
+    @staticmethod
+    def _first_stream(streams: list, codec_type: str):
+        for stream in streams:
+            if stream.get('codec_type') != codec_type:
+                continue
+            # обложки в mp4/mp3 тоже являются видео потоками
+            if stream.get('disposition', {}).get('attached_pic'):
+                continue
+            return stream
+        return None
+
+    @staticmethod
+    def _parse_frame_rate(frame_rate: str) -> float:
+        try:
+            return float(Fraction(frame_rate))
+        except (TypeError, ValueError, ZeroDivisionError):
+            return 0.0
+
+    @staticmethod
+    def _get_rotation(stream: dict) -> int:
+        rotation = stream.get('tags', {}).get('rotate')
+        for side_data in stream.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = side_data['rotation']
+        try:
+            return abs(int(float(rotation or 0)))
+        except ValueError:
+            return 0
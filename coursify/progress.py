@@ -0,0 +1,118 @@
+import threading
+import time
+
+
+class FfmpegProgress:
+    """ Ход конвертации по выводу ffmpeg -progress.
+
+    ffmpeg, запущенный с -progress pipe:1, пишет в stdout блоки строк key=value,
+    каждый блок заканчивается строкой progress=continue или progress=end.
+    Процессов ffmpeg может быть несколько (параллельные задания), их ход
+    суммируется: out_time - сколько секунд видео уже закодировали все процессы,
+    speed - во сколько раз быстрее реального времени они кодируют вместе.
+
+    Вывод процессов разбирается в потоках, которые их ждут, а сообщает о ходе
+    только поток, создавший объект, и не чаще раза в interval секунд:
+    функция report обычно пишет в базу данных и в backend celery.
+    """
+
+    def __init__(self, report, interval: float = 2.0):
+        """
+        :param report: функция, которой передаётся словарь с ходом конвертации (см. snapshot)
+        :param interval: минимальный интервал между сообщениями в секундах
+        """
+        self.report = report
+        self.interval = interval
+        self.stage = None
+        self._processes = []
+        self._lock = threading.Lock()
+        self._owner = threading.get_ident()
+        self._reported_at = None
+
+    def start_stage(self, stage: str):
+        """начинает новый этап конвертации, ход этапа считается с нуля"""
+
+        with self._lock:
+            self.stage = stage
+            self._processes = []
+        self.report_if_due(force=True)
+
+    def read(self, output, duration: float):
+        """разбирает вывод -progress одного процесса до его завершения
+
+        :param output: stdout процесса в текстовом режиме
+        :param duration: сколько секунд видео кодирует процесс
+        """
+
+        process = {'frame': 0, 'out_time': 0.0, 'speed': 0.0, 'duration': duration}
+        with self._lock:
+            self._processes.append(process)
+
+        values = {}
+        for line in output:
+            name, _, value = line.strip().partition('=')
+            values[name] = value.strip()
+            if name != 'progress':
+                continue
+
+            with self._lock:
+                process['frame'] = _parse_int(values.get('frame'), process['frame'])
+                out_time = _parse_int(values.get('out_time_us'), 0) / 1000000
+                if out_time > 0:
+                    process['out_time'] = out_time
+                process['speed'] = _parse_speed(values.get('speed'))
+                if value == 'end':
+                    process['out_time'] = duration
+                    process['speed'] = 0.0
+            values = {}
+            # о завершении процесса сообщается сразу
+            self.report_if_due(force=value == 'end')
+
+    def snapshot(self) -> dict:
+        """суммарный ход всех процессов текущего этапа
+
+        eta - сколько секунд осталось до конца этапа при текущей скорости
+        или None, если скорость ещё неизвестна."""
+
+        with self._lock:
+            processes = [dict(process) for process in self._processes]
+
+        duration = sum(process['duration'] for process in processes)
+        out_time = sum(min(process['out_time'], process['duration']) for process in processes)
+        speed = sum(process['speed'] for process in processes)
+        return {
+            'stage': self.stage,
+            'frame': sum(process['frame'] for process in processes),
+            'out_time': round(out_time, 3),
+            'speed': round(speed, 3),
+            'eta': round((duration - out_time) / speed, 1) if speed else None,
+            'percent': round(out_time / duration * 100, 1) if duration else 0.0,
+        }
+
+    def report_if_due(self, force: bool = False):
+        """сообщает о ходе, если с прошлого сообщения прошло interval секунд.
+        Из потоков, кроме создавшего объект, не сообщает"""
+
+        if threading.get_ident() != self._owner:
+            return
+
+        now = time.monotonic()
+        if not force and self._reported_at is not None and now - self._reported_at < self.interval:
+            return
+        self._reported_at = now
+        self.report(self.snapshot())
+
+
+def _parse_int(value, default: int) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _parse_speed(value) -> float:
+    """скорость кодирования вида 2.88x, N/A - неизвестна"""
+    try:
+        return float((value or '').rstrip('x'))
+    except ValueError:
+        return 0.0
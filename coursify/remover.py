@@ -0,0 +1,43 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class StorageRemover:
+    """ Параллельно удаляет файлы из storage.
+
+    Файлы делятся на пачки, пачки удаляются одновременно в пуле потоков
+    ограниченного размера. Для удалённого storage удаление файла - это
+    в основном ожидание сети, поэтому потоков может быть больше, чем ядер.
+    """
+
+    def __init__(self, storage: Storage, concurrency: int = 8, batch_size: int = 100):
+        """
+        :param storage: storage, из которого удаляются файлы
+        :param concurrency: сколько пачек удаляется одновременно
+        :param batch_size: количество файлов в одной пачке
+        """
+        self.storage = storage
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+
+    def delete(self, names: list):
+        """удаляет файлы и дожидается окончания удаления"""
+
+        batches = [names[index:index + self.batch_size]
+                   for index in range(0, len(names), self.batch_size)]
+        if not batches:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+            for _ in executor.map(self._delete_batch, batches):
+                pass
+
+        logger.info('Deleted %d files', len(names))
+
+    def _delete_batch(self, names: list):
+        for name in names:
+            self.storage.delete(name)
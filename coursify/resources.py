@@ -0,0 +1,63 @@
+import math
+import os
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def available_cpus(cgroup_root: str = CGROUP_ROOT) -> int:
+    """ Сколько ядер процессора доступно процессу.
+
+    os.cpu_count() возвращает все ядра машины, а в контейнере процесс
+    может быть привязан к части ядер (docker --cpuset-cpus) или ограничен
+    квотой cgroup (docker --cpus). Учитываются оба ограничения, квота
+    округляется вверх.
+
+    Модуль не зависит от django, так как используется в settings.
+    """
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = _cgroup_cpu_quota(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+
+def _cgroup_cpu_quota(cgroup_root: str):
+    """квота процессора cgroup в ядрах или None, если квоты нет"""
+
+    # cgroup v2: "квота период" или "max период"
+    cpu_max = _read_file(os.path.join(cgroup_root, 'cpu.max'))
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(' ')
+        if quota == 'max':
+            return None
+        return _quota_cpus(quota, period)
+
+    # cgroup v1: квота -1 означает, что её нет
+    quota = _read_file(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read_file(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us'))
+    if quota is None or period is None:
+        return None
+    return _quota_cpus(quota, period)
+
+
+def _quota_cpus(quota: str, period: str):
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def _read_file(path: str):
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except OSError:
+        return None
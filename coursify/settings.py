@@ -14,6 +14,8 @@ import os
 import socket
 import dj_database_url
 
+from coursify.resources import available_cpus
+
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -40,6 +42,7 @@ INSTALLED_APPS = [
     # Locale apps
     'admin',
     'courses',
+    'coursify',
 
 
     # Third party apps
@@ -152,6 +155,12 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'coursify/static')]
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Обработчики загрузки считают sha256 файла во время загрузки (см. DASH_DEDUPLICATE_UPLOADS)
+FILE_UPLOAD_HANDLERS = [
+    'coursify.uploadhandlers.ContentDigestMemoryFileUploadHandler',
+    'coursify.uploadhandlers.ContentDigestTemporaryFileUploadHandler',
+]
+
 # Sites
 # https://docs.djangoproject.com/en/2.1/ref/contrib/sites/#enabling-the-sites-framework
 
@@ -164,4 +173,140 @@ SITE_DOMAIN = os.environ.get('SITE_DOMAIN', None)
 
 DASH_RUN_CONVERTATION_AT_ASYNC = os.environ.get('DASH_RUN_CONVERTATION_AT_ASYNC', False)
 
+# Лестница разрешений: высота:битрейт:профиль h264 через запятую. Уже сконвертированным видео
+# недостающие разрешения добавляются командой update_dash_ladder
+DASH_LADDER = os.environ.get('DASH_LADDER', '360:450k:baseline,480:700k:main,720:1800k:main,1080:5000k:high')
+
+# Подбирать битрейты и количество разрешений лестницы для каждого видео по его сложности,
+# которую показывает пробное кодирование отрезков видео с постоянным качеством DASH_ADAPTIVE_CRF
+DASH_ADAPTIVE_LADDER = os.environ.get('DASH_ADAPTIVE_LADDER', False)
+DASH_ADAPTIVE_CRF = int(os.environ.get('DASH_ADAPTIVE_CRF', 23))
+DASH_ADAPTIVE_SAMPLES = int(os.environ.get('DASH_ADAPTIVE_SAMPLES', 6))
+
+# Во сколько раз битрейт разрешения может быть меньше и больше, чем в DASH_LADDER
+DASH_ADAPTIVE_MIN_FACTOR = float(os.environ.get('DASH_ADAPTIVE_MIN_FACTOR', 0.1))
+DASH_ADAPTIVE_MAX_FACTOR = float(os.environ.get('DASH_ADAPTIVE_MAX_FACTOR', 1.5))
+
+# Кодировать каждое разрешение отдельным процессом ffmpeg
+DASH_PARALLEL_RENDITIONS = os.environ.get('DASH_PARALLEL_RENDITIONS', False)
+
+# Очередь celery для конвертации видео и очередь для видео от DASH_HEAVY_HEIGHT,
+# которые занимают много памяти и обрабатываются воркером с одним процессом
+DASH_QUEUE = os.environ.get('DASH_QUEUE', 'transcoding')
+DASH_HEAVY_QUEUE = os.environ.get('DASH_HEAVY_QUEUE', 'transcoding-heavy')
+DASH_HEAVY_HEIGHT = int(os.environ.get('DASH_HEAVY_HEIGHT', 1080))
+
+# Приоритет конвертации в очереди по ожидаемой длительности кодирования (секунды видео 720p):
+# до первой границы - уровень 0 (самый высокий), до второй - 1 и т.д.
+DASH_PRIORITY_STEPS = [int(step) for step in os.environ.get('DASH_PRIORITY_STEPS', '300,1200,3600,10800').split(',')]
+
+# Через сколько секунд ожидания в очереди приоритет конвертации повышается на уровень, 0 - не повышать
+DASH_PRIORITY_AGING = int(os.environ.get('DASH_PRIORITY_AGING', 600))
+
+# Количество ядер процессора, доступных конвертации, по умолчанию с учётом квоты cgroup контейнера
+DASH_AVAILABLE_CPUS = int(os.environ.get('DASH_AVAILABLE_CPUS', 0)) or available_cpus()
+
+# Сколько видео одновременно конвертирует воркер очереди конвертации, по умолчанию одно на 4 ядра
+DASH_WORKER_CONCURRENCY = int(os.environ.get('DASH_WORKER_CONCURRENCY', 0)) \
+    or max(1, DASH_AVAILABLE_CPUS // 4)
+
+# Количество ядер процессора, которое может занять одна конвертация видео,
+# по умолчанию доступные ядра делятся поровну между одновременными конвертациями
+DASH_CPU_BUDGET = int(os.environ.get('DASH_CPU_BUDGET', 0)) \
+    or max(1, DASH_AVAILABLE_CPUS // DASH_WORKER_CONCURRENCY)
+
+# Приоритет (nice) процессов ffmpeg, чтобы конвертация не замедляла веб-сервер, 0 - не менять
+DASH_NICENESS = int(os.environ.get('DASH_NICENESS', 10))
+
+# Во сколько раз процесс ffmpeg может работать дольше длительности видео, которое он
+# обрабатывает (плюс минута), прежде чем его прервут, 0 - без ограничения
+DASH_FFMPEG_TIMEOUT = float(os.environ.get('DASH_FFMPEG_TIMEOUT', 10))
+
+# Длительность самого длинного видео в секундах, на которую рассчитано время конвертации
+DASH_MAX_VIDEO_DURATION = float(os.environ.get('DASH_MAX_VIDEO_DURATION', 4 * 3600))
+
+# Через сколько секунд redis отдаёт другому воркеру неподтверждённую задачу (acks_late).
+# Должно быть больше самой долгой конвертации, иначе идущая конвертация начнётся второй раз:
+# по умолчанию DASH_FFMPEG_TIMEOUT (без ограничения - 10) длительностей самого длинного видео и час
+DASH_VISIBILITY_TIMEOUT = int(os.environ.get('DASH_VISIBILITY_TIMEOUT', 0)) \
+    or int(DASH_MAX_VIDEO_DURATION * (DASH_FFMPEG_TIMEOUT or 10)) + 3600
+
+# Через сколько секунд без обновления хода конвертация считается прерванной: задача,
+# которую брокер отдал повторно, начинает её заново, только если ход давно не обновлялся
+DASH_STALE_CONVERSION_TIMEOUT = int(os.environ.get('DASH_STALE_CONVERSION_TIMEOUT', 1800))
+
+# Количество потоков одного процесса ffmpeg, 0 - поделить DASH_CPU_BUDGET поровну
+DASH_THREADS_PER_JOB = int(os.environ.get('DASH_THREADS_PER_JOB', 0))
+
+# На сколько отрезков по времени делить видео для параллельного кодирования, 0 - не делить
+DASH_TIME_SLICES = int(os.environ.get('DASH_TIME_SLICES', 0))
+
+# Сохранять готовые сегменты в storage, пока ffmpeg ещё кодирует видео
+DASH_STREAM_UPLOAD = os.environ.get('DASH_STREAM_UPLOAD', False)
+
+# Хранить каждый поток одним файлом, плеер запрашивает сегменты по диапазонам байт
+DASH_SINGLE_FILE = os.environ.get('DASH_SINGLE_FILE', False)
 
+# Создавать рядом с mpd манифестом плейлисты HLS, которые ссылаются на те же сегменты
+DASH_HLS_PLAYLIST = os.environ.get('DASH_HLS_PLAYLIST', False)
+
+# Сначала публиковать самое маленькое разрешение с аудио, а остальные добавлять по мере кодирования
+DASH_PROGRESSIVE_PUBLISH = os.environ.get('DASH_PROGRESSIVE_PUBLISH', False)
+
+# Не сохранять и не конвертировать повторно видео, которое уже было загружено
+DASH_DEDUPLICATE_UPLOADS = os.environ.get('DASH_DEDUPLICATE_UPLOADS', False)
+
+# Постоянная директория для промежуточных файлов конвертации, чтобы прерванная конвертация
+# продолжалась с места остановки, пусто - промежуточные файлы во временной директории
+DASH_CHECKPOINT_DIR = os.environ.get('DASH_CHECKPOINT_DIR', '')
+
+# Передавать оригинал из удалённого storage в ffmpeg через stdin, не копируя его во временный файл
+DASH_PIPE_SOURCE = os.environ.get('DASH_PIPE_SOURCE', False)
+
+# Момент видео в секундах, кадр из которого используется как превью
+DASH_PREVIEW_TIME = float(os.environ.get('DASH_PREVIEW_TIME', 1))
+
+# Сколько вариантов превью создавать через равные промежутки видео, 0 - не создавать
+DASH_POSTER_CANDIDATES = int(os.environ.get('DASH_POSTER_CANDIDATES', 0))
+
+# Через сколько секунд брать миниатюры для перемотки, 0 - не создавать миниатюры
+DASH_THUMBNAILS_INTERVAL = int(os.environ.get('DASH_THUMBNAILS_INTERVAL', 5))
+
+# Ширина миниатюры для перемотки в пикселях
+DASH_THUMBNAILS_WIDTH = int(os.environ.get('DASH_THUMBNAILS_WIDTH', 160))
+
+# Как часто (в секундах) сохранять ход конвертации в VideoConversion и состояние задачи celery
+DASH_PROGRESS_INTERVAL = float(os.environ.get('DASH_PROGRESS_INTERVAL', 2))
+
+# Сколько файлов dash одновременно сохраняется в storage
+DASH_UPLOAD_CONCURRENCY = int(os.environ.get('DASH_UPLOAD_CONCURRENCY', 8))
+
+# Сколько раз повторять сохранение файла в storage после ошибки
+DASH_UPLOAD_RETRIES = int(os.environ.get('DASH_UPLOAD_RETRIES', 3))
+
+# Сколько пачек файлов dash одновременно удаляется из storage и размер пачки
+DASH_DELETE_CONCURRENCY = int(os.environ.get('DASH_DELETE_CONCURRENCY', 8))
+DASH_DELETE_BATCH_SIZE = int(os.environ.get('DASH_DELETE_BATCH_SIZE', 100))
+
+
+# Celery
+
+CELERY_TASK_ROUTES = {
+    'coursify.tasks.generate_dash_manifest': {'queue': DASH_QUEUE},
+    'coursify.tasks.update_dash_renditions': {'queue': DASH_QUEUE},
+}
+
+# Redis хранит сообщения каждого приоритета (0 - самый высокий) в отдельном списке
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+    'visibility_timeout': DASH_VISIBILITY_TIMEOUT,
+}
+
+CELERY_BEAT_SCHEDULE = {
+    'age-transcoding-queue': {
+        'task': 'coursify.tasks.age_transcoding_queue',
+        'schedule': 60.0,
+    },
+}
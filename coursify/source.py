@@ -0,0 +1,200 @@
+import collections
+import io
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+# ffmpeg и ffprobe читают файл из stdin по этому адресу
+PIPE_SOURCE = 'pipe:0'
+
+# сколько последних строк stderr процесса хранится в памяти
+STDERR_MAX_LINES = 200
+
+# как часто проверять, не пора ли прервать процесс, в секундах
+WATCH_INTERVAL = 0.2
+
+# сколько байт служебных блоков mp4 можно пропустить в поисках moov,
+# прежде чем решить, что файл нельзя читать последовательно
+MAX_MP4_HEADER_SIZE = 1024 * 1024
+
+
+def needs_seeking(source) -> bool:
+    """ Нужна ли перемотка для чтения видео, т.е. можно ли передать его ffmpeg через pipe.
+
+    ffmpeg не может прочитать из pipe mp4 (mov, m4v, 3gp), у которого
+    блок moov с описанием потоков записан после блока mdat с данными:
+    чтобы декодировать первый кадр, ему нужен конец файла. Остальные
+    контейнеры (webm, mkv, ts) и mp4 с moov в начале читаются последовательно.
+
+    :param source: файл, открытый на чтение с начала, читается только его начало
+    """
+
+    header = source.read(8)
+    if len(header) < 8 or header[4:8] != b'ftyp':
+        return False
+
+    skipped = 0
+    while len(header) == 8:
+        size, box_type = struct.unpack('>I4s', header)
+        if box_type == b'moov':
+            return False
+        if box_type == b'mdat':
+            return True
+
+        if size == 1:
+            size = struct.unpack('>Q', source.read(8))[0] - 8
+        elif size == 0:
+            # блок до конца файла, moov после него уже не встретится
+            return True
+        body_size = size - 8
+
+        skipped += body_size
+        if body_size < 0 or skipped > MAX_MP4_HEADER_SIZE:
+            return True
+        _skip(source, body_size)
+        header = source.read(8)
+    return True
+
+
+class ProcessCancelled(Exception):
+    """процесс прерван, т.к. установлено событие отмены (см. run_with_source)"""
+
+
+def run_with_source(command: list, source, read_output=None, timeout: float = None,
+                    cancel: threading.Event = None) -> subprocess.CompletedProcess:
+    """запускает процесс, передавая ему в stdin содержимое файла source
+
+    Процесс запускается списком аргументов без shell, поэтому названия файлов
+    с пробелами и кавычками передаются как есть. Файл читается по частям
+    в отдельном потоке, поэтому чтение (например, скачивание из удалённого
+    storage) идёт одновременно с работой процесса. Процесс может завершиться,
+    не дочитав файл (например, если ему нужен только первый кадр), это не
+    считается ошибкой.
+
+    stdout пишется во временный файл, а stderr читается отдельным потоком,
+    чтобы процесс не заблокировался на записи, пока его вывод никто не читает.
+    От stderr хранятся только последние STDERR_MAX_LINES строк: ffmpeg пишет
+    туда строку о ходе кодирования каждые полсекунды.
+
+    :param source: файл для stdin процесса или None, если stdin не нужен
+    :param read_output: функция, которая читает stdout процесса в текстовом режиме
+        до его завершения, например, ход конвертации ffmpeg. Тогда stdout
+        не попадает в результат
+    :param timeout: через сколько секунд процесс прерывается, None - без ограничения
+    :param cancel: событие, после установки которого процесс прерывается, например,
+        когда параллельное задание той же конвертации завершилось с ошибкой
+    :raises subprocess.TimeoutExpired: если процесс не завершился за timeout секунд
+    :raises ProcessCancelled: если процесс прерван событием cancel
+    """
+
+    if cancel is not None and cancel.is_set():
+        raise ProcessCancelled(command)
+
+    with tempfile.TemporaryFile() as stdout:
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE if source is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if read_output is not None else stdout,
+            stderr=subprocess.PIPE)
+
+        stderr = collections.deque(maxlen=STDERR_MAX_LINES)
+        threads = [threading.Thread(target=_read_stderr, args=(process.stderr, stderr), daemon=True)]
+        if source is not None:
+            threads.append(threading.Thread(target=_write_source, args=(source, process.stdin), daemon=True))
+        for thread in threads:
+            thread.start()
+        watchdog = None
+        if timeout is not None or cancel is not None:
+            watchdog = _ProcessWatchdog(process, timeout, cancel)
+            watchdog.start()
+
+        try:
+            if read_output is not None:
+                with io.TextIOWrapper(process.stdout, errors='replace') as output:
+                    read_output(output)
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            returncode = process.wait()
+            if watchdog is not None:
+                watchdog.stop()
+            for thread in threads:
+                thread.join()
+
+        stderr = ''.join(stderr)
+        if watchdog is not None and watchdog.reason == _ProcessWatchdog.TIMEOUT:
+            raise subprocess.TimeoutExpired(command, timeout, stderr=stderr)
+        if watchdog is not None and watchdog.reason == _ProcessWatchdog.CANCELLED:
+            raise ProcessCancelled(command)
+
+        stdout.seek(0)
+        return subprocess.CompletedProcess(
+            command,
+            returncode,
+            stdout.read().decode(errors='replace'),
+            stderr)
+
+
+class _ProcessWatchdog(threading.Thread):
+    """поток, который убивает процесс по истечении времени или по событию отмены"""
+
+    TIMEOUT = 'timeout'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, process: subprocess.Popen, timeout: float = None, cancel: threading.Event = None):
+        super().__init__(daemon=True)
+        self.process = process
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.cancel = cancel
+        # почему процесс убит или None, если он завершился сам
+        self.reason = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(WATCH_INTERVAL):
+            if self.cancel is not None and self.cancel.is_set():
+                reason = self.CANCELLED
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                reason = self.TIMEOUT
+            else:
+                continue
+            if self.process.poll() is None:
+                self.reason = reason
+                self.process.kill()
+            return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _read_stderr(stderr, lines: collections.deque):
+    with io.TextIOWrapper(stderr, errors='replace') as output:
+        for line in output:
+            lines.append(line)
+
+
+def _write_source(source, stdin):
+    try:
+        shutil.copyfileobj(source, stdin)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _skip(source, size: int):
+    """пропускает size байт файла, не требуя от него перемотки"""
+
+    while size > 0:
+        chunk = source.read(min(size, 64 * 1024))
+        if not chunk:
+            return
+        size -= len(chunk)
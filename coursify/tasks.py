@@ -1,10 +1,181 @@
+import bisect
+import logging
+import uuid
+
 from celery import shared_task
+from django.conf import settings
 from django.core.files.storage import default_storage
+from django.utils import timezone
 
 from .dash import DashVideoManager
+from .models import VideoConversion
+from .probe import VideoProbe
+from .progress import FfmpegProgress
+
+logger = logging.getLogger(__name__)
+
+# самый низкий приоритет сообщения (см. CELERY_BROKER_TRANSPORT_OPTIONS)
+LOWEST_PRIORITY = 9
+
+# разрешение, для которого ожидаемая длительность кодирования равна длительности видео
+REFERENCE_PIXELS = 1280 * 720
+
+
+# задача подтверждается после выполнения: если воркер упал посреди конвертации,
+# брокер отдаст видео другому воркеру, а не потеряет его
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def generate_dash_manifest(self, file_name, probe=None):
+    if probe is not None:
+        probe = VideoProbe.from_dict(probe)
+
+    def report(progress):
+        self.update_state(state='PROGRESS', meta=progress)
+
+    generate_dash(file_name, probe, report, task_id=self.request.id)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def update_dash_renditions(file_name):
+    """добавляет видео недостающие разрешения лестницы DASH_LADDER,
+    если видео не ждёт конвертации и не конвертируется"""
+
+    if VideoConversion.is_active(file_name):
+        logger.info('Skipped renditions update of converting video %s', file_name)
+        return
+    renditions = DashVideoManager(file_name, default_storage).update_renditions()
+    logger.info('Added renditions %s to %s', [rendition.height for rendition in renditions], file_name)
 
 
 @shared_task
-def generate_dash_manifest(file_name):
-    dash = DashVideoManager(file_name, default_storage)
-    dash.generate()
+def age_transcoding_queue():
+    """ Повышает приоритет конвертаций, которые долго ждут в очереди.
+
+    Приоритет сообщения в брокере не меняется, поэтому в очередь отправляется
+    новая задача с более высоким приоритетом, а видео начинает ждать её.
+    Сообщение прежней задачи остаётся в очереди и, когда до него дойдёт
+    очередь, завершается без конвертации (см. VideoConversion.start).
+    """
+
+    now = timezone.now()
+    for conversion in VideoConversion.objects.filter(state=VideoConversion.STATE_QUEUED):
+        priority = get_aged_priority(conversion.priority, conversion.queued_at, now)
+        if priority >= conversion.task_priority:
+            continue
+
+        old_task_id, old_priority = conversion.task_id, conversion.task_priority
+        task_id = str(uuid.uuid4())
+        if not conversion.replace_task(task_id, priority):
+            continue
+        try:
+            generate_dash_manifest.apply_async(
+                args=[conversion.file_name],
+                kwargs={'probe': conversion.get_probe()},
+                queue=conversion.queue or None,
+                priority=priority,
+                task_id=task_id)
+        except Exception:
+            conversion.replace_task(old_task_id, old_priority)
+            raise
+        logger.info('Raised priority of %s to %d', conversion.file_name, priority)
+
+
+def get_transcoding_queue(probe: VideoProbe = None) -> str:
+    """очередь celery для конвертации видео: видео от DASH_HEAVY_HEIGHT занимают
+    много памяти, поэтому обрабатываются отдельной очередью по одному"""
+
+    if probe is not None and min(probe.width, probe.height) >= settings.DASH_HEAVY_HEIGHT:
+        return settings.DASH_HEAVY_QUEUE
+    return settings.DASH_QUEUE
+
+
+def get_transcoding_priority(probe: VideoProbe = None, retranscode: bool = False) -> int:
+    """ Приоритет задачи конвертации, 0 - самый высокий.
+
+    Чем короче ожидаемое кодирование (длительность видео с поправкой
+    на разрешение), тем выше приоритет (см. DASH_PRIORITY_STEPS), так что
+    исправленный двухминутный урок не ждёт двухчасовой вебинар. Повторная
+    конвертация видео урока, который уже можно смотреть, получает уровни
+    ниже всех первых публикаций. Если видео не анализировалось,
+    приоритет средний.
+    """
+
+    levels = len(settings.DASH_PRIORITY_STEPS) + 1
+    if probe is None:
+        level = levels // 2
+    else:
+        cost = probe.duration * probe.width * probe.height / REFERENCE_PIXELS
+        level = bisect.bisect_left(settings.DASH_PRIORITY_STEPS, cost)
+    if retranscode:
+        level += levels
+    return min(level, LOWEST_PRIORITY)
+
+
+def get_aged_priority(priority: int, queued_at, now) -> int:
+    """приоритет задачи, которая ждёт в очереди с queued_at: каждые DASH_PRIORITY_AGING
+    секунд ожидания он повышается на уровень, поэтому длинные видео не ждут бесконечно"""
+
+    if not settings.DASH_PRIORITY_AGING or queued_at is None:
+        return priority
+    waited_levels = int((now - queued_at).total_seconds() // settings.DASH_PRIORITY_AGING)
+    return max(0, priority - waited_levels)
+
+
+def enqueue_dash_generation(file_name: str, probe: VideoProbe = None, retranscode: bool = False):
+    """ставит конвертацию видео в очередь celery с приоритетом по ожидаемой длительности
+
+    :param retranscode: видео заменяет уже сконвертированное, т.е. урок можно смотреть и без него
+    """
+
+    tier = VideoConversion.TIER_RETRANSCODE if retranscode else VideoConversion.TIER_PUBLISH
+    priority = get_transcoding_priority(probe, retranscode)
+    queue = get_transcoding_queue(probe)
+    task_id = str(uuid.uuid4())
+    probe_data = probe.as_dict() if probe else None
+
+    # запись создаётся до отправки задачи, чтобы воркер её уже нашёл
+    VideoConversion.enqueue(file_name, task_id, queue, tier, priority, probe_data)
+    generate_dash_manifest.apply_async(
+        args=[file_name],
+        kwargs={'probe': probe_data},
+        queue=queue,
+        priority=priority,
+        task_id=task_id)
+
+
+def generate_dash(file_name: str, probe: VideoProbe = None, report=None, task_id: str = ''):
+    """конвертирует видео в dash, сохраняя ход и результат конвертации в VideoConversion
+
+    :param report: дополнительная функция, которой передаётся ход конвертации
+    :param task_id: задача celery, которая конвертирует видео. Если видео ждёт
+        другую задачу (см. age_transcoding_queue) или эта задача уже конвертирует
+        видео (см. VideoConversion.start), конвертация не выполняется
+    """
+
+    conversion = VideoConversion.start(file_name, task_id)
+    if conversion is None:
+        logger.info('Skipped outdated or running task %s for %s', task_id, file_name)
+        return
+
+    def report_progress(progress):
+        if not conversion.set_progress(progress):
+            # видео удалили во время конвертации, продолжать её незачем
+            dash.cancel()
+        if report is not None:
+            report(progress)
+
+    progress = FfmpegProgress(report_progress, settings.DASH_PROGRESS_INTERVAL)
+    dash = DashVideoManager(file_name, default_storage, probe, progress)
+    try:
+        dash.generate()
+    except Exception as error:
+        if conversion.set_failed(getattr(error, 'stderr', '') or repr(error)):
+            raise
+    else:
+        if conversion.set_done():
+            return
+
+    # строки конвертации нет: FieldVideo.delete удалил видео вместе с DASH файлами,
+    # пока оно конвертировалось. Удаляем и то, что конвертация успела сохранить после этого
+    logger.info('Cancelled conversion of deleted video %s', file_name)
+    if not default_storage.exists(file_name):
+        dash.destroy()
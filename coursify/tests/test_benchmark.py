@@ -0,0 +1,37 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from ..benchmark import STAGES, MemoryStorage, benchmark_clip, create_clip
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmark_command(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "results.json")
+            call_command("benchmark_dash", resolutions="320x180", durations="2",
+                         output=output_path, stderr=io.StringIO())
+            with open(output_path) as output_file:
+                report = json.load(output_file)
+
+        self.assertIn("ffmpeg", report["environment"]["ffmpeg"])
+        self.assertEqual([(result["storage"], result["resolution"], result["duration"])
+                          for result in report["results"]],
+                         [("filesystem", "320x180", 2), ("memory", "320x180", 2)])
+        for result in report["results"]:
+            self.assertEqual(tuple(result["stages"]), STAGES)
+            self.assertGreater(result["stages"]["encode"], 0)
+            self.assertGreater(result["upload"]["files"], 0)
+
+    def test_memory_storage_is_cleaned(self):
+        storage = MemoryStorage()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            clip_path = os.path.join(temp_dir, "clip.mp4")
+            create_clip(clip_path, 320, 180, 2)
+            benchmark_clip(clip_path, storage)
+
+        self.assertEqual(storage.files, {}, "После удаления видео в storage остались файлы")
@@ -1,12 +1,33 @@
+import io
+import json
 import os
+import posixpath
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
 
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.core.files.storage import Storage
+from django.core.management import CommandError, call_command
+from django.core.files import File
+from django.core.files.storage import Storage, default_storage
+from django.forms import ValidationError
 from django.test import TestCase, override_settings
 
 from courses.models import Lesson, Course
-from ..fields import DashFilesNames
+from ..dash import (COMPLEXITY_SCHEME, DashGenerationError, DashVideoManager, Rendition, adapt_ladder,
+                    format_ladder, parse_bitrate, parse_ladder)
+from ..fields import DashFilesNames, VideoField, VideoFormField
+from ..models import DashAsset, VideoAsset, VideoConversion, stream_id_of
+from ..mpd import MpdManifest
+from ..probe import VideoProbe
+from ..source import run_with_source
+from ..tasks import generate_dash, update_dash_renditions
+from ..uploader import SegmentWatcher
+from .test_source import VIDEO_PATH, StoredVideoMixin, create_faststart_video
 
 
 @override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=False)
@@ -40,7 +61,8 @@ class VideoFieldTest(TestCase):
 
     def test_is_created_chunks(self):
         storage = Lesson().video.storage
-        expected_streams_count = 5
+        # тестовое видео 1280x720: потоки 360, 480, 720 и аудио
+        expected_streams_count = 4
         expected_count_of_chunks_for_stream = 2
 
         lesson = Lesson.objects.first()
@@ -65,7 +87,8 @@ class VideoFieldTest(TestCase):
 
     def test_is_created_dash_init_files(self):
         storage = Lesson().video.storage
-        expected_count_of_stream_init = 5
+        # тестовое видео 1280x720: потоки 360, 480, 720 и аудио
+        expected_count_of_stream_init = 4
 
         lesson = Lesson.objects.first()
 
@@ -109,8 +132,179 @@ class VideoFieldTest(TestCase):
             len(lesson.video.video_name), 0,
             "Отсутствует имя видео файла")
 
+    def test_video_fields(self):
+        lesson = Lesson.objects.first()
+        self.assertEqual((lesson.video_width, lesson.video_height), (1280, 720),
+                         "Неверно заполнено разрешение видео")
+        self.assertGreater(lesson.video_duration.total_seconds(), 0,
+                           "Не заполнена длительность видео")
+        self.assertEqual(lesson.video_size, lesson.video.size,
+                         "Неверно заполнен размер видео")
+        self.assertEqual(lesson.video_thumbnail.name, lesson.video.preview_image_name,
+                         "Неверно заполнено превью видео")
 
-@override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=False)
+    def test_thumbnails_track(self):
+        lesson = Lesson.objects.first()
+        storage = lesson.video.storage
+        track_name = DashFilesNames.thumbnails_track_name(lesson.video.name)
+        with storage.open(track_name, "r") as track_file:
+            lines = track_file.read().splitlines()
+
+        self.assertEqual(lines[0], "WEBVTT")
+        thumbnails = [line for line in lines if "#xywh=" in line]
+        self.assertEqual(len(thumbnails), 2, "Неверное количество миниатюр для перемотки")
+        for thumbnail in thumbnails:
+            sprite_name = posixpath.join(posixpath.dirname(track_name), thumbnail.split("#")[0])
+            self.assertTrue(storage.exists(sprite_name), f"Отсутствует спрайт {sprite_name}")
+
+    def test_poster_candidates(self):
+        lesson = Lesson.objects.first()
+        self.assertEqual(len(lesson.video.poster_candidate_urls), settings.DASH_POSTER_CANDIDATES,
+                         "Создаются не все варианты превью")
+
+    def test_conversion_status(self):
+        conversion = Lesson.objects.first().video.conversion
+        self.assertEqual(conversion.state, VideoConversion.STATE_DONE)
+        self.assertEqual(conversion.percent, 100)
+        self.assertEqual(conversion.error, "")
+
+
+class DashEncodeJobsTest(TestCase):
+    """тест деления кодирования на задания ffmpeg без запуска ffmpeg"""
+
+    def _create_manager(self) -> DashVideoManager:
+        manager = DashVideoManager("videos/lecture.mp4", default_storage,
+                                   VideoProbe(width=1280, height=720, duration=23, has_audio=True))
+        manager.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(manager.temp_dir.cleanup)
+        manager.source_path = "/tmp/lecture.mp4"
+        return manager
+
+    def _get_jobs(self, manager: DashVideoManager) -> tuple:
+        """задания кодирования (команда, выходные файлы, длительность) и количество потоков пула"""
+
+        done = subprocess.CompletedProcess([], 0, "", "")
+        with mock.patch.object(manager, "_run_jobs", return_value=[done]) as run_jobs, \
+                mock.patch.object(manager, "_run_dash_ffmpeg", return_value=done), \
+                mock.patch.object(manager, "_finish_manifest"):
+            manager._generate_dash()
+        jobs, workers = run_jobs.call_args[0]
+        return jobs, workers
+
+    def _temp_path(self, manager: DashVideoManager, name: str) -> str:
+        return os.path.join(manager.temp_dir.name, posixpath.basename(name))
+
+    @override_settings(DASH_PARALLEL_RENDITIONS=True, DASH_CPU_BUDGET=4)
+    def test_parallel_renditions(self):
+        manager = self._create_manager()
+        jobs, workers = self._get_jobs(manager)
+
+        # по заданию на разрешения 360p, 480p и 720p, ядра делятся между ними
+        self.assertEqual(workers, 3)
+        self.assertEqual(len(jobs), 3)
+        preview_path = self._temp_path(manager, DashFilesNames.preview_image_name(manager.file_name))
+        for index, (command, output_paths, duration) in enumerate(jobs):
+            rendition = manager.ladder[index]
+            self.assertEqual(output_paths, [manager._rendition_file_path(index, 0)])
+            self.assertEqual(duration, 23)
+            self.assertNotIn("-ss", command)
+            self.assertEqual(command[command.index("-b:v:0") + 1], rendition.bitrate)
+            self.assertEqual(command.count("-b:v:0"), 1)
+            self.assertEqual(command[command.index("-threads") + 1], "1")
+            # превью создаются только первым заданием из уже декодированных кадров
+            self.assertEqual(preview_path in command, index == 0)
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_time_slices(self):
+        manager = self._create_manager()
+        jobs, workers = self._get_jobs(manager)
+
+        # 23 секунды - это 5 сегментов по 5 секунд, отрезки по 3 сегмента
+        self.assertEqual(manager._get_time_slices(), [(0, 15), (15, 15)])
+        self.assertEqual(workers, 2)
+        preview_path = self._temp_path(manager, DashFilesNames.preview_image_name(manager.file_name))
+        for slice_index, (command, output_paths, duration) in enumerate(jobs):
+            start = slice_index * 15
+            self.assertEqual(command[:5], ["ffmpeg", "-ss", str(start), "-t", "15"])
+            self.assertEqual(output_paths, [manager._rendition_file_path(index, slice_index)
+                                            for index, _ in enumerate(manager.ladder[:3])])
+            self.assertEqual(duration, [15, 8][slice_index])
+            self.assertEqual(command[command.index("-threads") + 1], "2")
+            self.assertEqual(preview_path in command, slice_index == 0)
+            # миниатюры второго отрезка начинаются со следующего спрайта
+            self.assertEqual(command[command.index("-start_number") + 1], str(slice_index + 1))
+
+        # разрешение склеивается из отрезков по порядку
+        with open(os.path.join(manager.temp_dir.name, "rendition-0.txt")) as concat_list:
+            self.assertEqual(concat_list.read().splitlines(), [
+                f"file '{manager._rendition_file_path(0, 0)}'",
+                f"file '{manager._rendition_file_path(0, 1)}'",
+            ])
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4, DASH_POSTER_CANDIDATES=2)
+    def test_poster_candidates(self):
+        manager = self._create_manager()
+        jobs, _ = self._get_jobs(manager)
+
+        # превью на 1 секунде и варианты через треть видео, второй вариант - во втором отрезке
+        posters = manager._get_posters()
+        self.assertEqual([round(time, 2) for time, _, _ in posters], [1, 7.67, 15.33])
+        (first_command, _, _), (second_command, _, _) = jobs
+        for time, temp_path, storage_name in posters:
+            command, start = (first_command, 0) if time < 15 else (second_command, 15)
+            self.assertEqual(command[command.index(temp_path) - 5:command.index(temp_path)], [
+                "-filter:v", f"select=gte(t\\,{time - start})", "-frames:v", "1", "-y"])
+            self.assertNotIn(temp_path, second_command if command is first_command else first_command)
+        self.assertEqual(posters[2][2], DashFilesNames.poster_candidate_name(manager.file_name, 2))
+
+
+@override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4, DASH_POSTER_CANDIDATES=2)
+class VideoFieldTimeSlicesTest(VideoFieldTest):
+    """ Те же проверки для кодирования видео отрезками по времени.
+
+    Из режимов кодирования заданиями только этот проверяется целиком:
+    отрезки склеиваются и упаковываются в dash настоящим ffmpeg. Остальные
+    режимы проверяются без запуска ffmpeg в DashEncodeJobsTest."""
+
+
+class DashStreamUploadTest(TestCase):
+    """тест сохранения сегментов в storage, пока ffmpeg ещё кодирует видео (DASH_STREAM_UPLOAD)"""
+
+    @override_settings(DASH_STREAM_UPLOAD=True)
+    def test_segments_saved_during_encoding(self):
+        manager = DashVideoManager("videos/lecture.mp4", default_storage)
+        manager.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(manager.temp_dir.cleanup)
+        manager.uploader = mock.Mock()
+        segment_path = os.path.join(manager.temp_dir.name, "lecture-chunk-stream0-00001.m4s")
+        unfinished_path = os.path.join(manager.temp_dir.name, "lecture-chunk-stream0-00002.m4s.tmp")
+        uploaded_during_encoding = []
+
+        def encode(command):
+            # ffmpeg пишет сегмент во временный файл и переименовывает его целиком записанным
+            with open(segment_path + ".tmp", "wb") as segment:
+                segment.write(b"segment")
+            os.replace(segment_path + ".tmp", segment_path)
+            with open(unfinished_path, "wb") as segment:
+                segment.write(b"seg")
+            deadline = time.monotonic() + 5
+            while not manager.uploader.upload.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+            uploaded_during_encoding.extend(manager.uploader.upload.call_args_list)
+            return subprocess.CompletedProcess(command, 0, "", "")
+
+        with mock.patch.object(SegmentWatcher, "POLL_INTERVAL", 0.01), \
+                mock.patch.object(manager, "_run_ffmpeg", side_effect=encode):
+            manager._run_dash_ffmpeg(["ffmpeg"])
+
+        expected = [mock.call(segment_path, "videos/lecture-chunk-stream0-00001.m4s", True)]
+        self.assertEqual(uploaded_during_encoding, expected)
+        # недописанный сегмент сохраняется после завершения ffmpeg вместе с init файлами
+        self.assertEqual(manager.uploader.upload.call_args_list, expected)
+        manager.uploader.wait.assert_called_once_with()
+
+
+@override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=False, DASH_POSTER_CANDIDATES=2)
 class VideoFieldDestroyTest(TestCase):
     """тест на правильное удаление VideoField"""
 
@@ -142,6 +336,8 @@ class VideoFieldDestroyTest(TestCase):
         self._check_is_init_files_deleted(video_name, storage)
         self._check_is_seg_files_deleted(video_name, storage)
         self._check_is_preview_files_deleted(video_name, storage)
+        self._check_is_poster_candidates_deleted(video_name, storage)
+        self._check_is_thumbnails_deleted(video_name, storage)
         self._check_is_mpd_manifest_deleted(video_name, storage)
 
     def _check_is_init_files_deleted(self, video_name: str, storage: Storage):
@@ -188,7 +384,994 @@ class VideoFieldDestroyTest(TestCase):
             storage.exists(image_preview),
             "Не удаляется изображение-превью для видеоплеера")
 
+    def _check_is_poster_candidates_deleted(self, video_name, storage):
+        for index in (1, 2):
+            self.assertFalse(
+                storage.exists(DashFilesNames.poster_candidate_name(video_name, index)),
+                "Не удаляются варианты превью")
+
+    def _check_is_thumbnails_deleted(self, video_name, storage):
+        self.assertFalse(
+            storage.exists(DashFilesNames.thumbnails_track_name(video_name)),
+            "Не удаляется дорожка миниатюр для перемотки")
+        self.assertFalse(
+            storage.exists(DashFilesNames.thumbnails_sprite_name(video_name, 1)),
+            "Не удаляются спрайты миниатюр для перемотки")
+
     def _check_is_mpd_manifest_deleted(self, video_name, storage):
         self.assertFalse(
             storage.exists(video_name),
             "Не удаляется mpd файл манифеста для DASH")
+
+
+@override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=False)
+class VideoFieldDestroyByManifestTest(TestCase):
+    """тест на удаление всех файлов, перечисленных в mpd манифесте"""
+
+    @classmethod
+    def setUpTestData(cls):
+        course = Course.objects.create(
+            slug="abc")
+        video_path = os.path.join(
+            settings.BASE_DIR,
+            "coursify",
+            "tests",
+            "assets",
+            "video_field_test.mp4")
+
+        (abs_dir_path, filename) = os.path.split(video_path)
+
+        with open(video_path, "rb") as infile:
+            _file = SimpleUploadedFile(filename, infile.read())
+            Lesson.objects.create(
+                course=course,
+                video=_file
+            )
+
+    def test_destroy_after_missing_chunk(self):
+        lesson = Lesson.objects.last()
+        storage = lesson.video.storage
+        video_name = lesson.video.name
+
+        dash_seg_name = DashFilesNames.dash_segments_mask(video_name)
+        dash_seg_name_mask = dash_seg_name. \
+            replace(r"\$RepresentationID\$", "{0}"). \
+            replace(r"\$Number%05d\$", "{1}")
+        storage.delete(dash_seg_name_mask.format(0, "00001"))
+        stream_init_name = DashFilesNames.dash_init_files_mask(video_name)
+        storage.delete(stream_init_name.replace(r"\$RepresentationID\$", "0"))
+
+        lesson.video.delete()
+
+        for stream_id in range(4):
+            self.assertFalse(
+                storage.exists(dash_seg_name_mask.format(stream_id, "00002")),
+                f"Не удалился чанк потока №{stream_id} после пропущенного файла")
+        self.assertFalse(
+            storage.exists(DashFilesNames.mpd_manifest_name(video_name)),
+            "Не удаляется mpd файл манифеста для DASH")
+
+
+class VideoFormFieldTest(TestCase):
+    """тест на проверку загружаемого файла в форме"""
+
+    def test_valid_video(self):
+        video_path = os.path.join(
+            settings.BASE_DIR,
+            "coursify",
+            "tests",
+            "assets",
+            "video_field_test.mp4")
+
+        with open(video_path, "rb") as infile:
+            _file = SimpleUploadedFile("video.mp4", infile.read())
+
+        cleaned = VideoFormField().clean(_file)
+
+        self.assertEqual(cleaned.video_probe.height, 720)
+        self.assertTrue(cleaned.video_probe.has_audio)
+
+    def test_invalid_video(self):
+        _file = SimpleUploadedFile("video.mp4", b"not a video")
+
+        with self.assertRaises(ValidationError):
+            VideoFormField().clean(_file)
+
+    def test_probe_passed_to_dash_generation(self):
+        course = Course.objects.create(slug="abc")
+        _file = SimpleUploadedFile("video.mp4", b"video content")
+        _file.video_probe = VideoProbe(width=640, height=360, duration=2.5)
+
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            lesson = Lesson.objects.create(course=course, video=_file)
+
+        gen_dash.assert_called_once_with(lesson.video.name, _file.video_probe, False)
+        self.assertEqual((lesson.video_width, lesson.video_height), (640, 360))
+        self.assertEqual(lesson.video_duration.total_seconds(), 2.5)
+
+
+@override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=False)
+class VideoFieldRegenerationTest(TestCase):
+    """тест на то, что DASH генерируется только для нового или заменённого видео"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(
+            slug="abc")
+
+    def _create_lesson(self, filename="video.mp4"):
+        return Lesson.objects.create(
+            course=self.course,
+            video=SimpleUploadedFile(filename, b"video content"))
+
+    def test_generate_for_new_video(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            lesson = self._create_lesson()
+
+        gen_dash.assert_called_once_with(lesson.video.name, None, False)
+
+    def test_not_regenerate_on_resave(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            lesson = self._create_lesson()
+            lesson.content = "новый текст урока"
+            lesson.save()
+
+            lesson = Lesson.objects.get(pk=lesson.pk)
+            lesson.content = "ещё один текст урока"
+            lesson.save()
+
+        self.assertEqual(gen_dash.call_count, 1,
+                         "DASH генерируется повторно для неизменённого видео")
+
+    def test_regenerate_for_replaced_video(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            lesson = self._create_lesson()
+
+            lesson = Lesson.objects.get(pk=lesson.pk)
+            lesson.video = SimpleUploadedFile("other.mp4", b"other video content")
+            lesson.save()
+
+        self.assertEqual(gen_dash.call_count, 2,
+                         "DASH не сгенерирован для заменённого видео")
+        # урок с заменённым видео уже можно смотреть, конвертация идёт в нижнем tier
+        gen_dash.assert_called_with(lesson.video.name, None, True)
+
+    def test_generate_for_new_model_with_stored_video(self):
+        name = default_storage.save("videos/stored.mp4", SimpleUploadedFile("stored.mp4", b"video content"))
+        self.addCleanup(default_storage.delete, name)
+
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            lesson = Lesson(course=self.course, video=name)
+            lesson.save()
+            lesson.save()
+
+        gen_dash.assert_called_once_with(name, None, False)
+
+    def test_regenerate_for_video_saved_through_field_file(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            lesson = self._create_lesson()
+
+            lesson = Lesson.objects.get(pk=lesson.pk)
+            lesson.video.save("other.mp4", SimpleUploadedFile("other.mp4", b"other video content"))
+            lesson.save()
+
+        self.assertEqual(gen_dash.call_count, 2,
+                         "DASH должен генерироваться один раз для каждого загруженного видео")
+
+
+@override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=False, DASH_DEDUPLICATE_UPLOADS=True)
+class VideoFieldDeduplicationTest(TestCase):
+    """тест на то, что одинаковые видео сохраняются и конвертируются один раз"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.course = Course.objects.create(
+            slug="abc")
+
+    def _create_lesson(self, content=b"video content"):
+        return Lesson.objects.create(
+            course=self.course,
+            slug=f"lesson-{Lesson.objects.count()}",
+            video=SimpleUploadedFile("video.mp4", content))
+
+    def test_same_video_is_reused(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            first = self._create_lesson()
+            second = self._create_lesson()
+            other = self._create_lesson(b"other video content")
+
+        self.assertEqual(first.video.name, second.video.name)
+        self.assertNotEqual(first.video.name, other.video.name)
+        self.assertEqual(gen_dash.call_count, 2,
+                         "DASH генерируется повторно для уже загруженного видео")
+        self.assertEqual(VideoAsset.objects.get(file_name=first.video.name).references, 2)
+
+    def test_same_video_saved_through_field_file(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            first = self._create_lesson()
+            second = Lesson.objects.create(course=self.course, slug="second")
+            second.video.save("video.mp4", SimpleUploadedFile("video.mp4", b"video content"))
+
+        second = Lesson.objects.get(pk=second.pk)
+        self.assertEqual(second.video.name, first.video.name)
+        self.assertEqual(gen_dash.call_count, 1)
+
+    def test_files_are_deleted_with_last_reference(self):
+        with mock.patch.object(VideoField, "gen_dash"):
+            first = self._create_lesson()
+            second = self._create_lesson()
+        storage = first.video.storage
+        video_name = first.video.name
+
+        with mock.patch.object(DashVideoManager, "destroy") as destroy:
+            first.video.delete()
+            self.assertTrue(storage.exists(video_name),
+                            "Удалено видео, которое используется в другом уроке")
+            destroy.assert_not_called()
+            self.assertEqual(Lesson.objects.get(pk=first.pk).video.name, '')
+
+            second.video.delete()
+            self.assertFalse(storage.exists(video_name))
+            destroy.assert_called_once_with()
+
+        self.assertFalse(VideoAsset.objects.exists())
+
+    def test_missing_file_is_uploaded_again(self):
+        with mock.patch.object(VideoField, "gen_dash") as gen_dash:
+            first = self._create_lesson()
+            first.video.storage.delete(first.video.name)
+            second = self._create_lesson()
+
+        self.assertTrue(second.video.storage.exists(second.video.name))
+        self.assertEqual(gen_dash.call_count, 2)
+        second.video.delete()
+
+
+@override_settings(DASH_PROGRESS_INTERVAL=0)
+class DashConversionProgressTest(StoredVideoMixin, TestCase):
+    """тест хода и результата конвертации в VideoConversion"""
+
+    VIDEO_NAME = "videos/progress.mp4"
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+
+    def test_progress(self):
+        reports = []
+        generate_dash(self.video_name, report=reports.append)
+
+        encode_reports = [report for report in reports if report["stage"] == "encode"]
+        self.assertGreater(len(encode_reports), 1)
+        self.assertEqual(encode_reports[-1]["percent"], 100.0)
+        self.assertGreater(encode_reports[-1]["frame"], 0)
+        self.assertEqual(reports[-1]["stage"], "upload")
+        conversion = VideoConversion.objects.get(file_name=self.video_name)
+        self.assertEqual(conversion.state, VideoConversion.STATE_DONE)
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_progress_of_parallel_jobs(self):
+        reports = []
+        generate_dash(self.video_name, report=reports.append)
+
+        finished_stages = {report["stage"] for report in reports if report["percent"] == 100.0}
+        self.assertEqual(finished_stages, {"encode", "package"})
+
+    def test_failure(self):
+        stderr = "".join(f"line {index}\n" for index in range(100)) + "Invalid argument\n"
+        result = subprocess.CompletedProcess([], 1, "", stderr)
+        with mock.patch.object(DashVideoManager, "_run_dash_ffmpeg", return_value=result):
+            with self.assertRaises(DashGenerationError):
+                generate_dash(self.video_name)
+
+        conversion = VideoConversion.objects.get(file_name=self.video_name)
+        self.assertEqual(conversion.state, VideoConversion.STATE_FAILED)
+        self.assertEqual(conversion.error.splitlines(),
+                         stderr.splitlines()[-DashVideoManager.STDERR_TAIL_LINES:])
+
+    def _generate_and_delete_lesson_video(self):
+        """конвертирует видео урока, удаляя его после первого отчёта о ходе конвертации"""
+        lesson = Lesson.objects.create(course=Course.objects.create(slug="abc"))
+        Lesson.objects.filter(pk=lesson.pk).update(video=self.video_name)
+        lesson.refresh_from_db()
+
+        def delete_video(progress):
+            if lesson.video:
+                lesson.video.delete()
+
+        generate_dash(self.video_name, report=delete_video)
+
+        self.assertFalse(VideoConversion.objects.filter(file_name=self.video_name).exists())
+        self.assertEqual(self._get_dash_file_names(), [])
+
+    def test_video_deleted_during_conversion(self):
+        self._generate_and_delete_lesson_video()
+
+    @override_settings(DASH_PROGRESSIVE_PUBLISH=True)
+    def test_video_deleted_during_progressive_conversion(self):
+        self._generate_and_delete_lesson_video()
+
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_failed_job_cancels_other_jobs(self):
+        manager = DashVideoManager(self.video_name, default_storage)
+
+        def run_job(command, output_paths, duration=None):
+            if any(path.endswith("-1.mp4") for path in output_paths):
+                return subprocess.CompletedProcess(command, 1, "", "Invalid data found\n")
+            return manager._run_ffmpeg([sys.executable, "-c", "import time; time.sleep(60)"])
+
+        started_at = time.monotonic()
+        with mock.patch.object(manager, "_run_encode_job", side_effect=run_job):
+            with self.assertRaises(DashGenerationError) as error:
+                manager.generate()
+
+        self.assertEqual(error.exception.stderr, "Invalid data found")
+        self.assertLess(time.monotonic() - started_at, 30, "Параллельное задание не прервано")
+
+    @override_settings(DASH_FFMPEG_TIMEOUT=0.1)
+    def test_timeout(self):
+        manager = DashVideoManager(self.video_name, default_storage, VideoProbe(duration=8.0))
+        with mock.patch.object(DashVideoManager, "FFMPEG_TIMEOUT_MARGIN", 0):
+            with self.assertRaises(DashGenerationError) as error:
+                manager._run_ffmpeg([sys.executable, "-c", "import sys, time; print('stalled', file=sys.stderr, "
+                                                           "flush=True); time.sleep(60)"])
+
+        self.assertIn("timed out after 1 seconds", str(error.exception))
+        self.assertEqual(error.exception.stderr, "stalled")
+
+
+@override_settings(DASH_PIPE_SOURCE=True)
+class DashPipeSourceTest(TestCase):
+    """тест передачи оригинала из удалённого storage в ffmpeg через stdin"""
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            faststart_path = os.path.join(temp_dir, "faststart.mp4")
+            create_faststart_video(faststart_path)
+            with open(faststart_path, "rb") as video_file:
+                self.faststart_name = default_storage.save("videos/faststart.mp4", File(video_file))
+        with open(VIDEO_PATH, "rb") as video_file:
+            self.moov_at_end_name = default_storage.save("videos/moov_at_end.mp4", File(video_file))
+
+        # storage, который не хранит файлы в локальной файловой системе
+        patcher = mock.patch.object(DashVideoManager, "_get_local_path", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _generate(self, video_name: str):
+        manager = DashVideoManager(video_name, default_storage)
+        with mock.patch("coursify.dash.run_with_source", wraps=run_with_source) as run:
+            manager.generate()
+        self.addCleanup(default_storage.delete, video_name)
+        self.addCleanup(manager.destroy)
+        return manager, run
+
+    def _check_is_generated(self, video_name: str):
+        mpd_manifest_name = DashFilesNames.mpd_manifest_name(video_name)
+        with default_storage.open(mpd_manifest_name, "rb") as mpd_file:
+            manifest = MpdManifest.from_string(mpd_file.read())
+
+        file_names = manifest.file_names(posixpath.dirname(mpd_manifest_name))
+        self.assertEqual(len(file_names), 12, "Создаются не все init файлы и сегменты")
+        for file_name in file_names:
+            self.assertTrue(default_storage.exists(file_name), f"Не создался файл {file_name}")
+        self.assertTrue(
+            default_storage.exists(DashFilesNames.preview_image_name(video_name)),
+            "Не создаётся изображение-превью для видеоплеера")
+
+    def test_pipe_source(self):
+        manager, run = self._generate(self.faststart_name)
+
+        self.assertIsNone(manager.temp_video_file, "Оригинал скопирован во временный файл")
+        self.assertTrue(run.called, "Оригинал не передаётся в ffmpeg через stdin")
+        self._check_is_generated(self.faststart_name)
+
+    def test_moov_at_end_copied_to_temp_file(self):
+        manager, run = self._generate(self.moov_at_end_name)
+
+        self.assertIsNotNone(manager.temp_video_file)
+        self.assertEqual([call for call in run.call_args_list if call[0][1] is not None], [],
+                         "Оригинал передаётся в ffmpeg через stdin")
+        self._check_is_generated(self.moov_at_end_name)
+
+
+@override_settings(DASH_SINGLE_FILE=True)
+class DashSingleFileTest(StoredVideoMixin, TestCase):
+    """тест раскладки одним файлом на поток с индексом сегментов (DASH_SINGLE_FILE)"""
+
+    VIDEO_NAME = "videos/single.mp4"
+
+    def _check_generated(self):
+        manifest = self._read_manifest()
+        file_names = manifest.file_names(posixpath.dirname(self.mpd_manifest_name))
+
+        # тестовое видео 1280x720: потоки 360, 480, 720 и аудио, каждый одним файлом
+        self.assertEqual(sorted(file_names), [
+            DashFilesNames.dash_single_file_mask(self.video_name).replace(r"\$RepresentationID\$", str(index))
+            for index in range(4)])
+        for adaptation_set, representation in manifest.representations():
+            segment_base = representation.find(MpdManifest._tag("SegmentBase"))
+            self.assertIsNotNone(segment_base, "Поток описан не через SegmentBase")
+            index_start, index_end = map(int, segment_base.get("indexRange").split("-"))
+            file_name, = manifest.representation_file_names(adaptation_set, representation)
+            with default_storage.open(posixpath.join(posixpath.dirname(self.video_name), file_name)) as stream_file:
+                stream_file.seek(index_start + 4)
+                self.assertEqual(stream_file.read(4), b"sidx")
+                self.assertGreater(index_end, index_start)
+
+        chunk_name = DashFilesNames.dash_segments_mask(self.video_name). \
+            replace(r"\$RepresentationID\$", "0").replace(r"\$Number%05d\$", "00001")
+        self.assertFalse(default_storage.exists(chunk_name))
+
+    def test_generate_and_destroy(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self._check_generated()
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+        self.assertEqual(self._get_dash_file_names(), [])
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_generate_by_jobs(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+        self._check_generated()
+
+    @override_settings(DASH_PROGRESSIVE_PUBLISH=True)
+    def test_progressive_publish(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+        self._check_generated()
+
+    def test_destroy_without_manifest(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        default_storage.delete(self.mpd_manifest_name)
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+        self.assertEqual(self._get_dash_file_names(), [])
+
+
+@override_settings(DASH_HLS_PLAYLIST=True)
+class DashHlsPlaylistTest(StoredVideoMixin, TestCase):
+    """тест плейлистов HLS, которые ссылаются на те же сегменты, что и mpd (DASH_HLS_PLAYLIST)"""
+
+    VIDEO_NAME = "videos/hls.mp4"
+
+    def setUp(self):
+        super().setUp()
+        self.directory = posixpath.dirname(self.video_name)
+
+    def _read_playlist(self, name: str) -> list:
+        """ссылки из плейлиста: строки без # и URI из тегов"""
+        with default_storage.open(name, "r") as playlist_file:
+            lines = playlist_file.read().splitlines()
+        uris = [line for line in lines if line and not line.startswith("#")]
+        uris += re.findall(r'URI="([^"]+)"', "\n".join(lines))
+        return [posixpath.join(self.directory, uri) for uri in uris]
+
+    def _check_generated(self):
+        mpd_file_names = self._read_manifest().file_names(self.directory)
+
+        media_playlists = self._read_playlist(DashFilesNames.hls_playlist_name(self.video_name))
+        # тестовое видео 1280x720: потоки 360, 480, 720 и аудио
+        self.assertEqual(sorted(media_playlists), [
+            DashFilesNames.hls_media_playlist_name(self.video_name, stream_id) for stream_id in range(4)])
+
+        hls_file_names = set()
+        for media_playlist in media_playlists:
+            hls_file_names.update(self._read_playlist(media_playlist))
+        self.assertEqual(hls_file_names, set(mpd_file_names),
+                         "HLS и DASH ссылаются на разные файлы")
+        for file_name in hls_file_names:
+            self.assertTrue(default_storage.exists(file_name))
+
+    def test_generate_and_destroy(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self._check_generated()
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+        self.assertEqual(self._get_dash_file_names(), [])
+
+    @override_settings(DASH_SINGLE_FILE=True, DASH_PARALLEL_RENDITIONS=True, DASH_CPU_BUDGET=4)
+    def test_single_file(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self._check_generated()
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+        self.assertEqual(self._get_dash_file_names(), [])
+
+    @override_settings(DASH_PROGRESSIVE_PUBLISH=True)
+    def test_progressive_publish(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+        self._check_generated()
+
+    def test_hls_url(self):
+        lesson = Lesson(video=self.video_name)
+
+        self.assertEqual(lesson.video.hls_url, default_storage.url("videos/hls.m3u8"))
+
+    @override_settings(DASH_HLS_PLAYLIST=False)
+    def test_hls_url_without_playlists(self):
+        lesson = Lesson(video=self.video_name)
+
+        self.assertEqual(lesson.video.hls_url, "")
+
+
+@override_settings(DASH_PROGRESSIVE_PUBLISH=True)
+class DashProgressivePublishTest(StoredVideoMixin, TestCase):
+    """тест публикации и удаления видео на каждом этапе постепенной публикации"""
+
+    VIDEO_NAME = "videos/progressive.mp4"
+
+    def test_publish_by_renditions(self):
+        manager = DashVideoManager(self.video_name, default_storage)
+        publish_stage = manager._publish_progressive_stage
+        representations = []
+
+        def publish_and_check(first_stage):
+            publish_stage(first_stage)
+            manifest = self._read_manifest()
+            file_names = manifest.file_names(posixpath.dirname(self.mpd_manifest_name))
+            for file_name in file_names:
+                self.assertTrue(default_storage.exists(file_name),
+                                f"В манифесте есть несохранённый файл {file_name}")
+            representations.append(len(list(manifest.representations())))
+            # превью и миниатюры публикуются вместе с первым разрешением
+            for name in (DashFilesNames.preview_image_name(self.video_name),
+                         DashFilesNames.thumbnails_track_name(self.video_name)):
+                self.assertTrue(default_storage.exists(name), f"Не опубликован {name}")
+            self.assertEqual(DashAsset.objects.get(file_name=self.video_name).state, DashAsset.STATE_PUBLISHING)
+
+        with mock.patch.object(manager, "_publish_progressive_stage", side_effect=publish_and_check):
+            manager.generate()
+        self.addCleanup(manager.destroy)
+
+        # 360p с аудио, затем 480p и 720p
+        self.assertEqual(representations, [2, 3, 4])
+        self.assertEqual(DashAsset.objects.get(file_name=self.video_name).state, DashAsset.STATE_PUBLISHED)
+
+    def test_destroy_after_interrupted_stage(self):
+        manager = DashVideoManager(self.video_name, default_storage)
+        save_temp_file = manager._save_temp_file
+        saved_manifests = []
+
+        def save_or_fail(temp_file_path, storage_name, remove=False):
+            if storage_name == self.mpd_manifest_name:
+                if saved_manifests:
+                    raise IOError("worker stopped")
+                saved_manifests.append(storage_name)
+            save_temp_file(temp_file_path, storage_name, remove)
+
+        with mock.patch.object(manager, "_save_temp_file", side_effect=save_or_fail):
+            with self.assertRaises(IOError):
+                manager.generate()
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+        self.assertEqual(self._get_dash_file_names(), [])
+
+    def test_source_deleted_during_generation(self):
+        manager = DashVideoManager(self.video_name, default_storage)
+        publish_stage = manager._publish_progressive_stage
+
+        def publish_and_delete_source(first_stage):
+            publish_stage(first_stage)
+            default_storage.delete(self.video_name)
+
+        with mock.patch.object(manager, "_publish_progressive_stage",
+                               side_effect=publish_and_delete_source) as publish:
+            manager.generate()
+
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual(self._get_dash_file_names(), [])
+
+
+class DashCheckpointTest(StoredVideoMixin, TestCase):
+    """тест продолжения прерванной конвертации из контрольной точки (DASH_CHECKPOINT_DIR)"""
+
+    VIDEO_NAME = "videos/checkpoint.mp4"
+
+    def setUp(self):
+        super().setUp()
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        self.checkpoint_dir = checkpoint_dir.name
+
+    def _generate_reference_manifest(self) -> bytes:
+        DashVideoManager(self.video_name, default_storage).generate()
+        manifest = self._read_manifest().to_string()
+        DashVideoManager(self.video_name, default_storage).destroy()
+        return manifest
+
+    def _interrupt_generation(self, interrupted_output: str) -> DashVideoManager:
+        """запускает конвертацию, которую прерывают на кодировании interrupted_output"""
+
+        manager = DashVideoManager(self.video_name, default_storage)
+        run_encode_job = manager._run_encode_job
+
+        def run_or_stop(command, output_paths, duration=None):
+            if any(os.path.basename(path) == interrupted_output for path in output_paths):
+                raise RuntimeError("worker killed")
+            return run_encode_job(command, output_paths, duration)
+
+        with mock.patch.object(manager, "_run_encode_job", side_effect=run_or_stop):
+            with self.assertRaises(RuntimeError):
+                manager.generate()
+        return manager
+
+    def _resume_generation(self) -> list:
+        """продолжает конвертацию новым объектом, как повторная задача celery
+
+        :return: названия промежуточных файлов, которые кодировались заново
+        """
+
+        manager = DashVideoManager(self.video_name, default_storage)
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+        with mock.patch.object(manager, "_run_encode_job", wraps=manager._run_encode_job) as run:
+            manager.generate()
+        return sorted(os.path.basename(path) for call in run.call_args_list for path in call[0][1])
+
+    def _check_generated(self, reference_manifest: bytes):
+        self.assertEqual(self._read_manifest().to_string(), reference_manifest)
+        self.assertTrue(default_storage.exists(DashFilesNames.preview_image_name(self.video_name)))
+        self.assertTrue(default_storage.exists(DashFilesNames.thumbnails_track_name(self.video_name)))
+        self.assertEqual(os.listdir(self.checkpoint_dir), [], "Контрольная точка не удалена")
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_resume_time_slices(self):
+        reference_manifest = self._generate_reference_manifest()
+
+        with override_settings(DASH_CHECKPOINT_DIR=self.checkpoint_dir):
+            manager = self._interrupt_generation("rendition-0-1.mp4")
+            self.assertEqual(sorted(os.listdir(manager.checkpoint_path)), [
+                "checkpoint.json", "checkpoint.lock", "rendition-0-0.mp4", "rendition-1-0.mp4",
+                "rendition-2-0.mp4"])
+
+            encoded = self._resume_generation()
+
+        self.assertEqual(encoded, ["rendition-0-1.mp4", "rendition-1-1.mp4", "rendition-2-1.mp4"])
+        self._check_generated(reference_manifest)
+
+    @override_settings(DASH_PROGRESSIVE_PUBLISH=True)
+    def test_resume_progressive_publish(self):
+        reference_manifest = self._generate_reference_manifest()
+
+        with override_settings(DASH_CHECKPOINT_DIR=self.checkpoint_dir):
+            self._interrupt_generation("rendition-1-0.mp4")
+            encoded = self._resume_generation()
+
+        self.assertEqual(encoded, ["rendition-1-0.mp4", "rendition-2-0.mp4"])
+        self._check_generated(reference_manifest)
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_changed_source_is_encoded_again(self):
+        with override_settings(DASH_CHECKPOINT_DIR=self.checkpoint_dir):
+            self._interrupt_generation("rendition-0-1.mp4")
+            default_storage.delete(self.video_name)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                faststart_path = os.path.join(temp_dir, "faststart.mp4")
+                create_faststart_video(faststart_path)
+                with open(faststart_path, "rb") as video_file:
+                    default_storage.save(self.video_name, File(video_file))
+
+            encoded = self._resume_generation()
+
+        self.assertEqual(len(encoded), 6, "Промежуточные файлы другого оригинала использованы повторно")
+
+    @override_settings(DASH_TIME_SLICES=2, DASH_CPU_BUDGET=4)
+    def test_locked_by_running_conversion(self):
+        with override_settings(DASH_CHECKPOINT_DIR=self.checkpoint_dir):
+            running = DashVideoManager(self.video_name, default_storage, VideoProbe.from_file(VIDEO_PATH))
+            running.temp_dir = tempfile.TemporaryDirectory()
+            self.addCleanup(running.temp_dir.cleanup)
+            running._open_checkpoint()
+            self.addCleanup(running._unlock_checkpoint)
+            intermediate_path = running._rendition_file_path(0, 0)
+            with open(intermediate_path, "wb") as intermediate_file:
+                intermediate_file.write(b"encoded")
+
+            # вторая задача с тем же видео не начинает конвертацию заново
+            with self.assertRaises(DashGenerationError):
+                DashVideoManager(self.video_name, default_storage).generate()
+            # удаление видео не удаляет контрольную точку идущей конвертации
+            DashVideoManager(self.video_name, default_storage).destroy()
+            self.assertTrue(os.path.exists(intermediate_path))
+
+            running._remove_checkpoint()
+            self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+
+@override_settings(DASH_LADDER="360:450k:baseline,480:700k:main")
+class DashLadderTest(StoredVideoMixin, TestCase):
+    """тест лестницы разрешений и добавления недостающих разрешений к уже сконвертированному видео"""
+
+    VIDEO_NAME = "videos/ladder.mp4"
+
+    def _read_files(self, manifest: MpdManifest) -> dict:
+        contents = {}
+        for file_name in manifest.file_names(posixpath.dirname(self.mpd_manifest_name)):
+            with default_storage.open(file_name, "rb") as dash_file:
+                contents[file_name] = dash_file.read()
+        return contents
+
+    def _check_update(self, ladder: str, added_heights: list, heights: list):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+        old_files = self._read_files(self._read_manifest())
+
+        with override_settings(DASH_LADDER=ladder):
+            added = DashVideoManager(self.video_name, default_storage).update_renditions()
+
+        manifest = self._read_manifest()
+        self.assertEqual([rendition.height for rendition in added], added_heights)
+        self.assertEqual([int(representation.get("height"))
+                          for _, representation in manifest.video_representations()], heights)
+        new_files = self._read_files(manifest)
+        for file_name, content in old_files.items():
+            self.assertEqual(new_files[file_name], content, f"Файл {file_name} закодирован заново")
+        return manifest
+
+    def test_parse_ladder(self):
+        self.assertEqual(parse_ladder("720:1800k:main, 360:450k:baseline"), (
+            Rendition(height=360, bitrate="450k", profile="baseline"),
+            Rendition(height=720, bitrate="1800k", profile="main"),
+        ))
+        with self.assertRaises(ValueError):
+            parse_ladder("360:450k")
+        self.assertEqual(parse_bitrate("450k"), 450000)
+        self.assertEqual(parse_bitrate("5M"), 5000000)
+
+    @override_settings(DASH_LADDER="240:300k:baseline,360:450k:baseline,480:700k:main,720:1800k:main,"
+                                   "1080:5000k:high")
+    def test_renditions_by_height(self):
+        def heights(height):
+            manager = DashVideoManager(self.video_name, default_storage, VideoProbe(width=height * 2, height=height))
+            return [rendition.height for rendition in manager._get_renditions()]
+
+        self.assertEqual(heights(1080), [240, 360, 480, 720, 1080])
+        self.assertEqual(heights(1072), [240, 360, 480, 720, 1080])
+        self.assertEqual(heights(720), [240, 360, 480, 720])
+        self.assertEqual(heights(700), [240, 360, 480])
+        self.assertEqual(heights(144), [240, 360])
+
+    def test_add_top_rendition(self):
+        manifest = self._check_update("360:450k:baseline,480:700k:main,720:1800k:main", [720], [360, 480, 720])
+
+        # потоки 0 и 1 - видео, 2 - аудио, новое разрешение получает следующий номер
+        _, representation = list(manifest.video_representations())[-1]
+        self.assertEqual(representation.get("id"), "3")
+
+    def test_add_bottom_rendition(self):
+        self._check_update("240:300k:baseline,360:450k:baseline,480:700k:main", [240], [240, 360, 480])
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+        self.assertEqual(self._get_dash_file_names(), [])
+
+    @override_settings(DASH_SINGLE_FILE=True)
+    def test_add_rendition_single_file(self):
+        manifest = self._check_update("360:450k:baseline,480:700k:main,720:1800k:main", [720], [360, 480, 720])
+
+        adaptation_set, representation = list(manifest.video_representations())[-1]
+        file_name, = manifest.representation_file_names(adaptation_set, representation)
+        self.assertEqual(file_name, "ladder-stream3.mp4")
+        self.assertIsNotNone(representation.find(MpdManifest._tag("SegmentBase")))
+
+    def test_up_to_date(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+        manifest = self._read_manifest().to_string()
+
+        self.assertEqual(DashVideoManager(self.video_name, default_storage).update_renditions(), [])
+        self.assertEqual(self._read_manifest().to_string(), manifest)
+
+    def test_skip_converting_video(self):
+        lesson = Lesson.objects.create(course=Course.objects.create(slug="abc"))
+        Lesson.objects.filter(pk=lesson.pk).update(video=self.video_name)
+        VideoConversion.start(self.video_name)
+
+        output = io.StringIO()
+        call_command("update_dash_ladder", stdout=output)
+        update_dash_renditions(self.video_name)
+
+        self.assertEqual(output.getvalue(), f"{self.video_name}: converting, skipped\n")
+        self.assertFalse(default_storage.exists(self.mpd_manifest_name), "Видео конвертируется второй раз")
+
+    def test_locked_by_running_conversion(self):
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        with override_settings(DASH_CHECKPOINT_DIR=checkpoint_dir.name):
+            running = DashVideoManager(self.video_name, default_storage)
+            running._lock_conversion()
+            self.addCleanup(running._unlock_checkpoint)
+
+            with self.assertRaises(DashGenerationError):
+                DashVideoManager(self.video_name, default_storage).update_renditions()
+        self.assertFalse(default_storage.exists(self.mpd_manifest_name))
+
+
+@override_settings(DASH_ADAPTIVE_LADDER=True, DASH_ADAPTIVE_SAMPLES=2)
+class DashAdaptiveLadderTest(TestCase):
+    """тест лестницы, подобранной по сложности видео"""
+
+    LADDER = parse_ladder("360:450k:baseline,480:700k:main,720:1800k:main,1080:5000k:high")
+
+    def test_adapt_ladder(self):
+        # слайды: остаются два разрешения с битрейтами в разы ниже лестницы
+        self.assertEqual(adapt_ladder(self.LADDER, 30000, 0.1, 1.5), (
+            Rendition(height=720, bitrate="180k", profile="main"),
+            Rendition(height=1080, bitrate="500k", profile="high"),
+        ))
+        self.assertEqual([rendition.height for rendition in adapt_ladder(self.LADDER, 100000, 0.1, 1.5)],
+                         [480, 720, 1080])
+        # динамичное видео получает больше битов, но не больше max_factor
+        self.assertEqual([rendition.bitrate for rendition in adapt_ladder(self.LADDER, 2000000, 0.1, 1.5)],
+                         ["675k", "1050k", "2700k", "7500k"])
+
+    def test_complexity_command(self):
+        manager = DashVideoManager("videos/lecture.mp4", default_storage, VideoProbe(width=1280, height=720,
+                                                                                      duration=600))
+        manager.source_path = "/tmp/lecture.mp4"
+        command, duration = manager._complexity_command("/tmp/complexity.mp4")
+        self.assertEqual(duration, 4)
+        self.assertEqual(command[:9], ["ffmpeg", "-ss", "149.000", "-t", "2", "-i", "/tmp/lecture.mp4",
+                                       "-ss", "449.000"])
+        self.assertIn("[s0][s1]concat=n=2:v=1:a=0[v]", command[command.index("-filter_complex") + 1])
+        self.assertEqual(command[command.index("-crf") + 1], "23")
+
+        manager.source_path = "pipe:0"
+        command, duration = manager._complexity_command("/tmp/complexity.mp4")
+        self.assertEqual(duration, 4)
+        self.assertNotIn("-ss", command)
+        self.assertIn("select='lt(mod(t,300.000),2)'", command[command.index("-filter:v") + 1])
+
+    def test_generate(self):
+        with open(VIDEO_PATH, "rb") as video_file:
+            video_name = default_storage.save("videos/adaptive.mp4", File(video_file))
+        self.addCleanup(default_storage.delete, video_name)
+        manager = DashVideoManager(video_name, default_storage)
+        manager.generate()
+        self.addCleanup(DashVideoManager(video_name, default_storage).destroy)
+
+        with default_storage.open(DashFilesNames.mpd_manifest_name(video_name), "rb") as mpd_file:
+            manifest = MpdManifest.from_string(mpd_file.read())
+        complexity = int(manifest.get_property(COMPLEXITY_SCHEME))
+        self.assertEqual(complexity, manager.complexity)
+        self.assertGreater(complexity, 0)
+        renditions = adapt_ladder(self.LADDER[:3], complexity, 0.1, 1.5)
+        self.assertEqual([(int(representation.get("height")), int(representation.get("bandwidth")))
+                          for _, representation in manifest.video_representations()],
+                         [(rendition.height, parse_bitrate(rendition.bitrate)) for rendition in renditions])
+
+        # битрейты уже сконвертированного видео подбираются по сохранённой в манифесте сложности
+        with override_settings(DASH_ADAPTIVE_LADDER=False):
+            self.assertEqual(DashVideoManager(video_name, default_storage).update_renditions(), [])
+
+
+class DashAssetIndexTest(StoredVideoMixin, TestCase):
+    """тест индекса DASH файлов видео в базе"""
+
+    VIDEO_NAME = "videos/index.mp4"
+    LADDER = "360:450k:baseline,480:700k:main,720:1800k:main"
+
+    def _generate(self):
+        DashVideoManager(self.video_name, default_storage).generate()
+        self.addCleanup(DashVideoManager(self.video_name, default_storage).destroy)
+
+    def _stored_files(self) -> dict:
+        """размеры DASH файлов видео в storage по названиям"""
+        return {name: default_storage.size(name) for name in self._get_dash_file_names()}
+
+    def _check_index(self):
+        asset = DashAsset.objects.get(file_name=self.video_name)
+        stored_files = self._stored_files()
+        self.assertEqual(asset.state, DashAsset.STATE_PUBLISHED)
+        self.assertEqual(dict(asset.files.values_list("name", "size")), stored_files)
+        self.assertEqual(asset.file_count, len(stored_files))
+        self.assertEqual(asset.size, sum(stored_files.values()))
+        return asset
+
+    def test_generate(self):
+        self._generate()
+
+        asset = self._check_index()
+        self.assertEqual(asset.ladder, self.LADDER)
+        # три видео потока и аудио
+        self.assertEqual(asset.representations, 4)
+        chunk_name = DashFilesNames.dash_segments_mask(self.video_name) \
+            .replace(r"\$RepresentationID\$", "3").replace(r"\$Number%05d\$", "00001")
+        self.assertEqual(asset.files.get(name=chunk_name).representation, 3)
+        self.assertIsNone(asset.files.get(name=DashFilesNames.mpd_manifest_name(self.video_name)).representation)
+        self.assertEqual(DashAsset.usage([self.video_name, "videos/missing.mp4"]),
+                         {"videos": 1, "files": asset.file_count, "bytes": asset.size})
+
+    @override_settings(DASH_PROGRESSIVE_PUBLISH=True)
+    def test_generate_progressively(self):
+        self._generate()
+        self._check_index()
+
+    def test_update_renditions(self):
+        with override_settings(DASH_LADDER="360:450k:baseline,480:700k:main"):
+            self._generate()
+
+        with override_settings(DASH_LADDER=self.LADDER):
+            DashVideoManager(self.video_name, default_storage).update_renditions()
+
+        asset = self._check_index()
+        self.assertEqual(asset.ladder, self.LADDER)
+        self.assertEqual(asset.representations, 4)
+
+    def test_destroy_by_index(self):
+        self._generate()
+
+        with mock.patch.object(default_storage, "exists", side_effect=AssertionError("storage probed")), \
+                mock.patch.object(default_storage, "listdir", side_effect=AssertionError("storage listed")):
+            DashVideoManager(self.video_name, default_storage).destroy()
+
+        self.assertEqual(self._stored_files(), {})
+        self.assertFalse(DashAsset.objects.filter(file_name=self.video_name).exists())
+
+    def test_destroy_incomplete_index(self):
+        self._generate()
+        DashAsset.objects.filter(file_name=self.video_name).update(state=DashAsset.STATE_PUBLISHING)
+
+        DashVideoManager(self.video_name, default_storage).destroy()
+
+        self.assertEqual(self._stored_files(), {})
+        self.assertFalse(DashAsset.objects.filter(file_name=self.video_name).exists())
+
+    def test_index_existing_video(self):
+        self._generate()
+        DashAsset.objects.all().delete()
+
+        self.assertTrue(DashVideoManager(self.video_name, default_storage).index())
+
+        asset = self._check_index()
+        self.assertEqual(asset.ladder, self.LADDER)
+        self.assertFalse(DashVideoManager("videos/missing.mp4", default_storage).index())
+
+    @override_settings(DASH_POSTER_CANDIDATES=3)
+    def test_poster_candidate_urls(self):
+        video = Lesson(video="videos/lecture.mp4").video
+        names = [DashFilesNames.poster_candidate_name(video.name, index) for index in (1, 2)]
+
+        # без индекса в storage проверяется не больше DASH_POSTER_CANDIDATES вариантов
+        with mock.patch.object(default_storage, "exists", return_value=True) as exists:
+            self.assertEqual(len(video.poster_candidate_urls), 3)
+        self.assertEqual(exists.call_count, 3)
+
+        DashAsset.add_files(video.name, {name: 100 for name in names}, "", published=True)
+        with mock.patch.object(default_storage, "exists", side_effect=AssertionError("storage probed")):
+            self.assertEqual(video.poster_candidate_urls, [default_storage.url(name) for name in names])
+
+    def test_format_ladder(self):
+        self.assertEqual(format_ladder(parse_ladder(self.LADDER)), self.LADDER)
+
+    def test_storage_usage_command(self):
+        for slug, sizes in (("python", [100, 200]), ("django", [50])):
+            course = Course.objects.create(name=slug, slug=slug)
+            for index, size in enumerate(sizes):
+                file_name = f"videos/{slug}-{index}.mp4"
+                lesson = Lesson.objects.create(course=course, name=file_name, slug=f"lesson-{index}")
+                Lesson.objects.filter(pk=lesson.pk).update(video=file_name)
+                DashAsset.objects.create(file_name=file_name, state=DashAsset.STATE_PUBLISHED,
+                                         file_count=10, size=size)
+
+        output = io.StringIO()
+        call_command("dash_storage_usage", "courses.Lesson", group_by="course__slug", stdout=output)
+        usage = json.loads(output.getvalue())["courses.Lesson.video"]
+
+        self.assertEqual(usage["total"], {"videos": 3, "files": 30, "bytes": 350})
+        self.assertEqual(usage["groups"], {
+            "django": {"videos": 1, "files": 10, "bytes": 50},
+            "python": {"videos": 2, "files": 20, "bytes": 300},
+        })
+        with self.assertRaises(CommandError):
+            call_command("dash_storage_usage", group_by="missing", stdout=output)
+
+    def test_stream_id_of(self):
+        self.assertEqual(stream_id_of("videos/lecture.mp4", "videos/lecture-chunk-stream12-00003.m4s"), 12)
+        self.assertEqual(stream_id_of("videos/lecture.mp4", "videos/lecture-init-stream0.m4s"), 0)
+        self.assertEqual(stream_id_of("videos/lecture.mp4", "videos/lecture-stream2.mp4"), 2)
+        self.assertEqual(stream_id_of("videos/lecture.mp4", "videos/lecture-media-1.m3u8"), 1)
+        self.assertIsNone(stream_id_of("videos/lecture.mp4", "videos/lecture.mpd"))
+        self.assertIsNone(stream_id_of("videos/lecture.mp4", "videos/lecture-preview.jpg"))
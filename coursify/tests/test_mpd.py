@@ -0,0 +1,173 @@
+import io
+import struct
+
+from django.test import SimpleTestCase
+
+from ..mpd import ON_DEMAND_PROFILE, MpdManifest, find_index_range, parse_iso_duration
+
+MPD_WITH_TIMELINE = """<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT8.0S">
+    <Period id="0" start="PT0.0S">
+        <AdaptationSet id="0" contentType="video">
+            <Representation id="0" bandwidth="450000" width="640" height="360">
+                <SegmentTemplate timescale="12288" initialization="v-init-stream$RepresentationID$.m4s"
+                                 media="v-chunk-stream$RepresentationID$-$Number%05d$.m4s" startNumber="1">
+                    <SegmentTimeline>
+                        <S t="0" d="61440" r="1" />
+                        <S d="37376" />
+                    </SegmentTimeline>
+                </SegmentTemplate>
+            </Representation>
+        </AdaptationSet>
+        <AdaptationSet id="1" contentType="audio">
+            <SegmentTemplate timescale="44100" initialization="a-init-$RepresentationID$.m4s"
+                             media="a-$RepresentationID$-$Time$.m4s" startNumber="1">
+                <SegmentTimeline>
+                    <S t="0" d="219136" />
+                    <S d="134488" />
+                </SegmentTimeline>
+            </SegmentTemplate>
+            <Representation id="1" bandwidth="128000" />
+        </AdaptationSet>
+    </Period>
+</MPD>
+"""
+
+MPD_WITH_DURATION = """<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT0H0M11.5S">
+    <Period>
+        <AdaptationSet>
+            <Representation id="video" bandwidth="700000">
+                <SegmentTemplate timescale="1000" duration="5000" startNumber="0"
+                                 initialization="init-$Bandwidth$.m4s" media="seg-$Number$.m4s" />
+            </Representation>
+        </AdaptationSet>
+    </Period>
+</MPD>
+"""
+
+MPD_WITH_SEGMENT_LIST = """<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" profiles="urn:mpeg:dash:profile:isoff-live:2011"
+     type="static" mediaPresentationDuration="PT8.0S">
+    <Period id="0" start="PT0.0S">
+        <AdaptationSet id="0" contentType="video">
+            <Representation id="0" bandwidth="450000" width="640" height="360">
+                <BaseURL>v-stream0.mp4</BaseURL>
+                <SegmentList timescale="1000000" duration="5000000" startNumber="1">
+                    <Initialization range="0-918" />
+                    <SegmentURL mediaRange="919-271988" />
+                    <SegmentURL mediaRange="271989-453844" />
+                </SegmentList>
+            </Representation>
+        </AdaptationSet>
+    </Period>
+</MPD>
+"""
+
+
+def box(box_type: bytes, body: bytes = b'') -> bytes:
+    return struct.pack('>I4s', len(body) + 8, box_type) + body
+
+
+class MpdManifestTest(SimpleTestCase):
+    def test_file_names_from_timeline(self):
+        manifest = MpdManifest.from_string(MPD_WITH_TIMELINE)
+
+        self.assertEqual(manifest.file_names("courses/lessons"), [
+            "courses/lessons/v-init-stream0.m4s",
+            "courses/lessons/v-chunk-stream0-00001.m4s",
+            "courses/lessons/v-chunk-stream0-00002.m4s",
+            "courses/lessons/v-chunk-stream0-00003.m4s",
+            "courses/lessons/a-init-1.m4s",
+            "courses/lessons/a-1-0.m4s",
+            "courses/lessons/a-1-219136.m4s",
+        ])
+
+    def test_file_names_from_duration(self):
+        manifest = MpdManifest.from_string(MPD_WITH_DURATION)
+
+        self.assertEqual(manifest.file_names(), [
+            "init-700000.m4s",
+            "seg-0.m4s",
+            "seg-1.m4s",
+            "seg-2.m4s",
+        ])
+
+    def test_file_names_from_base_url(self):
+        manifest = MpdManifest.from_string(MPD_WITH_SEGMENT_LIST)
+
+        self.assertEqual(manifest.file_names("courses/lessons"), ["courses/lessons/v-stream0.mp4"])
+
+    def test_set_segment_base(self):
+        manifest = MpdManifest.from_string(MPD_WITH_SEGMENT_LIST)
+        _, representation = next(manifest.representations())
+
+        manifest.set_segment_base(representation, (855, 918))
+        manifest = MpdManifest.from_string(manifest.to_string())
+        _, representation = next(manifest.representations())
+
+        self.assertEqual(manifest.root.get('profiles'), ON_DEMAND_PROFILE)
+        self.assertIsNone(representation.find(MpdManifest._tag('SegmentList')))
+        segment_base = representation.find(MpdManifest._tag('SegmentBase'))
+        self.assertEqual(segment_base.get('indexRange'), '855-918')
+        self.assertEqual(segment_base.find(MpdManifest._tag('Initialization')).get('range'), '0-854')
+        self.assertEqual(manifest.file_names(), ["v-stream0.mp4"])
+
+    def test_add_video_representation(self):
+        manifest = MpdManifest.from_string(MPD_WITH_TIMELINE)
+        adaptation_set = manifest.root.find(f".//{MpdManifest._tag('AdaptationSet')}")
+        adaptation_set.set('maxWidth', '640')
+        adaptation_set.set('maxHeight', '360')
+        other = MpdManifest.from_string(MPD_WITH_TIMELINE)
+        _, smaller = next(other.representations())
+        smaller.set('id', '2')
+        smaller.set('width', '426')
+        smaller.set('height', '240')
+        _, larger = next(MpdManifest.from_string(MPD_WITH_TIMELINE).representations())
+        larger.set('id', '3')
+        larger.set('width', '1280')
+        larger.set('height', '720')
+
+        self.assertEqual(manifest.max_representation_id(), 1)
+        manifest.add_video_representation(larger)
+        manifest.add_video_representation(smaller)
+        manifest = MpdManifest.from_string(manifest.to_string())
+
+        self.assertEqual([representation.get('id') for _, representation in manifest.video_representations()],
+                         ['2', '0', '3'])
+        self.assertEqual(manifest.max_representation_id(), 3)
+        adaptation_set, _ = next(manifest.video_representations())
+        self.assertEqual((adaptation_set.get('maxWidth'), adaptation_set.get('maxHeight')), ('1280', '720'))
+        self.assertIn('v-chunk-stream3-00003.m4s', manifest.file_names())
+
+    def test_property(self):
+        manifest = MpdManifest.from_string(MPD_WITH_TIMELINE)
+        self.assertIsNone(manifest.get_property('urn:test'))
+        manifest.set_property('urn:test', '1')
+        manifest.set_property('urn:test', '2')
+        manifest = MpdManifest.from_string(manifest.to_string())
+
+        self.assertEqual(manifest.get_property('urn:test'), '2')
+        adaptation_set, _ = next(manifest.video_representations())
+        self.assertEqual(len(adaptation_set.findall(MpdManifest._tag('SupplementalProperty'))), 1)
+        self.assertEqual(len(list(manifest.representations())), 2)
+
+    def test_find_index_range(self):
+        content = box(b'ftyp', b'isom') + box(b'moov', b'\0' * 100) + box(b'sidx', b'\0' * 56) + box(b'moof')
+
+        self.assertEqual(find_index_range(io.BytesIO(content)), (120, 183))
+
+    def test_find_index_range_without_sidx(self):
+        with self.assertRaises(ValueError):
+            find_index_range(io.BytesIO(box(b'ftyp', b'isom') + box(b'moof') + box(b'mdat')))
+
+    def test_not_mpd(self):
+        with self.assertRaises(ValueError):
+            MpdManifest.from_string("<html></html>")
+        with self.assertRaises(ValueError):
+            MpdManifest.from_string("not xml")
+
+    def test_parse_iso_duration(self):
+        self.assertEqual(parse_iso_duration("PT8.0S"), 8.0)
+        self.assertEqual(parse_iso_duration("PT1H2M3.5S"), 3723.5)
+        self.assertEqual(parse_iso_duration(None), 0.0)
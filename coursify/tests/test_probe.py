@@ -0,0 +1,66 @@
+import os
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from ..probe import VideoProbe
+
+
+class VideoProbeTest(SimpleTestCase):
+    def test_from_file(self):
+        video_path = os.path.join(
+            settings.BASE_DIR,
+            "coursify",
+            "tests",
+            "assets",
+            "video_field_test.mp4")
+
+        probe = VideoProbe.from_file(video_path)
+
+        self.assertEqual((probe.width, probe.height), (1280, 720))
+        self.assertEqual(probe.fps, 24)
+        self.assertEqual(probe.video_codec, "h264")
+        self.assertEqual(probe.audio_codec, "aac")
+        self.assertTrue(probe.has_audio)
+        self.assertTrue(probe.is_video)
+        self.assertGreater(probe.duration, 0)
+        self.assertGreater(probe.bit_rate, 0)
+
+    def test_from_file_not_video(self):
+        with self.assertRaises(ValueError):
+            VideoProbe.from_file(__file__)
+
+    def test_rotated_video(self):
+        probe = VideoProbe.from_ffprobe_output({
+            "streams": [{
+                "codec_type": "video",
+                "codec_name": "h264",
+                "width": 1920,
+                "height": 1080,
+                "avg_frame_rate": "30000/1001",
+                "side_data_list": [{"rotation": -90}],
+            }],
+            "format": {"duration": "10.0"},
+        })
+
+        self.assertEqual((probe.width, probe.height), (1080, 1920))
+        self.assertFalse(probe.has_audio)
+
+    def test_image_is_not_video(self):
+        probe = VideoProbe.from_ffprobe_output({
+            "streams": [{
+                "codec_type": "video",
+                "codec_name": "png",
+                "width": 100,
+                "height": 100,
+            }],
+            "format": {},
+        })
+
+        self.assertFalse(probe.is_video)
+
+    def test_dict_round_trip(self):
+        probe = VideoProbe(width=640, height=360, duration=1.5, fps=25,
+                           video_codec="h264", has_audio=True)
+
+        self.assertEqual(VideoProbe.from_dict(probe.as_dict()).as_dict(), probe.as_dict())
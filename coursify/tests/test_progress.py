@@ -0,0 +1,83 @@
+import io
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ..progress import FfmpegProgress
+
+PROGRESS_OUTPUT = """frame=0
+fps=0.00
+out_time_us=0
+out_time=00:00:00.000000
+speed=N/A
+progress=continue
+frame=55
+fps=0.00
+out_time_us=2306576
+out_time=00:00:02.306576
+speed=2.88x
+progress=continue
+frame=192
+fps=83.84
+out_time_us=8000000
+out_time=00:00:08.000000
+speed=3.1x
+progress=end
+"""
+
+
+class FfmpegProgressTest(SimpleTestCase):
+    def test_read(self):
+        reports = []
+        progress = FfmpegProgress(reports.append, interval=0)
+        progress.start_stage('encode')
+
+        progress.read(io.StringIO(PROGRESS_OUTPUT), 8.0)
+
+        self.assertEqual([report['percent'] for report in reports], [0.0, 0.0, 28.8, 100.0])
+        self.assertEqual(reports[2], {
+            'stage': 'encode',
+            'frame': 55,
+            'out_time': 2.307,
+            'speed': 2.88,
+            'eta': 2.0,
+            'percent': 28.8,
+        })
+        self.assertEqual(reports[-1]['frame'], 192)
+        self.assertIsNone(reports[-1]['eta'])
+
+    def test_parallel_processes(self):
+        progress = FfmpegProgress(mock.Mock())
+        progress.start_stage('encode')
+        progress.read(io.StringIO("out_time_us=4000000\nspeed=2x\nprogress=continue\n"), 10.0)
+        progress.read(io.StringIO("out_time_us=1000000\nspeed=1x\nprogress=continue\n"), 10.0)
+
+        snapshot = progress.snapshot()
+
+        self.assertEqual(snapshot['out_time'], 5.0)
+        self.assertEqual(snapshot['speed'], 3.0)
+        self.assertEqual(snapshot['eta'], 5.0)
+        self.assertEqual(snapshot['percent'], 25.0)
+
+    def test_report_interval(self):
+        report = mock.Mock()
+        progress = FfmpegProgress(report, interval=3600)
+        progress.start_stage('encode')
+
+        progress.read(io.StringIO(PROGRESS_OUTPUT), 8.0)
+
+        # начало этапа и завершение процесса, промежуточный ход пропущен
+        self.assertEqual([call[0][0]['percent'] for call in report.call_args_list], [0.0, 100.0])
+
+    def test_report_only_from_owner_thread(self):
+        report = mock.Mock()
+        progress = FfmpegProgress(report, interval=0)
+
+        thread = threading.Thread(target=progress.read, args=(io.StringIO(PROGRESS_OUTPUT), 8.0))
+        thread.start()
+        thread.join()
+        report.assert_not_called()
+
+        progress.report_if_due()
+        self.assertEqual(report.call_args[0][0]['percent'], 100.0)
@@ -0,0 +1,47 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ..resources import available_cpus
+
+
+class AvailableCpusTest(SimpleTestCase):
+    def setUp(self):
+        self.cgroup_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cgroup_dir.cleanup)
+        patcher = mock.patch('os.sched_getaffinity', return_value=set(range(8)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name: str, content: str):
+        path = os.path.join(self.cgroup_dir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(content)
+
+    def test_without_cgroup(self):
+        self.assertEqual(available_cpus(self.cgroup_dir.name), 8)
+
+    def test_cgroup_v2_quota(self):
+        self.write('cpu.max', '250000 100000\n')
+        self.assertEqual(available_cpus(self.cgroup_dir.name), 3)
+
+    def test_cgroup_v2_without_quota(self):
+        self.write('cpu.max', 'max 100000\n')
+        self.assertEqual(available_cpus(self.cgroup_dir.name), 8)
+
+    def test_cgroup_v1_quota(self):
+        self.write('cpu/cpu.cfs_quota_us', '50000\n')
+        self.write('cpu/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(available_cpus(self.cgroup_dir.name), 1)
+
+    def test_cgroup_v1_without_quota(self):
+        self.write('cpu/cpu.cfs_quota_us', '-1\n')
+        self.write('cpu/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(available_cpus(self.cgroup_dir.name), 8)
+
+    def test_quota_above_affinity(self):
+        self.write('cpu.max', '1600000 100000\n')
+        self.assertEqual(available_cpus(self.cgroup_dir.name), 8)
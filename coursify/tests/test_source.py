@@ -0,0 +1,157 @@
+import io
+import os
+import posixpath
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.test import SimpleTestCase
+
+from ..fields import DashFilesNames
+from ..mpd import MpdManifest
+from ..probe import VideoProbe
+from ..source import STDERR_MAX_LINES, ProcessCancelled, needs_seeking, run_with_source
+
+VIDEO_PATH = os.path.join(
+    settings.BASE_DIR,
+    "coursify",
+    "tests",
+    "assets",
+    "video_field_test.mp4")
+
+
+def create_faststart_video(path: str):
+    """копия тестового видео с блоком moov в начале файла"""
+    subprocess.run(['ffmpeg', '-v', 'error', '-i', VIDEO_PATH, '-c', 'copy',
+                    '-movflags', '+faststart', '-y', path], check=True)
+
+
+class StoredVideoMixin:
+    """тестовое видео, сохранённое в default_storage под названием VIDEO_NAME на время теста"""
+
+    VIDEO_NAME = "videos/video.mp4"
+
+    def setUp(self):
+        super().setUp()
+        with open(VIDEO_PATH, "rb") as video_file:
+            self.video_name = default_storage.save(self.VIDEO_NAME, File(video_file))
+        self.addCleanup(default_storage.delete, self.video_name)
+        self.mpd_manifest_name = DashFilesNames.mpd_manifest_name(self.video_name)
+
+    def _read_manifest(self) -> MpdManifest:
+        with default_storage.open(self.mpd_manifest_name, "rb") as mpd_file:
+            return MpdManifest.from_string(mpd_file.read())
+
+    def _get_dash_file_names(self) -> list:
+        """DASH файлы видео в storage, кроме оригинала"""
+        directory = posixpath.dirname(self.video_name)
+        _, file_names = default_storage.listdir(directory)
+        prefix = DashFilesNames.get_video_name(posixpath.basename(self.video_name))
+        return [posixpath.join(directory, name) for name in file_names
+                if name.startswith(prefix) and name != posixpath.basename(self.video_name)]
+
+
+def box(box_type: bytes, body: bytes = b'') -> bytes:
+    return struct.pack('>I4s', len(body) + 8, box_type) + body
+
+
+class NeedsSeekingTest(SimpleTestCase):
+    def test_moov_at_end(self):
+        with open(VIDEO_PATH, "rb") as video_file:
+            self.assertTrue(needs_seeking(video_file))
+
+    def test_moov_at_start(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "faststart.mp4")
+            create_faststart_video(path)
+            with open(path, "rb") as video_file:
+                self.assertFalse(needs_seeking(video_file))
+
+    def test_not_mp4(self):
+        self.assertFalse(needs_seeking(io.BytesIO(b'\x1a\x45\xdf\xa3webm')))
+
+    def test_large_header(self):
+        content = box(b'ftyp', b'isom') + box(b'free', b'\0' * 2 * 1024 * 1024) + box(b'moov')
+        self.assertTrue(needs_seeking(io.BytesIO(content)))
+
+
+class RunWithSourceTest(SimpleTestCase):
+    def test_output(self):
+        result = run_with_source(
+            [sys.executable, '-c', 'import sys; print(len(sys.stdin.buffer.read()))'],
+            io.BytesIO(b'x' * 100000))
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.strip(), '100000')
+
+    def test_process_exits_before_end_of_source(self):
+        result = run_with_source(
+            [sys.executable, '-c', 'import sys; sys.stdin.buffer.read(10)'],
+            io.BytesIO(b'x' * 10 * 1024 * 1024))
+
+        self.assertEqual(result.returncode, 0)
+
+    def test_read_output(self):
+        lines = []
+        result = run_with_source(
+            [sys.executable, '-c', 'import sys; print(len(sys.stdin.buffer.read())); print("done")'],
+            io.BytesIO(b'x' * 100000),
+            lambda output: lines.extend(line.strip() for line in output))
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(lines, ['100000', 'done'])
+        self.assertEqual(result.stdout, '')
+
+    def test_without_source(self):
+        result = run_with_source([sys.executable, '-c', 'import sys; print(sys.stdin.read() == "")'], None)
+
+        self.assertEqual(result.stdout.strip(), 'True')
+
+    def test_stderr_is_bounded(self):
+        result = run_with_source(
+            [sys.executable, '-c', 'import sys\nfor i in range(10000): print(i, file=sys.stderr)'], None)
+
+        self.assertEqual(result.stderr.splitlines(), [str(i) for i in range(10000 - STDERR_MAX_LINES, 10000)])
+
+    def test_arguments_are_not_parsed_by_shell(self):
+        result = run_with_source([sys.executable, '-c', 'import sys; print(sys.argv[1])', "it's a $name"], None)
+
+        self.assertEqual(result.stdout.strip(), "it's a $name")
+
+    def test_timeout(self):
+        started_at = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired) as error:
+            run_with_source([sys.executable, '-c', 'import sys, time; print("started", file=sys.stderr, '
+                                                   'flush=True); time.sleep(60)'],
+                            io.BytesIO(b'x' * 100), timeout=0.5)
+
+        self.assertLess(time.monotonic() - started_at, 30)
+        self.assertEqual(error.exception.stderr.strip(), 'started')
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        threading.Timer(0.5, cancel.set).start()
+        lines = []
+        with self.assertRaises(ProcessCancelled):
+            run_with_source([sys.executable, '-c', 'import time; print("started", flush=True); time.sleep(60)'],
+                            None, lambda output: lines.extend(output), cancel=cancel)
+
+        self.assertEqual(lines, ['started\n'])
+        with self.assertRaises(ProcessCancelled):
+            run_with_source([sys.executable, '-c', ''], None, cancel=cancel)
+
+    def test_probe_from_stream(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "faststart.mp4")
+            create_faststart_video(path)
+            with open(path, "rb") as video_file:
+                probe = VideoProbe.from_stream(video_file)
+
+        self.assertEqual((probe.width, probe.height), (1280, 720))
+        self.assertTrue(probe.is_video)
@@ -0,0 +1,208 @@
+import datetime
+import io
+import json
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from ..celery import configure_transcoding_worker
+from ..fields import VideoField
+from ..models import VideoConversion
+from ..probe import VideoProbe
+from ..tasks import (age_transcoding_queue, enqueue_dash_generation, generate_dash, generate_dash_manifest,
+                     get_aged_priority, get_transcoding_priority, get_transcoding_queue)
+
+
+@override_settings(DASH_QUEUE='transcoding', DASH_HEAVY_QUEUE='transcoding-heavy', DASH_HEAVY_HEIGHT=1080)
+class TranscodingQueueTest(SimpleTestCase):
+    def test_queue(self):
+        self.assertEqual(get_transcoding_queue(VideoProbe(width=1280, height=720)), 'transcoding')
+        self.assertEqual(get_transcoding_queue(None), 'transcoding')
+
+    def test_heavy_queue(self):
+        self.assertEqual(get_transcoding_queue(VideoProbe(width=1920, height=1080)), 'transcoding-heavy')
+        self.assertEqual(get_transcoding_queue(VideoProbe(width=1080, height=1920)), 'transcoding-heavy')
+
+    def test_late_acks(self):
+        self.assertTrue(generate_dash_manifest.acks_late)
+        self.assertTrue(generate_dash_manifest.reject_on_worker_lost)
+        # неподтверждённая задача не отдаётся повторно, пока идёт самая долгая конвертация
+        self.assertGreater(settings.CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout'],
+                           settings.DASH_MAX_VIDEO_DURATION * settings.DASH_FFMPEG_TIMEOUT)
+
+
+@override_settings(DASH_QUEUE='transcoding', DASH_HEAVY_QUEUE='transcoding-heavy', DASH_WORKER_CONCURRENCY=3)
+class TranscodingWorkerTest(SimpleTestCase):
+    def configure(self, **options):
+        conf = mock.Mock(worker_concurrency=None, worker_prefetch_multiplier=4)
+        configure_transcoding_worker(conf=conf, options=options)
+        return conf
+
+    def test_transcoding_worker(self):
+        conf = self.configure(queues=['transcoding'], concurrency=None)
+
+        self.assertEqual(conf.worker_concurrency, 3)
+        self.assertEqual(conf.worker_prefetch_multiplier, 1)
+
+    def test_explicit_concurrency(self):
+        conf = self.configure(queues='transcoding,transcoding-heavy', concurrency=2)
+
+        self.assertIsNone(conf.worker_concurrency)
+        self.assertEqual(conf.worker_prefetch_multiplier, 1)
+
+    def test_other_worker(self):
+        for queues in (None, ['celery'], ['celery', 'transcoding']):
+            conf = self.configure(queues=queues, concurrency=None)
+
+            self.assertIsNone(conf.worker_concurrency)
+            self.assertEqual(conf.worker_prefetch_multiplier, 4)
+
+
+@override_settings(DASH_PRIORITY_STEPS=[300, 1200, 3600, 10800], DASH_PRIORITY_AGING=600)
+class TranscodingPriorityTest(SimpleTestCase):
+    def test_shortest_job_first(self):
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=1280, height=720, duration=120)), 0)
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=1280, height=720, duration=900)), 1)
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=1280, height=720, duration=7200)), 3)
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=1920, height=1080, duration=7200)), 4)
+
+    def test_resolution(self):
+        # 10 минут 360p кодируются быстрее, чем 10 минут 1080p
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=640, height=360, duration=600)), 0)
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=1920, height=1080, duration=600)), 2)
+
+    def test_retranscode_tier(self):
+        probe = VideoProbe(width=1280, height=720, duration=120)
+
+        self.assertEqual(get_transcoding_priority(probe, retranscode=True), 5)
+        self.assertEqual(get_transcoding_priority(VideoProbe(width=1920, height=1080, duration=7200), True), 9)
+
+    def test_unknown_duration(self):
+        self.assertEqual(get_transcoding_priority(None), 2)
+        self.assertEqual(get_transcoding_priority(None, retranscode=True), 7)
+
+    def test_aging(self):
+        now = timezone.now()
+
+        self.assertEqual(get_aged_priority(4, now - datetime.timedelta(seconds=599), now), 4)
+        self.assertEqual(get_aged_priority(4, now - datetime.timedelta(seconds=1300), now), 2)
+        self.assertEqual(get_aged_priority(9, now - datetime.timedelta(hours=5), now), 0)
+
+    @override_settings(DASH_PRIORITY_AGING=0)
+    def test_without_aging(self):
+        now = timezone.now()
+        self.assertEqual(get_aged_priority(4, now - datetime.timedelta(hours=5), now), 4)
+
+
+@override_settings(DASH_QUEUE='transcoding', DASH_HEAVY_QUEUE='transcoding-heavy', DASH_HEAVY_HEIGHT=1080,
+                   DASH_PRIORITY_STEPS=[300, 1200, 3600, 10800], DASH_PRIORITY_AGING=600)
+class TranscodingEnqueueTest(TestCase):
+    def enqueue(self, probe=None, retranscode=False):
+        with mock.patch.object(generate_dash_manifest, 'apply_async') as apply_async:
+            enqueue_dash_generation('video.mp4', probe, retranscode)
+        return apply_async.call_args[1]
+
+    @override_settings(DASH_RUN_CONVERTATION_AT_ASYNC=True)
+    def test_gen_dash_routes_task(self):
+        with mock.patch.object(generate_dash_manifest, 'apply_async') as apply_async:
+            VideoField().gen_dash('video.mp4', VideoProbe(width=3840, height=2160, duration=60))
+
+        self.assertEqual(apply_async.call_args[1]['queue'], 'transcoding-heavy')
+
+    def test_enqueue(self):
+        task = self.enqueue(VideoProbe(width=1280, height=720, duration=7200), retranscode=True)
+
+        conversion = VideoConversion.objects.get(file_name='video.mp4')
+        self.assertEqual(conversion.state, VideoConversion.STATE_QUEUED)
+        self.assertEqual(conversion.tier, VideoConversion.TIER_RETRANSCODE)
+        self.assertEqual((conversion.priority, conversion.task_priority), (8, 8))
+        self.assertEqual(conversion.queue, 'transcoding')
+        self.assertEqual(task['task_id'], conversion.task_id)
+        self.assertEqual(task['priority'], 8)
+        self.assertIsNone(conversion.queue_wait)
+
+    def test_start_task(self):
+        self.enqueue()
+        conversion = VideoConversion.objects.get(file_name='video.mp4')
+
+        started = VideoConversion.start('video.mp4', conversion.task_id)
+
+        self.assertEqual(started.state, VideoConversion.STATE_PROGRESS)
+        self.assertEqual(started.queued_at, conversion.queued_at)
+        self.assertGreaterEqual(started.queue_wait, 0)
+        # брокер повторно отдал задачу, пока конвертация идёт
+        self.assertIsNone(VideoConversion.start('video.mp4', conversion.task_id))
+        # брокер повторно отдал задачу после падения воркера
+        VideoConversion.objects.update(updated_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertIsNotNone(VideoConversion.start('video.mp4', conversion.task_id))
+
+    def test_skip_outdated_task(self):
+        self.enqueue()
+
+        with mock.patch('coursify.tasks.DashVideoManager') as manager:
+            generate_dash('video.mp4', task_id='outdated')
+
+        manager.assert_not_called()
+        self.assertEqual(VideoConversion.objects.get().state, VideoConversion.STATE_QUEUED)
+
+    def test_task_without_conversion(self):
+        # задача, поставленная в очередь до появления VideoConversion
+        conversion = VideoConversion.start('video.mp4', 'task')
+
+        self.assertEqual(conversion.task_id, 'task')
+        self.assertEqual(conversion.queue_wait, 0)
+
+    def test_age_queue(self):
+        self.enqueue(VideoProbe(width=1280, height=720, duration=7200))
+        VideoConversion.objects.update(queued_at=timezone.now() - datetime.timedelta(seconds=1300))
+        old_task_id = VideoConversion.objects.get().task_id
+
+        with mock.patch.object(generate_dash_manifest, 'apply_async') as apply_async:
+            age_transcoding_queue()
+            age_transcoding_queue()
+
+        conversion = VideoConversion.objects.get()
+        # анализ видео передаётся и новой задаче, чтобы воркер не анализировал видео повторно
+        apply_async.assert_called_once_with(
+            args=['video.mp4'], kwargs={'probe': VideoProbe(width=1280, height=720, duration=7200).as_dict()},
+            queue='transcoding', priority=1, task_id=conversion.task_id)
+        self.assertNotEqual(conversion.task_id, old_task_id)
+        self.assertIsNone(VideoConversion.start('video.mp4', old_task_id))
+        self.assertIsNotNone(VideoConversion.start('video.mp4', conversion.task_id))
+
+    def test_not_age_started_conversion(self):
+        self.enqueue(VideoProbe(width=1280, height=720, duration=7200))
+        conversion = VideoConversion.objects.get()
+        VideoConversion.objects.update(queued_at=timezone.now() - datetime.timedelta(hours=1))
+        VideoConversion.start('video.mp4', conversion.task_id)
+
+        with mock.patch.object(generate_dash_manifest, 'apply_async') as apply_async:
+            age_transcoding_queue()
+
+        apply_async.assert_not_called()
+        self.assertEqual(VideoConversion.objects.get().task_id, conversion.task_id)
+
+    def test_queue_wait_stats(self):
+        now = timezone.now()
+        for index, wait in enumerate([10, 20, 30, 400]):
+            VideoConversion.objects.create(
+                file_name=f'video{index}.mp4', state=VideoConversion.STATE_DONE,
+                queued_at=now - datetime.timedelta(seconds=wait), started_at=now)
+        VideoConversion.objects.create(
+            file_name='queued.mp4', state=VideoConversion.STATE_QUEUED,
+            tier=VideoConversion.TIER_RETRANSCODE, queued_at=now)
+
+        output = io.StringIO()
+        call_command('transcoding_queue_stats', stdout=output)
+        tiers = json.loads(output.getvalue())['tiers']
+
+        self.assertEqual(tiers['publish']['started'], 4)
+        self.assertEqual(tiers['publish']['wait_mean'], 115.0)
+        self.assertEqual(tiers['publish']['wait_median'], 20.0)
+        self.assertEqual(tiers['publish']['wait_p95'], 400.0)
+        self.assertEqual(tiers['retranscode']['started'], 0)
+        self.assertEqual(tiers['retranscode']['waiting'], 1)
+        self.assertIsNone(tiers['retranscode']['wait_mean'])
@@ -0,0 +1,108 @@
+import errno
+import os
+import tempfile
+from unittest import mock
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+from ..uploader import StorageUploader
+
+
+class StorageUploaderTest(SimpleTestCase):
+    def setUp(self):
+        self.local_dir = tempfile.TemporaryDirectory()
+        self.storage_dir = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(location=self.storage_dir.name)
+
+    def tearDown(self):
+        self.local_dir.cleanup()
+        self.storage_dir.cleanup()
+
+    def _create_local_file(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.local_dir.name, name)
+        with open(path, "wb") as local_file:
+            local_file.write(content)
+        return path
+
+    def test_upload(self):
+        uploader = StorageUploader(self.storage, concurrency=4)
+        for index in range(10):
+            path = self._create_local_file(f"{index}.m4s", b"x" * index)
+            uploader.upload(path, f"{index}.m4s")
+        uploader.close()
+
+        for index in range(10):
+            with self.storage.open(f"{index}.m4s") as storage_file:
+                self.assertEqual(storage_file.read(), b"x" * index)
+
+        stats = uploader.stats.as_dict()
+        self.assertEqual(stats["files"], 10)
+        self.assertEqual(stats["bytes"], sum(range(10)))
+
+    def test_remove_after_upload(self):
+        path = self._create_local_file("seg.m4s", b"segment")
+        uploader = StorageUploader(self.storage)
+        uploader.upload(path, "seg.m4s", remove=True)
+        uploader.close()
+
+        self.assertTrue(self.storage.exists("seg.m4s"))
+        self.assertFalse(os.path.exists(path))
+
+    def test_move_to_local_storage(self):
+        path = self._create_local_file("seg.m4s", b"segment")
+        inode = os.stat(path).st_ino
+        storage = FileSystemStorage(location=self.storage_dir.name, file_permissions_mode=0o640)
+        uploader = StorageUploader(storage)
+        uploader.upload(path, "video/seg.m4s", remove=True)
+        uploader.close()
+
+        storage_path = storage.path("video/seg.m4s")
+        self.assertEqual(os.stat(storage_path).st_ino, inode)
+        self.assertEqual(os.stat(storage_path).st_mode & 0o777, 0o640)
+        self.assertEqual(uploader.stats.as_dict()["files"], 1)
+
+    def test_copy_when_move_is_impossible(self):
+        path = self._create_local_file("seg.m4s", b"segment")
+        uploader = StorageUploader(self.storage)
+        cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+
+        with mock.patch("coursify.uploader.os.replace", side_effect=cross_device):
+            uploader.upload(path, "seg.m4s", remove=True)
+            uploader.close()
+
+        with self.storage.open("seg.m4s") as storage_file:
+            self.assertEqual(storage_file.read(), b"segment")
+        self.assertFalse(os.path.exists(path))
+
+    def test_retry(self):
+        path = self._create_local_file("seg.m4s", b"segment")
+        uploader = StorageUploader(self.storage, retries=2)
+        storage_open = self.storage.open
+        attempts = []
+
+        def flaky_open(name, mode="rb"):
+            attempts.append(name)
+            if len(attempts) == 1:
+                raise IOError("network error")
+            return storage_open(name, mode)
+
+        with mock.patch.object(StorageUploader, "RETRY_DELAY", 0), \
+                mock.patch.object(self.storage, "open", side_effect=flaky_open), \
+                self.assertLogs("coursify.uploader", "WARNING"):
+            uploader.upload(path, "seg.m4s")
+            uploader.close()
+
+        self.assertEqual(len(attempts), 2)
+        self.assertTrue(self.storage.exists("seg.m4s"))
+
+    def test_error_after_retries(self):
+        path = self._create_local_file("seg.m4s", b"segment")
+        uploader = StorageUploader(self.storage, retries=1)
+
+        with mock.patch.object(StorageUploader, "RETRY_DELAY", 0), \
+                mock.patch.object(self.storage, "open", side_effect=IOError("network error")), \
+                self.assertLogs("coursify.uploader", "WARNING"):
+            uploader.upload(path, "seg.m4s")
+            with self.assertRaises(IOError):
+                uploader.wait()
@@ -0,0 +1,37 @@
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import SimpleTestCase
+
+from ..uploadhandlers import (ContentDigestMemoryFileUploadHandler,
+                              ContentDigestTemporaryFileUploadHandler, get_content_digest)
+
+CONTENT = b"video content" * 1000
+
+
+class ContentDigestUploadHandlerTest(SimpleTestCase):
+    def _upload(self, handler):
+        handler.handle_raw_input(None, {}, len(CONTENT), "boundary")
+        try:
+            handler.new_file("video", "video.mp4", "video/mp4", len(CONTENT))
+        except StopFutureHandlers:
+            pass
+        for start in range(0, len(CONTENT), 4096):
+            handler.receive_data_chunk(CONTENT[start:start + 4096], start)
+        return handler.file_complete(len(CONTENT))
+
+    def test_memory_upload(self):
+        uploaded_file = self._upload(ContentDigestMemoryFileUploadHandler())
+
+        self.assertEqual(uploaded_file.content_digest, hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(get_content_digest(uploaded_file), uploaded_file.content_digest)
+
+    def test_temporary_file_upload(self):
+        uploaded_file = self._upload(ContentDigestTemporaryFileUploadHandler())
+
+        self.assertEqual(uploaded_file.content_digest, hashlib.sha256(CONTENT).hexdigest())
+        uploaded_file.close()
+
+    def test_digest_of_file_without_handler(self):
+        self.assertEqual(get_content_digest(ContentFile(CONTENT)), hashlib.sha256(CONTENT).hexdigest())
@@ -0,0 +1,198 @@
+import errno
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.core.files.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class UploadStats:
+    """ Статистика сохранения файлов в storage для настройки параллельности."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def add(self, size: int, latency: float):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.latencies.append(latency)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            latencies = list(self.latencies)
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'latency_total': sum(latencies),
+            'latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_max': max(latencies, default=0.0),
+        }
+
+
+class StorageUploader:
+    """ Параллельно сохраняет файлы из локальной файловой системы в storage.
+
+    Каждый файл сохраняется в отдельном потоке из пула ограниченного размера,
+    т.к. для удалённого storage сохранение маленького файла - это в основном
+    ожидание сети. При ошибке сохранение файла повторяется несколько раз
+    с увеличивающейся паузой.
+
+    upload только ставит файл в очередь, wait дожидается сохранения
+    всех поставленных файлов и пробрасывает первую ошибку.
+
+    Если локальный файл после сохранения не нужен, а storage хранит файлы
+    в той же файловой системе (FileSystemStorage), файл не копируется,
+    а атомарно переименовывается на место файла storage.
+    """
+
+    RETRY_DELAY = 0.5
+
+    def __init__(self, storage: Storage, concurrency: int = 8, retries: int = 3):
+        """
+        :param storage: storage, в который сохраняются файлы
+        :param concurrency: сколько файлов сохраняется одновременно
+        :param retries: сколько раз повторить сохранение файла после ошибки
+        """
+        self.storage = storage
+        self.retries = retries
+        self.stats = UploadStats()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def upload(self, file_path: str, storage_name: str, remove: bool = False):
+        """ставит файл в очередь на сохранение в storage
+
+        :param file_path: путь к файлу в локальной файловой системе
+        :param storage_name: название файла в storage
+        :param remove: удалить локальный файл после сохранения
+        """
+        with self._lock:
+            self._futures.append(
+                self._executor.submit(self._upload_file, file_path, storage_name, remove))
+
+    def wait(self):
+        """дожидается сохранения всех файлов, поставленных в очередь"""
+        with self._lock:
+            futures, self._futures = self._futures, []
+
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+        stats = self.stats.as_dict()
+        logger.info('Uploaded %(files)d files, %(bytes)d bytes, '
+                    'mean latency %(latency_mean).3fs, max latency %(latency_max).3fs', stats)
+
+    def _upload_file(self, file_path: str, storage_name: str, remove: bool):
+        size = os.path.getsize(file_path)
+        started_at = time.monotonic()
+
+        if remove and self._move_local_file(file_path, storage_name):
+            self.stats.add(size, time.monotonic() - started_at)
+            return
+
+        for attempt in range(self.retries + 1):
+            try:
+                with open(file_path, "rb") as local_file:
+                    storage_file = self.storage.open(storage_name, "wb+")
+                    shutil.copyfileobj(local_file, storage_file)
+                    storage_file.close()
+                break
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.warning('Cannot upload %s, retrying', storage_name, exc_info=True)
+                time.sleep(self.RETRY_DELAY * 2 ** attempt)
+
+        latency = time.monotonic() - started_at
+        self.stats.add(size, latency)
+        logger.debug('Uploaded %s, %d bytes in %.3fs', storage_name, size, latency)
+
+        if remove:
+            os.remove(file_path)
+
+    def _move_local_file(self, file_path: str, storage_name: str) -> bool:
+        """переименовывает локальный файл в файл storage, если это возможно"""
+
+        try:
+            storage_path = self.storage.path(storage_name)
+        except NotImplementedError:
+            return False
+
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+        try:
+            os.replace(file_path, storage_path)
+        except OSError as error:
+            # файл и storage в разных файловых системах
+            if error.errno == errno.EXDEV:
+                return False
+            raise
+
+        permissions_mode = getattr(self.storage, 'file_permissions_mode', None)
+        if permissions_mode is not None:
+            os.chmod(storage_path, permissions_mode)
+        return True
+
+
+class SegmentWatcher(threading.Thread):
+    """ Сохраняет в storage готовые сегменты dash, пока ffmpeg ещё кодирует видео.
+
+    ffmpeg пишет каждый сегмент во временный файл *.tmp и переименовывает
+    его, когда сегмент записан полностью. Поэтому файл, подходящий под маску
+    сегментов, уже закрыт и его можно сохранять. Каждый сегмент передаётся
+    в функцию сохранения один раз, она же удаляет локальную копию,
+    так что на диске не копится вся лестница.
+
+    Сегменты, которые появятся после остановки наблюдателя, и init файлы
+    сохраняются обычным образом после завершения ffmpeg, mpd манифест - последним.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, directory: str, pattern: str, save_file):
+        """
+        :param directory: директория, куда ffmpeg пишет сегменты
+        :param pattern: glob маска названий сегментов
+        :param save_file: функция, сохраняющая файл по его пути в storage
+        """
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.pattern = pattern
+        self.save_file = save_file
+        self.error = None
+        self._seen = set()
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.POLL_INTERVAL):
+                self.save_finished_segments()
+        except Exception as error:
+            self.error = error
+
+    def save_finished_segments(self):
+        for segment_path in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            if segment_path not in self._seen:
+                self._seen.add(segment_path)
+                self.save_file(segment_path)
+
+    def stop(self):
+        """останавливает наблюдение и пробрасывает ошибку сохранения, если она была"""
+        self._stopped.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,51 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+def get_content_digest(content) -> str:
+    """sha256 содержимого файла. Если файл загружен через обработчики
+    из этого модуля, sha256 уже посчитан во время загрузки"""
+
+    digest = getattr(content, 'content_digest', None)
+    if digest:
+        return digest
+
+    content_hash = hashlib.sha256()
+    for chunk in content.chunks():
+        content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class ContentDigestMixin:
+    """ Считает sha256 загружаемого файла по мере получения его частей,
+    чтобы не читать файл ещё раз после загрузки. Результат доступен
+    в атрибуте content_digest загруженного файла."""
+
+    def new_file(self, *args, **kwargs):
+        self.content_hash = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.is_receiving():
+            self.content_hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_digest = self.content_hash.hexdigest()
+        return file
+
+    def is_receiving(self) -> bool:
+        return True
+
+
+class ContentDigestMemoryFileUploadHandler(ContentDigestMixin, MemoryFileUploadHandler):
+    def is_receiving(self) -> bool:
+        # большие файлы этот обработчик передаёт следующему
+        return self.activated
+
+
+class ContentDigestTemporaryFileUploadHandler(ContentDigestMixin, TemporaryFileUploadHandler):
+    pass